@@ -13,12 +13,23 @@
 # limitations under the License.
 
 from __future__ import print_function
-import json
 import tensorflow as tf
 import random
+import itertools
+import multiprocessing
+from multiprocessing.util import Finalize
+from collections import OrderedDict, namedtuple
+import numpy as np
 
-from salento.models.low_level_evidences.infer import BayesianPredictor, event_states
-from salento.models.low_level_evidences.data_reader import smart_open
+from salento.models.low_level_evidences.infer import BayesianPredictor
+from salento.models.low_level_evidences.data_reader import PackageIndex
+from salento.models.low_level_evidences.store import ModelStore
+from salento.models.low_level_evidences.cache import DecoderCache
+from salento.aggregators.dataset import CompiledDataset, compile_packages
+
+
+# a sequence of the data: the compiled dataset (chunk of packages) that has it, and its number in it
+Sequence = namedtuple('Sequence', ['data', 'number'])
 
 
 class Aggregator(object):
@@ -26,13 +37,33 @@ class Aggregator(object):
     The base class for aggregators
     """
 
-    def __init__(self, data_file, model_dir):
+    # the number of packages that are compiled, and have their latent specifications prefetched, together
+    chunk_size = 256
+
+    def __init__(self, data_file, model_dir, backend='tensorflow', store=None, psi_mean=False, psi_samples=1,
+                 workers=1):
         """
-        :param data_file: the data file, should have evidences extracted
+        Subclasses take the same options in the same order, followed by their own ones
+        :param data_file: the data file (or columnar dataset, see columnar.py), should have evidences extracted
         :param model_dir: directory where model is stored
+        :param backend: 'tensorflow', or 'numpy' to run on the weights exported by export.py without a session
+        :param store: directory of persistent stores, to reuse the latent specifications and decoder
+                      states of earlier runs of the same model (see ModelStore)
+        :param psi_mean: if True, use the mean latent specification of evidences instead of a sample
+        :param psi_samples: the number of latent specifications to sample and average the model over
+        :param workers: the number of processes to score packages in (see map_packages)
         """
         self._data_file = data_file
         self._model_dir = model_dir
+        self._backend = backend
+        self._store_dir = store
+        self._psi_mean = psi_mean
+        self._psi_samples = psi_samples
+        self.workers = workers
+        self._specs = {}
+        self._reader = None  # the PackageIndex of a worker process (see _read_package)
+        self.store = None
+        self.cache = None  # the DecoderCache of subclasses that use one
         self.END_MARKER = 'STOP'
 
 
@@ -41,79 +72,224 @@ class Aggregator(object):
 
     def __enter__(self):
         self.log('Loading model...', end='')
-        self.sess = tf.Session()
-        self.model = BayesianPredictor(self._model_dir, self.sess)
+        self._load_model()
         self.log('done')
-
-        self.log('Loading data...', end='')
-        with smart_open(self._data_file, "rt") as f:
-            self.dataset = json.load(f)
-        self.log('done')
-
+        if self.store is not None:
+            self.log('Using store {}'.format(self.store))
+        # the data is not loaded here, but read and compiled a chunk at a time as packages() is consumed
         return self
 
+    def _data_vocab(self):
+        # the vocab that the events of the data are compiled with (and filtered by)
+        return self.model.model.config.decoder.vocab
+
     def __exit__(self, exc_type, exc_val, exc_tb):
-        self.sess.close()
+        self._close_model()
+        if self.store is not None:
+            self.log('Saved store {}'.format(self.store))
+
+    def _load_predictor(self, model_dir, threads=0):
+        # each model gets a graph of its own, so that several models can be loaded side by side
+        # threads is the size of the session's thread pools, 0 to let TF pick it
+        if self._backend != 'tensorflow':
+            return None, BayesianPredictor(model_dir, None, self._backend, self._psi_mean, self._psi_samples)
+        graph = tf.Graph()
+        with graph.as_default():
+            sess = tf.Session(graph=graph, config=tf.ConfigProto(intra_op_parallelism_threads=threads,
+                                                                 inter_op_parallelism_threads=threads))
+            return sess, BayesianPredictor(model_dir, sess, self._backend, self._psi_mean, self._psi_samples)
+
+    def _load_model(self, threads=0):
+        self.sess, self.model = self._load_predictor(self._model_dir, threads)
+        self.store = None
+        if self._store_dir is not None:
+            self.store = ModelStore(self._store_dir, self.model.model_digest(), self.model.model.config)
+            if self.cache is not None:
+                self.cache.store = self.store
+
+    def _close_model(self):
+        if self.store is not None:
+            self.store.flush()
+        if self.sess is not None:
+            self.sess.close()
+        if self._reader is not None:
+            self._reader.close()
+
+    def __getstate__(self):
+        # what a worker process gets to set up the same aggregator (see map_packages): its options,
+        # but not the model, which it loads itself, nor the latent specifications, which come with
+        # the packages to score
+        state = dict(self.__dict__)
+        for key in ['sess', 'model', 'store']:
+            state.pop(key, None)
+        state['_specs'] = {}
+        state['_reader'] = None
+        if self.cache is not None:
+            state['cache'] = DecoderCache(self.cache.max_bytes)
+        return state
+
+    def map_packages(self, method, packages=None):
+        """
+        Apply a method of the aggregator to each package. The latent specifications of the packages
+        are prefetched a chunk of packages at a time (see prefetch_latent_specifications). With more
+        than one worker, the packages are scored in a pool of worker processes that each load their
+        own copy of the model. The workers are sent the index of each package in the data file, and
+        read and compile it themselves (see _read_package), with its prefetched latent
+        specifications, so that the results do not depend on the number of workers.
+        :param method: the name of the method, which takes a package
+        :param packages: the packages, all packages in the dataset if not given
+        :return: an iterator over (package, result of the method for the package), in order
+        """
+        packages = iter(self.packages() if packages is None else packages)
+        chunks = iter(lambda: list(itertools.islice(packages, self.chunk_size)), [])
+        if self.workers <= 1:
+            for chunk in chunks:
+                self.prefetch_latent_specifications(chunk)
+                for package in chunk:
+                    yield package, getattr(self, method)(package)
+            return
+        # build the index of the data file once, before the workers read their packages with it
+        PackageIndex(self._data_file).close()
+        # TF is not fork-safe, so workers are started fresh
+        context = multiprocessing.get_context('spawn')
+        threads = max(1, multiprocessing.cpu_count() // self.workers)
+        pool = context.Pool(self.workers, initializer=_init_worker, initargs=(self, threads))
+        try:
+            for chunk in chunks:
+                self.prefetch_latent_specifications(chunk)
+                tasks = [(method, package.index, self._package_specs(package)) for package in chunk]
+                for package, result in zip(chunk, pool.imap(_call_worker, tasks)):
+                    yield package, result
+            pool.close()
+        except BaseException:
+            pool.terminate()
+            raise
+        finally:
+            pool.join()
+
+    def _read_package(self, k):
+        # the package with index k in the data file, read and compiled on its own, with the
+        # columns of a columnar dataset memory-mapped, or from the byte range of a JSON data file
+        # in its index (see PackageIndex)
+        if self._reader is None:
+            self._reader = PackageIndex(self._data_file)
+        config = self.model.model.config
+        if self._reader.columns is not None:
+            data = CompiledDataset.from_columns(self._reader.columns, self._data_vocab(), config.decoder.chars,
+                                                config.evidence, k, k + 1)
+        else:
+            data = CompiledDataset(self._reader.packages([k]), self._data_vocab(), config.decoder.chars,
+                                   config.evidence, k)
+        return data.packages[0]
+
+    def _package_specs(self, package):
+        # the prefetched latent specifications that a worker needs to score a package, by the
+        # attribute that has them
+        key = self.model.psi_key(package)
+        return {'_specs': {key: self._specs[key]}}
 
     # Methods to query the model
 
     def get_latent_specification(self, evidences):
         """
-        Return the latent specification for a given set of evidences
+        Return the latent specification for a given set of evidences. Evidences that the model
+        cannot tell apart (e.g., packages with the same "apicalls") get the same specification,
+        so that decoder steps cached for one package are reused for the others.
         :param evidences: the evidences as a dictionary (internally, Salento will look for the key "apicalls")
         :return: the latent specification tensor
         """
-        spec = self.model.psi_from_evidence(evidences)
-        return spec
-
-    def distribution_next_call(self, spec, sequence, call=None, cache=None):
+        key = self.model.psi_key(evidences)
+        if key not in self._specs:
+            self._specs[key] = self._stored_specification(key)
+        if self._specs[key] is None:
+            self._specs[key] = self.model.psi_from_evidence(evidences)
+            if self.store is not None:
+                self.store.put_psi(key, self._specs[key])
+        return self._specs[key]
+
+    def _stored_specification(self, key):
+        return self.store.get_psi(key, self.model.psi_samples) if self.store is not None else None
+
+    def prefetch_latent_specifications(self, packages=None):
+        """
+        Compute the latent specifications of many packages up front, encoding them in batches
+        instead of one at a time. get_latent_specification then returns the prefetched ones.
+        :param packages: the packages (with evidences), all packages in the dataset if not given
+        """
+        packages = self.packages() if packages is None else packages
+        missing = OrderedDict()
+        for package in packages:
+            key = self.model.psi_key(package)
+            if key not in self._specs:
+                self._specs[key] = self._stored_specification(key)
+            if self._specs[key] is None and key not in missing:
+                missing[key] = package
+        psi = self.model.psi_from_evidences(list(missing.values()))
+        for i, key in enumerate(missing):
+            self._specs[key] = psi[i]
+            if self.store is not None:
+                self.store.put_psi(key, self._specs[key])
+
+    def distribution_next_call(self, spec, sequence, call=None, cache=None, log=False):
         """
         Get a distribution over the next call in a sequence
         :param spec: the latent spec, get it from get_latent_specification
         :param sequence: the sequence
         :param call: if given, return the probability of this call instead of the whole distribution
+                     (only this probability is computed)
+        :param log: if True, return log-probabilities
         :return: distribution over the next call, or if call is given, probability of the call
         """
-        dist = self.model.infer_step(spec, sequence, step='call', cache=cache)
-        return dist if call is None else dist[call]
+        return self.model.infer_step(spec, sequence, step='call', cache=cache, log=log, target=call)
 
-    def distribution_call_iter(self, spec, sequence, cache=None):
+    def distribution_call_iter(self, spec, sequence, cache=None, log=False):
         """
         Get a distribution over the a sequence of calls
         :param spec: the latent spec, get it from get_latent_specification
         :param sequence: the sequence
-        :param call: if given, return the probability of this call instead of the whole distribution
+        :param log: if True, yield log-distributions
         :return: an iterator that yields at each point the distribution of the next calls
         """
-        return self.model.infer_step_iter(spec, sequence, step='call', cache=cache)
+        return self.model.infer_step_iter(spec, sequence, step='call', cache=cache, log=log)
 
-    def distribution_state_iter(self, spec, sequence, cache=None):
+    def distribution_state_iter(self, spec, sequence, cache=None, log=False):
         """
         Get a distribution over the a sequence of calls plus the state of each call
         :param spec: the latent spec, get it from get_latent_specification
         :param sequence: the sequence
-        :param call: if given, return the probability of this call instead of the whole distribution
+        :param log: if True, yield log-distributions and log-probabilities of the states
         :return: an iterator that yields at each point the distribution of the next calls
         """
-        return self.model.infer_step_iter(spec, sequence, step='state', cache=cache)
+        return self.model.infer_step_iter(spec, sequence, step='state', cache=cache, log=log)
 
-    def distribution_next_state(self, spec, sequence, state=None, cache=None):
+    def sequence_log_likelihoods(self, spec, sequences, step='call', cache=None, batch_size=None):
+        """
+        Get the log-likelihood of many sequences at once, decoding each prefix they share only once
+        :param spec: the latent spec, get it from get_latent_specification
+        :param sequences: the list of sequences
+        :param step: 'call' to score the calls of each sequence, 'state' to score its calls and their states
+        :param batch_size: the number of prefixes to decode at a time, or None for no limit
+        :return: array with the log-likelihood of each sequence
+        """
+        return self.model.sequence_log_likelihoods(spec, sequences, step=step, cache=cache, batch_size=batch_size)
+
+    def distribution_next_state(self, spec, sequence, state=None, cache=None, log=False):
         """
         Get a distribution over the next state of the last call in a sequence
         :param spec: the latent spec, get it from get_latent_specification
         :param sequence: the sequence
         :param state: (0 or 1) if given, return the probability of this state instead of the whole distribution
+                      (only this probability is computed)
+        :param log: if True, return log-probabilities
         :return: distribution over the next state, or if state is given, probability of the state
         :raise ValueError: if sequence was empty
         """
         if len(sequence) == 0:
             raise ValueError('Sequence cannot be empty when querying next state')
-        dist = self.model.infer_step(spec, sequence, step='state', cache=cache)
-        if state is None:
-            return dist
-        idx = len(sequence[-1]['states'])  # get how many states are in last call
-        state = '{}#{}'.format(idx, state) if not state == self.END_MARKER else state
-        return dist[state]
+        if state is not None:
+            idx = len(sequence[-1]['states'])  # get how many states are in last call
+            state = '{}#{}'.format(idx, state) if not state == self.END_MARKER else state
+        return self.model.infer_step(spec, sequence, step='state', cache=cache, log=log, target=state)
 
     def sample_from_dist(self, dist):
         """
@@ -164,38 +340,50 @@ class Aggregator(object):
         """
         Get the list of all unique locations in a given package
         """
-        locations = [self.location(event) for sequence in self.sequences(package) for event in self.events(sequence)]
-        return list(set(locations))
+        return package.data.package_locations(package)
 
     def packages(self):
         """
-        Get a list of packages in the dataset
+        Get the packages in the dataset, as an iterator that reads and compiles them a chunk at a
+        time (see compile_packages), so that the dataset is never in memory as a whole
         """
-        return self.dataset['packages']
+        config = self.model.model.config
+        for data in compile_packages(self._data_file, self._data_vocab(), config.decoder.chars, config.evidence,
+                                     self.chunk_size):
+            for package in data.packages:
+                yield package
 
     def sequences(self, package):
         """
         Get the list of sequences in the given package
         """
-        return package['data']
-
-    def _well_formed(self, event, check_states=True):
-        vocabs = self.model.model.config.decoder.vocab
-        if self.call(event) not in vocabs:
-            return False
-        if check_states:
-            for e in event_states(event):
-                if e not in vocabs:
-                    return False
-        return True
+        return [Sequence(package.data, s) for s in package.data.sequences(package)]
 
-    def events(self, sequence, check_states=True):
+    def events(self, sequence):
         """
         Get the list of events in the given sequence. Filters out
-        any call that is unknown
-        :param check_states: if True then filters out unknown states as well
+        any event whose call or states are unknown (the data is
+        compiled with the events that have known calls and states only)
+        """
+        return sequence.data.events(sequence.number)
+
+    def sequences_ending_at(self, sequences):
+        """
+        Group the (non-empty) sequences of a package by the location of their last event
+        :return: list of (location, list of sequences), sorted by location
+        """
+        if len(sequences) == 0:
+            return []
+        data = sequences[0].data
+        return [(location, [Sequence(data, s) for s in group])
+                for location, group in data.sequences_ending_at([sequence.number for sequence in sequences])]
+
+    def sequence_keys(self, sequences):
+        """
+        Get the keys of the sequences of a package, equal for sequences that are equal in the data
+        :return: array with the key of each sequence
         """
-        return [x for x in sequence['sequence'] if self._well_formed(x)]
+        return np.array([sequence.data.sequence_keys[sequence.number] for sequence in sequences], dtype=np.int64)
 
     def call(self, event):
         """
@@ -235,3 +423,21 @@ class Aggregator(object):
         raise NotImplementedError('run() has not been implemented.')
 
 
+# the aggregator of a worker process of map_packages
+_worker = None
+
+
+def _init_worker(aggregator, threads):
+    global _worker
+    _worker = aggregator
+    _worker._load_model(threads)
+    # save the worker's store when the pool closes
+    Finalize(_worker, _worker._close_model, exitpriority=10)
+
+
+def _call_worker(args):
+    method, k, specs = args
+    # the worker keeps the latent specifications of the package it scores only
+    for name, package_specs in specs.items():
+        setattr(_worker, name, package_specs)
+    return getattr(_worker, method)(_worker._read_package(k))
@@ -0,0 +1,265 @@
+# Copyright 2017 Rice University
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import itertools
+import numpy as np
+
+from salento.models.low_level_evidences.data_reader import event_states, read_packages
+from salento.models.low_level_evidences.columnar import is_columnar, ColumnarDataset
+
+
+def _sequence_key(obj):
+    # a hashable key of a sequence (nested dicts and lists), equal for equal sequences
+    if isinstance(obj, dict):
+        return tuple(sorted((k, _sequence_key(v)) for k, v in obj.items()))
+    if isinstance(obj, list):
+        return tuple(_sequence_key(v) for v in obj)
+    return obj
+
+
+class Package(dict):
+    """
+    A package of a compiled dataset: its name and evidences (all its fields but the data), its
+    index in the data file, and the compiled dataset that has its sequences
+    """
+    def __init__(self, index, fields, data=None):
+        dict.__init__(self, fields)
+        self.index = index
+        self.data = data
+
+
+def compile_packages(filename, vocab, chars, evidence, chunk_size=256):
+    """
+    Compile the packages of a data file a chunk at a time, reading them from the file (see
+    read_packages) or from the columns of a columnar dataset as the chunks are consumed, so that
+    only the chunks in use are in memory
+    :param filename: the data file, possibly compressed (see smart_open), or a columnar dataset
+    :param vocab: the decoder vocab, from names to ids
+    :param chars: the decoder vocab, from ids to names
+    :param evidence: the evidences of the model
+    :param chunk_size: the number of packages to compile together
+    :return: an iterator over the compiled datasets of the chunks, in order
+    """
+    if is_columnar(filename):
+        columns = ColumnarDataset(filename)
+        for start in range(0, len(columns), chunk_size):
+            yield CompiledDataset.from_columns(columns, vocab, chars, evidence, start,
+                                               min(start + chunk_size, len(columns)))
+        return
+    packages = read_packages(filename)
+    for first in itertools.count(0, chunk_size):
+        chunk = list(itertools.islice(packages, chunk_size))
+        if len(chunk) == 0:
+            return
+        yield CompiledDataset(chunk, vocab, chars, evidence, first)
+
+
+class CompiledDataset(object):
+    """
+    A dataset (or a chunk of consecutive packages of one, see compile_packages) compiled into flat
+    arrays, with only the events that the model knows (its call and the keys of its states are in
+    the vocab). Sequences are numbered across the compiled packages:
+        - the package with index first + k has the sequences sequence_offsets[k] to sequence_offsets[k+1]
+        - sequence s has the events event_offsets[s] to event_offsets[s+1]
+        - event e has the call calls[e] (a vocab id), the location locations[e] (an id into
+          location_names) and the states with the vocab ids states[state_offsets[e]:state_offsets[e+1]],
+          whose values in the data are state_values[state_offsets[e]:state_offsets[e+1]] (ids into
+          state_value_names)
+        - sequence s has the key sequence_keys[s], equal for sequences that are equal in the data
+    Locations are ranked by name in location_ranks.
+    """
+    def __init__(self, packages, vocab, chars, evidence, first=0):
+        """
+        :param packages: the packages of the JSON dataset, an iterable that is consumed once
+        :param vocab: the decoder vocab, from names to ids
+        :param chars: the decoder vocab, from ids to names
+        :param evidence: the evidences of the model
+        :param first: the index of the first package in the data file
+        """
+        self.chars = chars
+        self.first = first
+        self.location_names = []
+        self.state_value_names = []
+        self.packages = []
+        location_ids, key_ids, value_ids = {}, {}, {}
+        calls, locations, states, values, keys = [], [], [], [], []
+        state_offsets, event_offsets, sequence_offsets = [0], [0], [0]
+        for k, package in enumerate(packages):
+            # read the evidences first, since some (e.g., apicalls) may be extracted from the data
+            for ev in evidence:
+                ev.read_data_point(package)
+            self.packages.append(Package(first + k, {key: value for key, value in package.items() if key != 'data'},
+                                         self))
+
+            for sequence in package['data']:
+                keys.append(key_ids.setdefault(_sequence_key(sequence), len(key_ids)))
+                for event in sequence['sequence']:
+                    call = vocab.get(event['call'])
+                    state_ids = [vocab.get(key) for key in event_states(event)]
+                    if call is None or None in state_ids:
+                        continue
+                    location = event.get('location')
+                    if location not in location_ids:
+                        location_ids[location] = len(self.location_names)
+                        self.location_names.append(location)
+                    calls.append(call)
+                    locations.append(location_ids[location])
+                    states.extend(state_ids)
+                    for value in event['states']:
+                        # by type as well, so that e.g. 1 and True are told apart
+                        if (type(value), value) not in value_ids:
+                            value_ids[(type(value), value)] = len(self.state_value_names)
+                            self.state_value_names.append(value)
+                        values.append(value_ids[(type(value), value)])
+                    state_offsets.append(len(states))
+                event_offsets.append(len(calls))
+            sequence_offsets.append(len(event_offsets) - 1)
+
+        self.calls = np.array(calls, dtype=np.int32)
+        self.locations = np.array(locations, dtype=np.int32)
+        self.states = np.array(states, dtype=np.int32)
+        self.state_values = np.array(values, dtype=np.int32)
+        self.sequence_keys = np.array(keys, dtype=np.int64)
+        self.state_offsets = np.array(state_offsets, dtype=np.int64)
+        self.event_offsets = np.array(event_offsets, dtype=np.int64)
+        self.sequence_offsets = np.array(sequence_offsets, dtype=np.int64)
+        self._rank_locations()
+
+    @classmethod
+    def from_columns(cls, columns, vocab, chars, evidence, start=0, end=None):
+        """
+        Compile a columnar dataset, with array operations over its columns instead of a pass over
+        its packages
+        :param columns: the ColumnarDataset
+        :param vocab: the decoder vocab, from names to ids
+        :param chars: the decoder vocab, from ids to names
+        :param evidence: the evidences of the model
+        :param start: the index of the first package to compile
+        :param end: the index after the last package to compile, the number of packages if not given
+        """
+        self = cls.__new__(cls)
+        self.chars = chars
+        self.first = start
+        self.location_names = list(columns.location_names)
+        self.packages = []
+        end = len(columns) if end is None else end
+        for k in range(start, end):
+            package = dict(columns.package_fields[k])
+            try:
+                for ev in evidence:
+                    ev.read_data_point(package)
+            except KeyError:
+                # some evidences are not in the fields, but extracted from the data
+                package = columns.package(k)
+                for ev in evidence:
+                    ev.read_data_point(package)
+                del package['data']
+            self.packages.append(Package(k, package, self))
+
+        # the columns of the compiled packages, with their offsets from their first sequence, event and state
+        package_offsets = np.array(columns.package_offsets[start:end + 1], dtype=np.int64)
+        sequence_offsets = np.array(columns.sequence_offsets[package_offsets[0]:package_offsets[-1] + 1],
+                                    dtype=np.int64)
+        state_offsets = np.array(columns.state_offsets[sequence_offsets[0]:sequence_offsets[-1] + 1],
+                                 dtype=np.int64)
+        column_calls = np.asarray(columns.calls[sequence_offsets[0]:sequence_offsets[-1]])
+        column_locations = np.asarray(columns.locations[sequence_offsets[0]:sequence_offsets[-1]])
+        column_states = np.asarray(columns.states[state_offsets[0]:state_offsets[-1]])
+        package_offsets -= package_offsets[0]
+        sequence_offsets -= sequence_offsets[0]
+        state_offsets -= state_offsets[0]
+
+        # the vocab ids of the calls, and of the state keys by position in their event and value
+        call_ids = np.array([vocab.get(call, -1) for call in columns.call_names], dtype=np.int64)
+        calls = call_ids[column_calls] if len(call_ids) > 0 else np.zeros(0, dtype=np.int64)
+        state_counts = np.diff(state_offsets)
+        positions = np.arange(len(column_states)) - np.repeat(state_offsets[:-1], state_counts)
+        keys, inverse = np.unique(np.stack([positions, column_states], axis=1), axis=0, return_inverse=True)
+        key_ids = np.array([vocab.get('{}#{}'.format(i, value), -1) for i, value in keys], dtype=np.int64)
+        states = key_ids[inverse.reshape(-1)]
+
+        # keep the events whose call and states are all in the vocab
+        unknown = np.concatenate([[0], np.cumsum(states < 0)])
+        keep = (calls >= 0) & (unknown[state_offsets[1:]] == unknown[state_offsets[:-1]])
+        kept = np.concatenate([[0], np.cumsum(keep)])
+        self.calls = calls[keep].astype(np.int32)
+        self.locations = column_locations[keep].astype(np.int32)
+        self.states = states[np.repeat(keep, state_counts)].astype(np.int32)
+        names, values = np.unique(column_states[np.repeat(keep, state_counts)], return_inverse=True)
+        self.state_value_names = names.tolist()
+        self.state_values = values.reshape(-1).astype(np.int32)
+        self.state_offsets = np.concatenate([[0], np.cumsum(state_counts[keep])]).astype(np.int64)
+        self.event_offsets = kept[sequence_offsets].astype(np.int64)
+        self.sequence_offsets = package_offsets
+
+        # sequences are equal if all the columns of their events are
+        key_ids = {}
+        self.sequence_keys = np.zeros(len(sequence_offsets) - 1, dtype=np.int64)
+        for s in range(len(sequence_offsets) - 1):
+            first, last = sequence_offsets[s], sequence_offsets[s + 1]
+            key = (column_calls[first:last].tobytes(), column_locations[first:last].tobytes(),
+                   np.diff(state_offsets[first:last + 1]).tobytes(),
+                   column_states[state_offsets[first]:state_offsets[last]].tobytes())
+            self.sequence_keys[s] = key_ids.setdefault(key, len(key_ids))
+        self._rank_locations()
+        return self
+
+    def _rank_locations(self):
+        # the position of each location in the sorted location names
+        self.location_ranks = np.zeros(len(self.location_names), dtype=np.int64)
+        self.location_ranks[sorted(range(len(self.location_names)), key=lambda i: self.location_names[i])] = \
+            np.arange(len(self.location_names))
+
+    def sequences(self, package):
+        k = package.index - self.first
+        return range(self.sequence_offsets[k], self.sequence_offsets[k + 1])
+
+    def events(self, sequence):
+        """
+        The events of a sequence as dictionaries, as expected by the model
+        """
+        events = []
+        for e in range(self.event_offsets[sequence], self.event_offsets[sequence + 1]):
+            values = self.state_values[self.state_offsets[e]:self.state_offsets[e + 1]]
+            events.append({'call': self.chars[self.calls[e]],
+                           'states': [self.state_value_names[i] for i in values],
+                           'location': self.location_names[self.locations[e]]})
+        return events
+
+    def package_locations(self, package):
+        k = package.index - self.first
+        start = self.event_offsets[self.sequence_offsets[k]]
+        end = self.event_offsets[self.sequence_offsets[k + 1]]
+        return [self.location_names[i] for i in np.unique(self.locations[start:end])]
+
+    def last_locations(self, sequences):
+        """
+        :return: the location ids of the last events of the given sequences, which must not be empty
+        """
+        return self.locations[self.event_offsets[np.asarray(sequences, dtype=np.int64) + 1] - 1]
+
+    def sequences_ending_at(self, sequences):
+        """
+        Group the non-empty sequences by the location of their last event
+        :return: list of (location, list of sequences), sorted by location
+        """
+        sequences = np.asarray(sequences, dtype=np.int64)
+        sequences = sequences[self.event_offsets[sequences + 1] > self.event_offsets[sequences]]
+        locations = self.last_locations(sequences)
+        order = np.argsort(self.location_ranks[locations], kind='mergesort')
+        sequences, locations = sequences[order], locations[order]
+        bounds = np.flatnonzero(np.diff(locations)) + 1
+        return [(self.location_names[group_locations[0]], [int(s) for s in group])
+                for group, group_locations in zip(np.split(sequences, bounds), np.split(locations, bounds))
+                if len(group) > 0]
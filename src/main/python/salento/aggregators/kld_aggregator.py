@@ -16,8 +16,9 @@ from __future__ import print_function
 import math
 import argparse
 from salento.aggregators.base import Aggregator
-import itertools
-from operator import itemgetter
+from salento.models.low_level_evidences.infer import BACKENDS
+from salento.models.low_level_evidences.cache import DecoderCache
+import numpy as np
 
 class KLDAggregator(Aggregator):
 
@@ -31,55 +32,61 @@ class KLDAggregator(Aggregator):
         6. Repeat 1-5 for each location in the package.
     """
 
-    def __init__(self, data_file, model_dir):
-        Aggregator.__init__(self, data_file, model_dir)
-        self.cache = {}
+    def __init__(self, data_file, model_dir, backend='tensorflow', store=None, psi_mean=False, psi_samples=1,
+                 workers=1, cache_size=1024, batch_size=256):
+        Aggregator.__init__(self, data_file, model_dir, backend=backend, store=store, psi_mean=psi_mean,
+                            psi_samples=psi_samples, workers=workers)
+        self.cache = DecoderCache(cache_size * 2**20)
+        self.batch_size = batch_size
 
     def log_likelihood(self, spec, sequence):
-        llh = 0.
-        events = self.events(sequence)
-        calls = list(s['call'] for s in events)
-        calls.append(self.END_MARKER)
-        
-        for (row, next_call) in zip(self.distribution_state_iter(spec, events, cache=self.cache), calls):
-            llh += math.log(row.distribution[next_call])
-            for prob in row.states:
-                llh += math.log(prob)
+        return self.log_likelihoods(spec, [sequence])[0]
 
-            if next_call != self.END_MARKER:
-                dist = row.next_state()
-                llh += math.log(dist[self.END_MARKER])
-
-        return llh
+    def log_likelihoods(self, spec, sequences):
+        """
+        Log-likelihood of many sequences (same as log_likelihood), scored together over the
+        prefix trie of their decoder paths
+        """
+        return list(self.sequence_log_likelihoods(spec, [self.events(sequence) for sequence in sequences],
+                                                  step='state', cache=self.cache, batch_size=self.batch_size))
 
     def compute_kld(self, spec, sequences):
-        counted = []
+        return self._kld(sequences, self._distinct_log_likelihoods(spec, sequences))
+
+    def _distinct_log_likelihoods(self, spec, sequences):
+        # score the distinct sequences once, by their keys
+        keys = self.sequence_keys(sequences)
+        first = np.sort(np.unique(keys, return_index=True)[1])
+        return dict(zip(keys[first], self.log_likelihoods(spec, [sequences[i] for i in first])))
+
+    def _kld(self, sequences, log_qs):
+        # count the distinct sequences by their keys
+        keys = self.sequence_keys(sequences)
+        _, first, counts = np.unique(keys, return_index=True, return_counts=True)
         kld = 0.
-        for sequence in sequences:
-            if sequence in counted:
-                continue
-            counted.append(sequence)
-            p = sequences.count(sequence) / len(sequences)
+        for i in np.argsort(first):
+            p = counts[i] / len(sequences)
             log_p = math.log(p)
-            log_q = self.log_likelihood(spec, sequence)
-            kld += p * (log_p - log_q)
+            kld += p * (log_p - log_qs[keys[first[i]]])
         return kld
 
-    def sequences_ending_at(self, sequences):
-        elems_by_loc = ((self.location(self.events(seq)[-1]), seq)
-            for seq in sequences if len(self.events(seq)) > 0)
-        elems = itertools.groupby(sorted(elems_by_loc, key=itemgetter(0)), itemgetter(0))
-        for location, row in elems:
-            yield location, map(itemgetter(1), row)
+    def score_package(self, package):
+        """
+        :return: list of (location, KLD score) of the locations of the package
+        """
+        spec = self.get_latent_specification(package)
+        located = self.sequences_ending_at(self.sequences(package))
+        # the sequences of all locations are scored together, so that they share their prefixes
+        log_qs = self._distinct_log_likelihoods(spec, [s for _, seqs_l in located for s in seqs_l])
+        return [(location, self._kld(seqs_l, log_qs)) for location, seqs_l in located]
 
     def run(self):
-        for package in self.packages():
+        for package, scores in self.map_packages('score_package'):
             print('Package: {}'.format(package["name"]))
-            spec = self.get_latent_specification(package)
-            sequences = self.sequences(package)
-            for location, seqs_l in self.sequences_ending_at(sequences):
-                kld_score = self.compute_kld(spec, list(seqs_l))
+            for location, kld_score in scores:
                 print('{:50s} : {:.4f}'.format(location, kld_score), flush=True)
+        if self.workers <= 1:
+            self.log('Decoder cache: {}'.format(self.cache))
 
 
 if __name__ == '__main__':
@@ -88,7 +95,23 @@ if __name__ == '__main__':
                         help='input data file')
     parser.add_argument('--model_dir', type=str, required=True,
                         help='directory to load model from')
+    parser.add_argument('--backend', type=str, default='tensorflow', choices=BACKENDS,
+                        help='run the model with tensorflow, or with numpy on weights exported by export.py')
+    parser.add_argument('--cache_size', type=int, default=1024,
+                        help='memory (in MB) for caching decoder steps')
+    parser.add_argument('--store', type=str, default=None,
+                        help='directory of persistent stores to reuse the results of earlier runs from')
+    parser.add_argument('--psi_mean', action='store_true',
+                        help='use the mean latent specification of each package instead of a sample')
+    parser.add_argument('--psi_samples', type=int, default=1,
+                        help='number of latent specifications to sample for each package and average over')
+    parser.add_argument('--workers', type=int, default=1,
+                        help='number of processes to score packages in, each with its own copy of the model')
+    parser.add_argument('--batch_size', type=int, default=256,
+                        help='number of prefixes to decode together')
     clargs = parser.parse_args()
 
-    with KLDAggregator(clargs.data_file, clargs.model_dir) as aggregator:
+    with KLDAggregator(clargs.data_file, clargs.model_dir, backend=clargs.backend, store=clargs.store,
+                       psi_mean=clargs.psi_mean, psi_samples=clargs.psi_samples, workers=clargs.workers,
+                       cache_size=clargs.cache_size, batch_size=clargs.batch_size) as aggregator:
         aggregator.run()
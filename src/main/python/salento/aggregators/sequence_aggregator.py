@@ -13,12 +13,10 @@
 # limitations under the License.
 
 from __future__ import print_function
-import math
 import argparse
 from salento.aggregators.base import Aggregator
-import numpy as np
-import itertools
-from operator import itemgetter
+from salento.models.low_level_evidences.infer import BACKENDS
+from salento.models.low_level_evidences.cache import DecoderCache
 
 class SimpleSequenceAggregator(Aggregator):
 
@@ -26,40 +24,46 @@ class SimpleSequenceAggregator(Aggregator):
     The simple sequence aggregator computes, for each sequence, the negative
     log-likelihood of the sequence using only its calls (not states).
     """
-    def __init__(self, data_file, model_dir):
-        Aggregator.__init__(self, data_file, model_dir)
-        self.cache = {}
+    def __init__(self, data_file, model_dir, backend='tensorflow', store=None, psi_mean=False, psi_samples=1,
+                 workers=1, cache_size=1024, batch_size=256):
+        Aggregator.__init__(self, data_file, model_dir, backend=backend, store=store, psi_mean=psi_mean,
+                            psi_samples=psi_samples, workers=workers)
+        self.cache = DecoderCache(cache_size * 2**20)
+        self.batch_size = batch_size
 
-    def call_dist(self, spec, events):
-        for (i, row) in enumerate(self.distribution_call_iter(spec, events, cache=self.cache)):
-            if i == len(events):
-                next_call = self.END_MARKER
-            else:
-                next_call = events[i]['call']
-            yield row.distribution.get(next_call, 0.0)
+    def sequence_likelihoods(self, spec, events_list):
+        """
+        Negative log-likelihood of many sequences, scored together over the prefix trie of their
+        decoder paths
+        :param events_list: the list of events of each sequence
+        :return: array with the negative log-likelihood of each sequence
+        """
+        return -self.sequence_log_likelihoods(spec, events_list, cache=self.cache, batch_size=self.batch_size)
 
-    def sequence_likelihood(self, spec, events):
-        row = np.fromiter(self.call_dist(spec, events), dtype=np.float64)
-        # Apply log to each element
-        np.log(row, out=row)
-        # Summate all elements
-        return -np.sum(row)
-
-    def sequences_ending_at(self, sequences):
-        elems_by_loc = ((self.location(self.events(seq)[-1]), seq)
-            for seq in sequences if len(self.events(seq)) > 0)
-        elems = itertools.groupby(sorted(elems_by_loc, key=itemgetter(0)), itemgetter(0))
-        for location, row in elems:
-            yield location, map(itemgetter(1), row)
+    def score_package(self, package):
+        """
+        :return: list of (location, score) of the locations of the package
+        """
+        spec = self.get_latent_specification(package)
+        sequences = self.sequences(package)
+        # score all sequences of the package together, then split the scores by location
+        located = [(location, [self.events(seq) for seq in seqs_l])
+                   for location, seqs_l in self.sequences_ending_at(sequences)]
+        scores = self.sequence_likelihoods(spec, [events for _, batch in located for events in batch])
+        result = []
+        offset = 0
+        for location, batch in located:
+            result.append((location, max(scores[offset:offset + len(batch)])))
+            offset += len(batch)
+        return result
 
     def run(self):
-        for package in self.packages():
+        for package, scores in self.map_packages('score_package'):
             print('Package: {}'.format(package['name']))
-            spec = self.get_latent_specification(package)
-            sequences = self.sequences(package)
-            for location, seqs_l in self.sequences_ending_at(sequences):
-                score = max(self.sequence_likelihood(spec, self.events(seq)) for seq in seqs_l)
+            for location, score in scores:
                 print('{:50s} : {:.4f}'.format(location, score), flush=True)
+        if self.workers <= 1:
+            self.log('Decoder cache: {}'.format(self.cache))
 
 
 if __name__ == '__main__':
@@ -68,7 +72,23 @@ if __name__ == '__main__':
                         help='input data file')
     parser.add_argument('--model_dir', type=str, required=True,
                         help='directory to load model from')
+    parser.add_argument('--batch_size', type=int, default=256,
+                        help='number of prefixes to decode together')
+    parser.add_argument('--backend', type=str, default='tensorflow', choices=BACKENDS,
+                        help='run the model with tensorflow, or with numpy on weights exported by export.py')
+    parser.add_argument('--cache_size', type=int, default=1024,
+                        help='memory (in MB) for caching decoder steps')
+    parser.add_argument('--store', type=str, default=None,
+                        help='directory of persistent stores to reuse the results of earlier runs from')
+    parser.add_argument('--psi_mean', action='store_true',
+                        help='use the mean latent specification of each package instead of a sample')
+    parser.add_argument('--psi_samples', type=int, default=1,
+                        help='number of latent specifications to sample for each package and average over')
+    parser.add_argument('--workers', type=int, default=1,
+                        help='number of processes to score packages in, each with its own copy of the model')
     clargs = parser.parse_args()
 
-    with SimpleSequenceAggregator(clargs.data_file, clargs.model_dir) as aggregator:
+    with SimpleSequenceAggregator(clargs.data_file, clargs.model_dir, backend=clargs.backend, store=clargs.store,
+                                  psi_mean=clargs.psi_mean, psi_samples=clargs.psi_samples, workers=clargs.workers,
+                                  cache_size=clargs.cache_size, batch_size=clargs.batch_size) as aggregator:
         aggregator.run()
@@ -15,19 +15,23 @@
 import tensorflow as tf
 from itertools import chain
 
+from salento.models.low_level_evidences.utils import batch_size
+
 
 class BayesianEncoder(object):
-    def __init__(self, config):
+    def __init__(self, config, inputs=None):
 
-        self.inputs = [ev.placeholder(config) for ev in config.evidence]
+        # read the evidences from the given tensors (e.g., of an input pipeline) or placeholders
+        self.inputs = list(inputs) if inputs is not None else [ev.placeholder(config) for ev in config.evidence]
         exists = [ev.exists(i) for ev, i in zip(config.evidence, self.inputs)]
-        zeros = tf.zeros([config.batch_size, config.latent_size], dtype=tf.float32)
+        batch = batch_size(config, self.inputs[0])
+        zeros = tf.zeros([batch, config.latent_size], dtype=tf.float32)
 
         # Compute the denominator used for mean and covariance
         for ev in config.evidence:
             ev.init_sigma(config)
-        d = [tf.where(exist, tf.tile([1. / tf.square(ev.sigma)], [config.batch_size]),
-                      tf.zeros(config.batch_size)) for ev, exist in zip(config.evidence, exists)]
+        d = [tf.where(exist, tf.tile([1. / tf.square(ev.sigma)], [batch]),
+                      tf.zeros([batch])) for ev, exist in zip(config.evidence, exists)]
         d = 1. + tf.reduce_sum(tf.stack(d), axis=0)
         denom = tf.tile(tf.reshape(d, [-1, 1]), [1, config.latent_size])
 
@@ -50,12 +54,12 @@ class BayesianEncoder(object):
 
         # Compute the covariance of Psi
         with tf.variable_scope('covariance'):
-            I = tf.ones([config.batch_size, config.latent_size], dtype=tf.float32)
+            I = tf.ones([batch, config.latent_size], dtype=tf.float32)
             self.psi_covariance = I / denom
 
 
 class BayesianDecoder(object):
-    def __init__(self, config, initial_state, infer=False):
+    def __init__(self, config, initial_state, infer=False, nodes=None, edges=None):
 
         cells1, cells2 = [], []
         for _ in range(config.decoder.num_layers):
@@ -65,11 +69,25 @@ class BayesianDecoder(object):
         self.cell2 = tf.nn.rnn_cell.MultiRNNCell(cells2)
 
         # placeholders
-        self.initial_state = [initial_state] * config.decoder.num_layers
-        self.nodes = [tf.placeholder(tf.int32, [config.batch_size], name='node{0}'.format(i))
-                      for i in range(config.decoder.max_seq_length)]
-        self.edges = [tf.placeholder(tf.bool, [config.batch_size], name='edge{0}'.format(i))
-                      for i in range(config.decoder.max_seq_length)]
+        if infer:
+            # a placeholder per layer, so that each layer of a decoder state is fed on its own (by
+            # default, all the layers start from the given initial state)
+            self.initial_state = [tf.placeholder_with_default(initial_state, [config.batch_size, config.decoder.units],
+                                                              name='initial_state{0}'.format(i))
+                                  for i in range(config.decoder.num_layers)]
+            # a statically unrolled step at a time (max_seq_length is 1), fed by name
+            self.nodes = [tf.placeholder(tf.int32, [config.batch_size], name='node{0}'.format(i))
+                          for i in range(config.decoder.max_seq_length)]
+            self.edges = [tf.placeholder(tf.bool, [config.batch_size], name='edge{0}'.format(i))
+                          for i in range(config.decoder.max_seq_length)]
+        else:
+            self.initial_state = [initial_state] * config.decoder.num_layers
+            # whole [batch, time] paths, padded to the longest path of the batch only, from the
+            # tensors of an input pipeline or from placeholders
+            self.nodes = nodes if nodes is not None else tf.placeholder(tf.int32, [config.batch_size, None],
+                                                                        name='nodes')
+            self.edges = edges if edges is not None else tf.placeholder(tf.bool, [config.batch_size, None],
+                                                                        name='edges')
 
         # projection matrices for output
         self.projection_w = tf.get_variable('projection_w', [self.cell1.output_size,
@@ -79,18 +97,29 @@ class BayesianDecoder(object):
         # setup embedding
         with tf.variable_scope('decoder'):
             emb = tf.get_variable('emb', [config.decoder.vocab_size, config.decoder.units])
+            self.emb = emb
+
+            if not infer:
+                # decode the paths in a graph loop, which creates the variables of the cells in the
+                # same scopes as the unrolled decoder, so that the graph does not grow with the
+                # length of the paths
+                with tf.variable_scope('rnn') as scope:
+                    self.scope = scope
+                    self.outputs, self.state = self._dynamic_outputs(self.nodes, self.edges, reuse=None)
+                return
 
             def loop_fn(prev, _):
                 prev = tf.nn.xw_plus_b(prev, self.projection_w, self.projection_b)
                 prev_symbol = tf.argmax(prev, 1)
                 return tf.nn.embedding_lookup(emb, prev_symbol)
 
-            loop_function = loop_fn if infer else None
+            loop_function = loop_fn
             emb_inp = (tf.nn.embedding_lookup(emb, i) for i in self.nodes)
 
-            with tf.variable_scope('rnn'):
+            with tf.variable_scope('rnn') as scope:
+                self.scope = scope
                 self.state = self.initial_state
-                self.outputs = []
+                outputs = []
                 prev = None
                 for i, inp in enumerate(emb_inp):
                     if loop_function is not None and prev is not None:
@@ -98,13 +127,52 @@ class BayesianDecoder(object):
                             inp = loop_function(prev, i)
                     if i > 0:
                         tf.get_variable_scope().reuse_variables()
-                    with tf.variable_scope('cell1'):  # handles CHILD_EDGE
-                        output1, state1 = self.cell1(inp, self.state)
-                    with tf.variable_scope('cell2'):  # handles SIBLING_EDGE
-                        output2, state2 = self.cell2(inp, self.state)
-                    output = tf.where(self.edges[i], output1, output2)
-                    self.state = [tf.where(self.edges[i], state1[j], state2[j])
-                                  for j in range(config.decoder.num_layers)]
-                    self.outputs.append(output)
+                    output, self.state = self._step(inp, self.state, self.edges[i])
+                    outputs.append(output)
                     if loop_function is not None:
                         prev = output
+                # [batch, time, units], as for the decoder of whole paths
+                self.outputs = tf.stack(outputs, axis=1)
+
+    def _dynamic_outputs(self, nodes, edges, reuse):
+        inputs = tf.nn.embedding_lookup(self.emb, tf.transpose(nodes))
+        edges = tf.transpose(edges)
+        steps = tf.shape(nodes)[1]
+
+        def step(i, state, outputs):
+            with tf.variable_scope(self.scope, reuse=reuse):
+                output, state = self._step(inputs[i], state, edges[i])
+            return i + 1, tuple(state), outputs.write(i, output)
+
+        _, state, outputs = tf.while_loop(lambda i, state, outputs: i < steps, step,
+                                          [tf.constant(0), tuple(self.initial_state),
+                                           tf.TensorArray(tf.float32, size=steps)])
+        return tf.transpose(outputs.stack(), [1, 0, 2]), list(state)
+
+    def _step(self, inp, state, edges):
+        """
+        Advance the decoder by one step, running each row through the cell of its edge only: the
+        rows are partitioned by edge, each cell runs on its own rows and the results are stitched
+        back in the order of the rows
+        :param inp: float tensor [batch, units] of embedded nodes
+        :param state: the decoder state, a list of float tensors [batch, units], one per layer
+        :param edges: bool tensor [batch], True for CHILD_EDGE
+        :return: tuple of the output [batch, units] and the new state
+        """
+        partitions = tf.cast(edges, tf.int32)
+        rows = tf.dynamic_partition(tf.range(tf.shape(inp)[0]), partitions, 2)
+        sibling_inp, child_inp = tf.dynamic_partition(inp, partitions, 2)
+        layers = [tf.dynamic_partition(layer, partitions, 2) for layer in state]
+        with tf.variable_scope('cell1'):  # handles CHILD_EDGE
+            output1, state1 = self.cell1(child_inp, tuple(layer[1] for layer in layers))
+        with tf.variable_scope('cell2'):  # handles SIBLING_EDGE
+            output2, state2 = self.cell2(sibling_inp, tuple(layer[0] for layer in layers))
+
+        def stitch(child, sibling, like):
+            # keep the static shape of the rows, as the graph loop requires of its state
+            stitched = tf.dynamic_stitch([rows[1], rows[0]], [child, sibling])
+            stitched.set_shape(like.get_shape())
+            return stitched
+
+        output = stitch(output1, output2, inp)
+        return output, [stitch(s1, s2, layer) for s1, s2, layer in zip(state1, state2, state)]
@@ -0,0 +1,187 @@
+# Copyright 2017 Rice University
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import hashlib
+from collections import OrderedDict
+
+import numpy as np
+
+from salento.models.low_level_evidences.constants import CHILD_EDGE
+
+
+def token_id(vocab_id, edge):
+    """
+    Intern a (node, edge) decoder input as a single integer
+    """
+    return 2 * vocab_id + (1 if edge == CHILD_EDGE else 0)
+
+
+def fingerprint(*arrays):
+    """
+    A digest of the contents of the given arrays
+    """
+    digest = hashlib.sha1()
+    for array in arrays:
+        digest.update(np.ascontiguousarray(array).tobytes())
+    return digest.hexdigest()
+
+
+# approximate memory taken by each log-probability kept for a single target
+_GATHERED_BYTES = 64
+
+
+class _TrieNode(object):
+    __slots__ = ['parent', 'key', 'children', 'value', 'nbytes']
+
+    def __init__(self, parent, key):
+        self.parent = parent
+        self.key = key
+        self.children = {}
+        self.value = None
+        self.nbytes = 0
+
+
+class DecoderCache(object):
+    """
+    Cache of decoder steps, i.e., the (log-distribution, state) after each prefix of (node, edge)
+    inputs. Each latent specification has its own trie (see scope), since the same prefix
+    decodes differently under different specifications. Prefixes are keyed by token_id in
+    the tries, and the values are evicted in least-recently-used order once they take up
+    more than max_bytes. Trie nodes are kept while they lead to a cached value, so an evicted
+    prefix can be recomputed and its cached extensions are still found. If given a ModelStore,
+    the states of the steps are also kept in it, so that later runs can restore them.
+    """
+    def __init__(self, max_bytes=None, store=None):
+        """
+        :param max_bytes: memory budget for the cached arrays, or None for no limit
+        :param store: the ModelStore backing the cache, if any
+        """
+        self.max_bytes = max_bytes
+        self.store = store
+        self._roots = {}
+        self.nbytes = 0
+        self.hits = self.misses = self.evictions = 0
+        self._lru = OrderedDict()
+
+    def scope(self, psi):
+        """
+        Get the root of the trie of prefixes decoded from the latent specification psi
+        """
+        key = fingerprint(psi)
+        root = self._roots.get(key)
+        if root is None:
+            root = self._roots[key] = _TrieNode(None, key)
+        return root
+
+    def child(self, node, key):
+        """
+        Get the trie node for the prefix of node extended by the token key, creating it if needed
+        """
+        child = node.children.get(key)
+        if child is None:
+            child = node.children[key] = _TrieNode(node, key)
+        return child
+
+    def prefix(self, node):
+        """
+        The prefix of a trie node: the fingerprint of its latent specification and its token ids
+        """
+        keys = []
+        while node is not None:
+            keys.append(node.key)
+            node = node.parent
+        return tuple(reversed(keys))
+
+    def stored_state(self, node):
+        """
+        Get the decoder state of a trie node from the backing store
+        :return: the decoder state, or None if there is no store or it does not have the state
+        """
+        if self.store is None:
+            return None
+        return self.store.get_state(self.prefix(node))
+
+    def get(self, node, target=None):
+        """
+        Get the value cached at a trie node
+        :param target: if given, the vocab id of the node whose log-probability is wanted
+        :return: tuple of the log-distribution (or with target, its log-probability) and the
+                 decoder state, or None if it is not cached
+        """
+        if node.value is not None:
+            log_dist, state = node.value
+            if target is None and isinstance(log_dist, np.ndarray):
+                value = log_dist
+            elif target is not None:
+                value = log_dist.get(target) if isinstance(log_dist, dict) else log_dist[target]
+            else:
+                value = None
+            if value is not None:
+                self.hits += 1
+                self._lru.move_to_end(node)
+                return value, state
+        self.misses += 1
+        return None
+
+    def put(self, node, value, state, target=None):
+        """
+        Cache a decoder step at a trie node, evicting old values if over budget
+        :param value: the log-distribution after the step, or with target, its log-probability
+        :param state: the decoder state after the step
+        :param target: if given, the vocab id of the node the log-probability is of. Only these
+                       log-probabilities are kept for a step until its full log-distribution is put.
+        """
+        log_dist = None
+        if node.value is None and self.store is not None and not self.store.readonly:
+            self.store.put_state(self.prefix(node), state)
+        if node.value is not None:
+            log_dist = node.value[0]
+            self.nbytes -= node.nbytes
+            del self._lru[node]
+        if target is None:
+            log_dist = value
+        elif not isinstance(log_dist, np.ndarray):
+            log_dist = dict(log_dist or {})
+            log_dist[target] = value
+        node.value = (log_dist, state)
+        size = log_dist.nbytes if isinstance(log_dist, np.ndarray) else _GATHERED_BYTES * len(log_dist)
+        node.nbytes = size + sum(layer.nbytes for layer in state)
+        self.nbytes += node.nbytes
+        self._lru[node] = None
+        while self.max_bytes is not None and self.nbytes > self.max_bytes and len(self._lru) > 1:
+            self._evict()
+
+    def _evict(self):
+        node, _ = self._lru.popitem(last=False)
+        self.nbytes -= node.nbytes
+        node.value = None
+        node.nbytes = 0
+        self.evictions += 1
+
+        # drop the trie nodes that no longer lead to any cached value from their parents, but keep
+        # their own parent links, since a decode in progress may still hold them and take their prefix
+        while node.parent is not None and node.value is None and len(node.children) == 0:
+            parent = node.parent
+            if parent.children.get(node.key) is node:
+                del parent.children[node.key]
+            node = parent
+        if node.value is None and len(node.children) == 0 and self._roots.get(node.key) is node:
+            del self._roots[node.key]
+
+    def __len__(self):
+        return len(self._lru)
+
+    def __str__(self):
+        return '{} entries ({:.1f} MB), hits: {}, misses: {}, evictions: {}'.format(
+            len(self), self.nbytes / 2.**20, self.hits, self.misses, self.evictions)
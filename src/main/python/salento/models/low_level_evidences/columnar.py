@@ -0,0 +1,145 @@
+# Copyright 2017 Rice University
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+from __future__ import print_function
+import argparse
+import array
+import json
+import os
+
+import numpy as np
+
+HELP = """Use this script to convert a JSON data file (see doc/json_schemas/salento_input_schema.json)
+into a columnar dataset, a directory of memory-mapped arrays that the training reader and the
+aggregators load in place of the JSON file."""
+
+# file (in the dataset directory) with the string tables and the package fields, written last
+META_FILE = 'meta.json'
+FORMAT = 'salento-columnar'
+VERSION = 1
+
+# the integer columns, each in its own .npy file:
+#   - package k has the sequences package_offsets[k] to package_offsets[k+1]
+#   - sequence s has the events sequence_offsets[s] to sequence_offsets[s+1]
+#   - event e has the call calls[e] and the location locations[e] (ids into the string tables)
+#     and the states states[state_offsets[e]:state_offsets[e+1]]
+COLUMNS = [('package_offsets', 'q'), ('sequence_offsets', 'q'), ('calls', 'i'), ('locations', 'i'),
+           ('state_offsets', 'q'), ('states', 'i')]
+_DTYPES = {'i': np.int32, 'q': np.int64}
+
+
+def is_columnar(path):
+    """
+    Whether path is a columnar dataset (see write_columnar) rather than a JSON data file
+    """
+    return os.path.isdir(path) and os.path.exists(os.path.join(path, META_FILE))
+
+
+def write_columnar(packages, path):
+    """
+    Write packages as a columnar dataset: the calls and locations are interned in string tables
+    and the events are flattened into integer columns. Only the fields of the JSON schema are kept
+    for the events; all the fields of the packages but the data are kept.
+    :param packages: the packages, e.g., from read_packages, an iterable that is consumed once
+    :param path: the directory to write the dataset to
+    :return: the number of packages written
+    """
+    call_ids, location_ids = {}, {}
+    fields = []
+    columns = {name: array.array(typecode) for name, typecode in COLUMNS}
+    for name in ['package_offsets', 'sequence_offsets', 'state_offsets']:
+        columns[name].append(0)
+    calls, locations, states = columns['calls'], columns['locations'], columns['states']
+    for package in packages:
+        fields.append({key: value for key, value in package.items() if key != 'data'})
+        for sequence in package['data']:
+            for event in sequence['sequence']:
+                calls.append(call_ids.setdefault(event['call'], len(call_ids)))
+                locations.append(location_ids.setdefault(event['location'], len(location_ids)))
+                states.extend(event['states'])
+                columns['state_offsets'].append(len(states))
+            columns['sequence_offsets'].append(len(calls))
+        columns['package_offsets'].append(len(columns['sequence_offsets']) - 1)
+
+    if not os.path.exists(path):
+        os.makedirs(path)
+    for name, typecode in COLUMNS:
+        np.save(os.path.join(path, name + '.npy'), np.frombuffer(columns[name], dtype=_DTYPES[typecode]))
+    # the string tables are in id order
+    meta = {'format': FORMAT, 'version': VERSION, 'calls': list(call_ids), 'locations': list(location_ids),
+            'packages': fields}
+    with open(os.path.join(path, META_FILE), 'w') as f:
+        json.dump(meta, f)
+    return len(fields)
+
+
+class ColumnarDataset(object):
+    """
+    A columnar dataset (see write_columnar) with its columns memory-mapped, so that opening it
+    costs nothing but reading the string tables, and processes that open the same dataset
+    share its pages.
+    """
+    def __init__(self, path):
+        with open(os.path.join(path, META_FILE)) as f:
+            meta = json.load(f)
+        assert meta.get('format') == FORMAT and meta.get('version') == VERSION, \
+            'Unsupported dataset format in {}'.format(path)
+        self.call_names = meta['calls']
+        self.location_names = meta['locations']
+        self.package_fields = meta['packages']
+        for name, _ in COLUMNS:
+            setattr(self, name, np.load(os.path.join(path, name + '.npy'), mmap_mode='r'))
+
+    def __len__(self):
+        return len(self.package_fields)
+
+    def package(self, k):
+        """
+        The k-th package as in the JSON data file
+        """
+        package = dict(self.package_fields[k])
+        start, end = self.package_offsets[k], self.package_offsets[k + 1]
+        sequence_offsets = self.sequence_offsets[start:end + 1].tolist()
+        first, last = sequence_offsets[0], sequence_offsets[-1]
+        calls = self.calls[first:last].tolist()
+        locations = self.locations[first:last].tolist()
+        state_offsets = self.state_offsets[first:last + 1].tolist()
+        states = self.states[state_offsets[0]:state_offsets[-1]].tolist()
+        base = state_offsets[0]
+
+        events = [{'call': self.call_names[call],
+                   'states': states[state_offsets[e] - base:state_offsets[e + 1] - base],
+                   'location': self.location_names[location]}
+                  for e, (call, location) in enumerate(zip(calls, locations))]
+        package['data'] = [{'sequence': events[s - first:t - first]}
+                           for s, t in zip(sequence_offsets[:-1], sequence_offsets[1:])]
+        return package
+
+    def __iter__(self):
+        for k in range(len(self)):
+            yield self.package(k)
+
+
+if __name__ == '__main__':
+    from salento.models.low_level_evidences.data_reader import read_packages
+    parser = argparse.ArgumentParser(formatter_class=argparse.RawDescriptionHelpFormatter,
+                                     description=HELP)
+    parser.add_argument('input_file', type=str,
+                        help='input data file (JSON, possibly compressed)')
+    parser.add_argument('output_dir', type=str,
+                        help='directory to write the columnar dataset to')
+    clargs = parser.parse_args()
+    print('Converting {}...'.format(clargs.input_file), end='', flush=True)
+    n = write_columnar(read_packages(clargs.input_file), clargs.output_dir)
+    print('done, {} packages'.format(n))
@@ -0,0 +1,26 @@
+# Copyright 2017 Rice University
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+# the constants of configs and decoder paths, in a module of their own so that the modules that
+# only need these (e.g., the data reader and the decoder cache) can be used without tensorflow
+
+CONFIG_GENERAL = ['model', 'latent_size', 'batch_size', 'num_epochs',
+                  'learning_rate', 'print_step', 'alpha', 'beta']
+CONFIG_ENCODER = ['name', 'units', 'num_layers', 'tile']
+CONFIG_DECODER = ['units', 'num_layers', 'max_seq_length']
+CONFIG_INFER = ['chars', 'vocab', 'vocab_size']
+
+UNK = '_UNK_'
+CHILD_EDGE = 'V'
+SIBLING_EDGE = 'H'
@@ -14,17 +14,19 @@
 
 from __future__ import print_function
 import json
+import re
 import numpy as np
-import random
-from collections import Counter
-from itertools import chain
 
-from salento.models.low_level_evidences.utils import CHILD_EDGE, SIBLING_EDGE
+from salento.models.low_level_evidences.constants import CHILD_EDGE, SIBLING_EDGE, CONFIG_INFER
+from salento.models.low_level_evidences.columnar import is_columnar, ColumnarDataset
+from salento.models.low_level_evidences.store import store_key, file_digest
 
 import bz2
 import lzma
 import gzip
 import os.path
+import shutil
+import tempfile
 
 LOADERS = {
     ".bz2": bz2.open,
@@ -37,115 +39,460 @@ LOADERS = {
 def smart_open(filename, *args, **kwargs):
     return LOADERS.get(os.path.splitext(filename)[1], open)(filename, *args, **kwargs)
 
+
+_WHITESPACE = re.compile(r'\s*')
+
+
+class _JSONStream(object):
+    """
+    Read JSON values one at a time from a text file, keeping only the unread part in memory
+    """
+    def __init__(self, f, chunk_size):
+        self.f = f
+        self.chunk_size = chunk_size
+        self.buffer = ''
+        self.pos = 0
+        self.decoder = json.JSONDecoder()
+        # the byte offset (in the UTF-8 encoded file) of the character at position mark of the buffer
+        self.mark = 0
+        self.mark_offset = 0
+
+    def _fill(self):
+        # keep the unread part and read at least as much again, so a value that does not fit
+        # in the buffer is decoded a logarithmic number of times
+        self.offset()
+        chunk = self.f.read(max(self.chunk_size, len(self.buffer) - self.pos))
+        self.buffer = self.buffer[self.pos:] + chunk
+        self.pos = self.mark = 0
+        return len(chunk) > 0
+
+    def offset(self):
+        """
+        The byte offset of the current position in the file
+        """
+        # count the bytes since the last offset taken, so the buffer is encoded only once
+        self.mark_offset += len(self.buffer[self.mark:self.pos].encode('utf-8'))
+        self.mark = self.pos
+        return self.mark_offset
+
+    def _peek(self):
+        while True:
+            self.pos = _WHITESPACE.match(self.buffer, self.pos).end()
+            if self.pos < len(self.buffer):
+                return self.buffer[self.pos]
+            if not self._fill():
+                return None
+
+    def accept(self, c):
+        if self._peek() == c:
+            self.pos += 1
+            return True
+        return False
+
+    def expect(self, c):
+        if not self.accept(c):
+            raise ValueError('Expected {} at: {}'.format(c, self.buffer[self.pos:self.pos + 50]))
+
+    def value(self):
+        self._peek()
+        while True:
+            try:
+                value, end = self.decoder.raw_decode(self.buffer, self.pos)
+            except ValueError:
+                if not self._fill():
+                    raise
+                continue
+            # a value that ends with the buffer (e.g., a number) may go on in the rest of the file
+            if end == len(self.buffer) and self._fill():
+                continue
+            self.pos = end
+            return value
+
+    def array(self, offsets=False):
+        """
+        Read the values of an array one at a time
+        :param offsets: if True, yield (value, start, end) with the byte offsets of each value
+        """
+        self.expect('[')
+        if self.accept(']'):
+            return
+        while True:
+            if offsets:
+                self._peek()
+                start = self.offset()
+                value = self.value()
+                yield value, start, self.offset()
+            else:
+                yield self.value()
+            if self.accept(']'):
+                return
+            self.expect(',')
+
+
+def read_packages(filename, chunk_size=2**20):
+    """
+    Read the packages of a data file ({"packages": [...]}) one at a time, without loading the
+    whole file in memory
+    :param filename: the data file, possibly compressed (see smart_open), or a columnar dataset
+                     (see columnar.py)
+    :param chunk_size: the number of characters to read from the file at a time
+    :return: an iterator over the packages
+    """
+    if is_columnar(filename):
+        for package in ColumnarDataset(filename):
+            yield package
+        return
+    for package in _read_packages(filename, chunk_size, offsets=False):
+        yield package
+
+
+def _read_packages(filename, chunk_size, offsets):
+    # newlines are read untranslated, so that the offsets are those of the file
+    with smart_open(filename, 'rt', encoding='utf-8', newline='') as f:
+        stream = _JSONStream(f, chunk_size)
+        stream.expect('{')
+        if stream.accept('}'):
+            return
+        while True:
+            key = stream.value()
+            stream.expect(':')
+            if key == 'packages':
+                for package in stream.array(offsets):
+                    yield package
+            else:
+                stream.value()
+            if stream.accept('}'):
+                return
+            stream.expect(',')
+
+
+# suffix of the sidecar index file of a data file (see PackageIndex)
+INDEX_SUFFIX = '.index.npz'
+
+
+class PackageIndex(object):
+    """
+    Index of the packages of a data file, to read some of them without parsing the whole file:
+    the name, the number of sequences and the byte range of each package. The byte offsets are in
+    the uncompressed file, so a compressed file is decompressed up to the packages that are read
+    (once for all of them, since they are read in file order, and the file is kept open for the
+    packages of later calls that come after them, until close). The index is built with a pass
+    over the file and saved next to it (data file + INDEX_SUFFIX), and is rebuilt if the data file
+    changes. A columnar dataset (see columnar.py) needs no index file since its packages are
+    found from its offsets.
+    """
+    def __init__(self, filename, rebuild=False):
+        """
+        :param filename: the data file, possibly compressed (see smart_open), or a columnar dataset
+        :param rebuild: if True, rebuild the index even if it is up to date
+        """
+        self.filename = filename
+        self.columns = None
+        self._file = None
+        if is_columnar(filename):
+            self.columns = ColumnarDataset(filename)
+            self.names = [package.get('name', '') for package in self.columns.package_fields]
+            self.sequences = np.diff(self.columns.package_offsets)
+            return
+
+        path = filename + INDEX_SUFFIX
+        stat = os.stat(filename)
+        version = np.array([stat.st_size, stat.st_mtime_ns], dtype=np.int64)
+        if not rebuild and os.path.exists(path):
+            with np.load(path) as f:
+                if np.array_equal(f['version'], version):
+                    self.names = f['names'].tolist()
+                    self.sequences = f['sequences']
+                    self.offsets = f['offsets']
+                    return
+
+        names, sequences, offsets = [], [], []
+        for package, start, end in _read_packages(filename, 2**20, offsets=True):
+            names.append(package.get('name', ''))
+            sequences.append(len(package.get('data', [])))
+            offsets.append((start, end))
+        self.names = names
+        self.sequences = np.array(sequences, dtype=np.int64)
+        self.offsets = np.array(offsets, dtype=np.int64).reshape(-1, 2)
+        try:
+            np.savez(path, version=version, names=np.array(names, dtype=str), sequences=self.sequences,
+                     offsets=self.offsets)
+        except OSError as e:
+            print('Could not save index {}: {}'.format(path, e))
+
+    def __len__(self):
+        return len(self.names)
+
+    def find(self, name):
+        """
+        :return: the indices of the packages with the given name
+        """
+        return [k for k, package_name in enumerate(self.names) if package_name == name]
+
+    def packages(self, indices):
+        """
+        Read the packages with the given indices
+        :return: an iterator over the packages, in the order of indices
+        """
+        indices = list(indices)
+        if self.columns is not None:
+            for k in indices:
+                yield self.columns.package(k)
+            return
+        # read the packages in file order, so that a compressed file is decompressed once
+        packages = {}
+        if self._file is None:
+            self._file = smart_open(self.filename, 'rb')
+        for k in sorted(set(indices), key=lambda k: self.offsets[k][0]):
+            start, end = self.offsets[k]
+            self._file.seek(start)
+            packages[k] = json.loads(self._file.read(end - start).decode('utf-8'))
+        for k in indices:
+            yield packages[k]
+
+    def package(self, k):
+        return next(self.packages([k]))
+
+    def close(self):
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+
+
+def event_states(call):
+    for i, elem in enumerate(call['states']):
+        key = '{}#{}'.format(i, elem)
+        yield key
+
+
 def get_seq_paths(js):
-    def get_seq_path_step(elem=None, accum=None):
-        if accum is None:
-            return [
-                [('STOP', SIBLING_EDGE)]
-            ]
-
-        call = elem['call']
-        
-        for path in accum:
-            path.insert(0, (call, SIBLING_EDGE))
-
-        accum.insert(0, list(chain(
-            [(call, CHILD_EDGE)],
-            (('{}#{}'.format(i, state), SIBLING_EDGE) for i, state in enumerate(elem['states'])),
-            [('STOP', SIBLING_EDGE)]
-        )))
-    
-        return accum
-
-    accum = get_seq_path_step()
-    for elem in reversed(js):
-        accum = get_seq_path_step(elem, accum)
-    return accum
+    """
+    The paths of a sequence: for each event, the calls before it along SIBLING_EDGEs, its call along
+    a CHILD_EDGE, its states and STOP, and finally all the calls and STOP
+    :param js: the events of the sequence
+    :return: list of paths, each a list of (node, edge)
+    """
+    prefix = [(elem['call'], SIBLING_EDGE) for elem in js]
+    paths = [prefix[:k] + [(elem['call'], CHILD_EDGE)] +
+             [('{}#{}'.format(i, state), SIBLING_EDGE) for i, state in enumerate(elem['states'])] +
+             [('STOP', SIBLING_EDGE)] for k, elem in enumerate(js)]
+    paths.append(prefix + [('STOP', SIBLING_EDGE)])
+    return paths
+
+
+def get_seq_path_arrays(calls, states, state_offsets, start, stop):
+    """
+    The paths of a sequence (see get_seq_paths) for training, each from a START node along a
+    CHILD_EDGE, as arrays of token ids built at once for all the paths
+    :param calls: int array of the token ids of the calls of the n events
+    :param states: int array of the token ids of the states of all the events
+    :param state_offsets: int array of n+1 offsets, event k has the states state_offsets[k] to state_offsets[k+1]
+    :param start: the token id of START
+    :param stop: the token id of STOP
+    :return: tuple of the nodes, the edges (True for CHILD_EDGE) and the targets (the nodes shifted
+             left by one, 0 after the last node) of the n+1 paths, concatenated, and the lengths of the paths
+    """
+    n = len(calls)
+    counts = np.append(np.diff(state_offsets), 0)
+    k = np.arange(n + 1)
+    # START, the calls before event k, the call of event k, its states and STOP (no event for the last path)
+    lengths = np.where(k < n, k + counts + 3, n + 2)
+    col = np.arange(lengths.max())[None, :]
+    row = k[:, None]
+    last = row == n
+
+    prefix = (col >= 1) & (col <= row)
+    child = (col == row + 1) & ~last
+    state = (col >= row + 2) & (col < row + 2 + counts[:, None]) & ~last
+    calls = np.append(calls, stop)
+    states = np.append(states, stop)
+    state_index = state_offsets[:, None] + col - row - 2
+
+    nodes = np.full((n + 1, lengths.max()), stop, dtype=np.int32)
+    nodes[:, 0] = start
+    nodes[prefix] = calls[np.broadcast_to(col - 1, nodes.shape)[prefix]]
+    nodes[child] = calls[k[:n]]
+    nodes[state] = states[np.broadcast_to(state_index, nodes.shape)[state]]
+    edges = child | (col == 0)
+    targets = np.zeros_like(nodes)
+    targets[:, :-1] = nodes[:, 1:]
+
+    # keep the positions within the length of each path, and no target after the last node
+    valid = col < lengths[:, None]
+    targets[col == lengths[:, None] - 1] = 0
+    return nodes[valid], edges[valid], targets[valid], lengths
+
+
+# file (in a cache entry of the reader) with the vocabs, written last
+CACHE_FILE = 'reader.json'
+CACHE_ARRAYS = ['nodes', 'edges', 'targets', 'lengths']
+CACHE_VERSION = 1
+
 
 class Reader():
     def __init__(self, clargs, config):
         self.config = config
+        continue_from = clargs.continue_from is not None
+
+        # with a cache directory, the arrays of a data file are wrangled once for a given config
+        cache_dir = getattr(clargs, 'cache_dir', None)
+        if cache_dir is not None:
+            path = os.path.join(cache_dir, self.cache_key(clargs.input_file[0], continue_from))
+            if os.path.exists(os.path.join(path, CACHE_FILE)):
+                print('Reading cached data {}...'.format(path))
+                self.load_cache(path, continue_from)
+                return
+        self.read(clargs.input_file[0], continue_from)
+        if cache_dir is not None:
+            self.save_cache(path)
+
+    def cache_key(self, filename, continue_from):
+        """
+        The key of the cache entry of a data file, a digest of its contents and of the config that
+        the arrays depend on (and of the vocabs of the model when continuing from it)
+        """
+        config = self.config
+        paths = [os.path.join(filename, name) for name in os.listdir(filename)] if os.path.isdir(filename) \
+            else [filename]
+        parts = [CACHE_VERSION, file_digest(paths), config.batch_size, config.decoder.max_seq_length,
+                 json.dumps([ev.name for ev in config.evidence])]
+        if continue_from:
+            parts.append(json.dumps([config.decoder.chars] + [ev.chars for ev in config.evidence]))
+        return store_key(*parts).decode('ascii')
 
-        # read the raw evidences and targets
+    def save_cache(self, path):
+        """
+        Write the arrays and the vocabs to a cache entry, which appears at once when complete
+        """
+        directory = os.path.dirname(path)
+        if not os.path.exists(directory):
+            os.makedirs(directory)
+        tmp = tempfile.mkdtemp(dir=directory)
+        for name in CACHE_ARRAYS:
+            np.save(os.path.join(tmp, name + '.npy'), getattr(self, name))
+        for j, data in enumerate(self.inputs):
+            np.save(os.path.join(tmp, 'inputs{}.npy'.format(j)), data)
+        meta = {'decoder': {attr: getattr(self.config.decoder, attr) for attr in CONFIG_INFER},
+                'evidence': [{attr: getattr(ev, attr) for attr in CONFIG_INFER} for ev in self.config.evidence]}
+        with open(os.path.join(tmp, CACHE_FILE), 'w') as f:
+            json.dump(meta, f)
+        try:
+            os.rename(tmp, path)
+        except OSError:
+            # another run cached the same entry meanwhile
+            shutil.rmtree(tmp)
+
+    def load_cache(self, path, continue_from):
+        """
+        Memory-map the arrays of a cache entry, and set up the vocabs from it unless continuing
+        from a model (whose vocabs the entry was wrangled with)
+        """
+        for name in CACHE_ARRAYS:
+            setattr(self, name, np.load(os.path.join(path, name + '.npy'), mmap_mode='r'))
+        self.inputs = [np.load(os.path.join(path, 'inputs{}.npy'.format(j)), mmap_mode='r')
+                       for j in range(len(self.config.evidence))]
+        self.config.num_batches = len(self.lengths) // self.config.batch_size
+        if not continue_from:
+            with open(os.path.join(path, CACHE_FILE)) as f:
+                meta = json.load(f)
+            for attr in CONFIG_INFER:
+                setattr(self.config.decoder, attr, meta['decoder'][attr])
+            for ev, vocab in zip(self.config.evidence, meta['evidence']):
+                for attr in CONFIG_INFER:
+                    setattr(ev, attr, vocab[attr])
+
+    def read(self, filename, continue_from):
+        config = self.config
+
+        # read the raw evidences and the paths, as ids into a table of tokens
         print('Reading data file...')
-        raw_evidences, raw_targets = self.read_data(clargs.input_file[0])
-        raw_evidences = [[raw_evidence[i] for raw_evidence in raw_evidences] for i, ev in
-                         enumerate(config.evidence)]
+        raw_evidences, program_ids, tokens, (nodes, edges, targets, lengths) = self.read_data(filename)
 
-        # align with number of batches
-        config.num_batches = int(len(raw_targets) / config.batch_size)
+        # randomly shuffle to avoid bias towards initial data points during training, and align
+        # with number of batches
+        config.num_batches = int(len(lengths) / config.batch_size)
         assert config.num_batches > 0, 'Not enough data'
         sz = config.num_batches * config.batch_size
-        for i in range(len(raw_evidences)):
-            raw_evidences[i] = raw_evidences[i][:sz]
-        raw_targets = raw_targets[:sz]
+        order = np.random.permutation(len(lengths))[:sz]
+        program_ids = program_ids[order]
+        raw_evidences = [[raw_evidence[i] for raw_evidence in raw_evidences] for i, ev in
+                         enumerate(config.evidence)]
+
+        # the positions of the tokens of the selected paths, in the order of the paths
+        offsets = np.concatenate([[0], np.cumsum(lengths)])
+        self.lengths = lengths[order].astype(np.int32)
+        rows = np.repeat(np.arange(sz), self.lengths)
+        cols = np.arange(len(rows)) - np.repeat(np.cumsum(self.lengths) - self.lengths, self.lengths)
+        positions = np.repeat(offsets[order], self.lengths) + cols
+        path_nodes = nodes[positions]
 
         # setup input and target chars/vocab
-        if clargs.continue_from is None:
+        if not continue_from:
             for ev, data in zip(config.evidence, raw_evidences):
-                ev.set_chars_vocab(data)
-            counts = Counter([n for path in raw_targets for (n, _) in path])
-            config.decoder.chars = sorted(counts.keys(), key=lambda w: counts[w], reverse=True)
+                ev.set_chars_vocab([data[i] for i in program_ids])
+            # tokens by decreasing count, ties in order of first appearance
+            counts = np.bincount(path_nodes, minlength=len(tokens))
+            seen, first = np.unique(path_nodes, return_index=True)
+            seen = seen[np.argsort(first, kind='mergesort')]
+            seen = seen[np.argsort(-counts[seen], kind='mergesort')]
+            config.decoder.chars = [tokens[i] for i in seen]
             config.decoder.vocab = dict(zip(config.decoder.chars, range(len(config.decoder.chars))))
             config.decoder.vocab_size = len(config.decoder.vocab)
+        token_ids = np.array([config.decoder.vocab.get(token, -1) for token in tokens], dtype=np.int32)
+        assert np.all(token_ids[path_nodes] >= 0), 'Data has tokens that are not in the vocab of the model'
 
-        # wrangle the evidences and targets into numpy arrays
-        self.inputs = [ev.wrangle(data) for ev, data in zip(config.evidence, raw_evidences)]
-        self.nodes = np.zeros((sz, config.decoder.max_seq_length), dtype=np.int32)
-        self.edges = np.zeros((sz, config.decoder.max_seq_length), dtype=np.bool)
-        self.targets = np.zeros((sz, config.decoder.max_seq_length), dtype=np.int32)
-        for i, path in enumerate(raw_targets):
-            self.nodes[i, :len(path)] = list(map(config.decoder.vocab.get, [p[0] for p in path]))
-            self.edges[i, :len(path)] = [p[1] == CHILD_EDGE for p in path]
-            self.targets[i, :len(path)-1] = self.nodes[i, 1:len(path)]  # shifted left by one
-
-        # split into batches
-        self.inputs = [np.split(ev_data, config.num_batches, axis=0) for ev_data in self.inputs]
-        self.nodes = np.split(self.nodes, config.num_batches, axis=0)
-        self.edges = np.split(self.edges, config.num_batches, axis=0)
-        self.targets = np.split(self.targets, config.num_batches, axis=0)
-
-        # reset batches
-        self.reset_batches()
+        # wrangle the evidences and targets into numpy arrays, one data point per row (padded to
+        # the longest path), which the input pipeline (see input_pipeline.py) buckets by length
+        self.inputs = [ev.wrangle(data)[program_ids] for ev, data in zip(config.evidence, raw_evidences)]
+        width = self.lengths.max()
+        self.nodes = np.zeros((sz, width), dtype=np.int32)
+        self.edges = np.zeros((sz, width), dtype=np.bool)
+        self.targets = np.zeros((sz, width), dtype=np.int32)
+        self.nodes[rows, cols] = token_ids[path_nodes]
+        self.edges[rows, cols] = edges[positions]
+        # the target after the last node of a path is 0, and stays so
+        self.targets[rows, cols] = np.where(cols < np.repeat(self.lengths, self.lengths) - 1,
+                                            token_ids[targets[positions]], 0)
 
     def read_data(self, filename):
-        with smart_open(filename, 'rt') as f:
-            js = json.load(f)
-        data_points = []
+        """
+        Read the evidences and the paths (see get_seq_path_arrays) of the programs of a data file,
+        ignoring the programs with paths longer than max_seq_length
+        :return: tuple of the evidences of each program, the program of each path, the table of
+                 tokens, and the concatenated (nodes, edges, targets) and lengths of the paths, as
+                 ids into the table of tokens
+        """
+        evidences, program_ids, paths = [], [], []
+        token_ids = {}
+        start = token_ids.setdefault('START', len(token_ids))
+        stop = token_ids.setdefault('STOP', len(token_ids))
         ignored, done = 0, 0
 
-        for program in js['packages']:
+        for program in read_packages(filename):
             if 'data' not in program:
                 continue
-            try:
-                evidence = [ev.read_data_point(program) for ev in self.config.evidence]
-                sequences = list(chain.from_iterable(get_seq_paths(seq['sequence']) for seq in program['data']))
-                for sequence in sequences:
-                    sequence.insert(0, ('START', CHILD_EDGE))
-                    assert len(sequence) <= self.config.decoder.max_seq_length
-                    data_points.append((evidence, sequence))
-            except AssertionError:
+            evidence = [ev.read_data_point(program) for ev in self.config.evidence]
+            program_paths = []
+            for seq in program['data']:
+                calls, states, state_offsets = [], [], [0]
+                for elem in seq['sequence']:
+                    calls.append(token_ids.setdefault(elem['call'], len(token_ids)))
+                    states.extend(token_ids.setdefault('{}#{}'.format(i, state), len(token_ids))
+                                  for i, state in enumerate(elem['states']))
+                    state_offsets.append(len(states))
+                program_paths.append(get_seq_path_arrays(np.array(calls, dtype=np.int32),
+                                                         np.array(states, dtype=np.int32),
+                                                         np.array(state_offsets), start, stop))
+            if any(path[3].max() > self.config.decoder.max_seq_length for path in program_paths):
                 ignored += 1
+            else:
+                program_ids.extend([len(evidences)] * sum(len(path[3]) for path in program_paths))
+                evidences.append(evidence)
+                paths.extend(program_paths)
             done += 1
         print('{:8d} programs in training data'.format(done))
         print('{:8d} programs ignored by given config'.format(ignored))
 
-        # randomly shuffle to avoid bias towards initial data points during training
-        random.shuffle(data_points)
-        evidences, targets = zip(*data_points)
-
-        return evidences, targets
-
-    def next_batch(self):
-        batch = next(self.batches)
-        n, e, y = batch[:3]
-        ev_data = batch[3:]
-
-        # reshape the batch into required format
-        rn = np.transpose(n)
-        re = np.transpose(e)
-
-        return ev_data, rn, re, y
-
-    def reset_batches(self):
-        self.batches = iter(zip(self.nodes, self.edges, self.targets, *self.inputs))
+        tokens = sorted(token_ids, key=token_ids.get)
+        nodes, edges, targets, lengths = (np.concatenate(arrays) for arrays in zip(*paths))
+        return evidences, np.array(program_ids, dtype=np.int64), tokens, (nodes, edges, targets, lengths)
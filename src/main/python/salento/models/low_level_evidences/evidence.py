@@ -17,7 +17,7 @@ import numpy as np
 import re
 from collections import Counter
 
-from salento.models.low_level_evidences.utils import CONFIG_ENCODER, CONFIG_INFER
+from salento.models.low_level_evidences.utils import CONFIG_ENCODER, CONFIG_INFER, batch_size
 
 
 class Evidence(object):
@@ -67,6 +67,15 @@ class Evidence(object):
     def evidence_loss(self, psi, encoding, config):
         raise NotImplementedError('evidence_loss() has not been implemented')
 
+    def export_weights(self, variables):
+        raise NotImplementedError('export_weights() has not been implemented')
+
+    def np_exists(self, inputs):
+        raise NotImplementedError('np_exists() has not been implemented')
+
+    def np_encode(self, inputs, weights, config):
+        raise NotImplementedError('np_encode() has not been implemented')
+
 
 def _extract_evidence(program):
     sequences = program['data']
@@ -94,7 +103,7 @@ def _get_apicalls(program, max_seqs=9999, max_seq_length=9999, KEY='apicalls', c
 def update_apicalls(program, max_seqs=9999, max_seqs_length=9999, KEY='apicalls'):
     if KEY in program:
         return True
-    if _valid_apicalls(program, max_seq, max_seqs_length):
+    if _valid_apicalls(program, max_seqs, max_seqs_length):
         program[KEY] = _extract_evidence(program)
         return True
     return False
@@ -131,8 +140,9 @@ class APICalls(Evidence):
 
     def encode(self, inputs, config):
         with tf.variable_scope('apicalls'):
-            latent_encoding = tf.zeros([config.batch_size, config.latent_size])
-            inp = tf.slice(inputs, [0, 0, 0], [config.batch_size, 1, self.vocab_size])
+            batch = batch_size(config, inputs)
+            latent_encoding = tf.zeros([batch, config.latent_size])
+            inp = tf.slice(inputs, [0, 0, 0], [batch, 1, self.vocab_size])
             inp = tf.reshape(inp, [-1, self.vocab_size])
             encoding = tf.layers.dense(inp, self.units, activation=tf.nn.tanh)
             for i in range(self.num_layers - 1):
@@ -147,3 +157,26 @@ class APICalls(Evidence):
         loss = 0.5 * (config.latent_size * tf.log(2 * np.pi * sigma_sq + 1e-10)
                       + tf.square(encoding - psi) / sigma_sq)
         return loss
+
+    def export_weights(self, variables):
+        dense = variables.find(r'mean/apicalls/dense(_\d+)?/(kernel|weights)$')
+        assert len(dense) == self.num_layers, 'Expected {} dense layers in apicalls'.format(self.num_layers)
+        weights = {'apicalls/sigma': variables.get(r'(^|/)apicalls/sigma$'),
+                   'apicalls/w': variables.get(r'mean/apicalls/w$'),
+                   'apicalls/b': variables.get(r'mean/apicalls/b$')}
+        # layers are named dense, dense_1, dense_2, ... in the order they were created
+        for i, name in enumerate(sorted(dense, key=lambda n: int(re.search(r'dense_?(\d*)/', n).group(1) or 0))):
+            scope = name.rsplit('/', 1)[0]
+            weights['apicalls/dense{}/kernel'.format(i)] = dense[name]
+            weights['apicalls/dense{}/bias'.format(i)] = variables.get('^{}/(bias|biases)$'.format(scope))
+        return weights
+
+    def np_exists(self, inputs):
+        return np.count_nonzero(np.sum(inputs, axis=2), axis=1) != 0
+
+    def np_encode(self, inputs, weights, config):
+        encoding = inputs[:, 0, :].astype(np.float32)
+        for i in range(self.num_layers):
+            encoding = np.tanh(np.dot(encoding, weights['apicalls/dense{}/kernel'.format(i)])
+                               + weights['apicalls/dense{}/bias'.format(i)])
+        return np.dot(encoding, weights['apicalls/w']) + weights['apicalls/b']
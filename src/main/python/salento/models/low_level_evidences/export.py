@@ -0,0 +1,47 @@
+# Copyright 2017 Rice University
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+from __future__ import print_function
+import numpy as np
+import tensorflow as tf
+
+import argparse
+import os
+import json
+
+from salento.models.low_level_evidences.numpy_model import export_weights, WEIGHTS_FILE
+from salento.models.low_level_evidences.utils import read_config
+
+HELP = """Use this script to export the weights of a trained model into {} in the model directory,
+so that it can be used for inference with the numpy backend (no TF session).""".format(WEIGHTS_FILE)
+
+
+def export(clargs):
+    with open(os.path.join(clargs.save, 'config.json')) as f:
+        config = read_config(json.load(f), chars_vocab=True)
+    ckpt = tf.train.get_checkpoint_state(clargs.save)
+    reader = tf.train.NewCheckpointReader(ckpt.model_checkpoint_path)
+    print('Exporting {}...'.format(ckpt.model_checkpoint_path), end='')
+    weights = export_weights(reader, config)
+    np.savez(os.path.join(clargs.save, WEIGHTS_FILE), **weights)
+    print('done')
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(formatter_class=argparse.RawDescriptionHelpFormatter,
+                                     description=HELP)
+    parser.add_argument('save', type=str,
+                        help='directory where the model is checkpointed')
+    clargs = parser.parse_args()
+    export(clargs)
@@ -18,20 +18,20 @@ import numpy as np
 
 import os
 import json
+import glob
 
 from salento.models.low_level_evidences.model import Model
+from salento.models.low_level_evidences.numpy_model import NumpyModel, WEIGHTS_FILE
 from salento.models.low_level_evidences.utils import CHILD_EDGE, SIBLING_EDGE
 from salento.models.low_level_evidences.utils import read_config
+from salento.models.low_level_evidences.store import file_digest
+from salento.models.low_level_evidences.data_reader import event_states
+from salento.models.low_level_evidences.cache import DecoderCache
 
-from collections import namedtuple    
+from collections import namedtuple
 
 Row = namedtuple('Row', ['call', 'states', 'distribution', 'next_state'])
 
-def event_states(call):
-    for i, elem in enumerate(call['states']):
-        key = '{}#{}'.format(i, elem)
-        yield key
-
 def _next_state(event):
     yield (event['call'], CHILD_EDGE)
     for key in event_states(event):
@@ -40,6 +40,16 @@ def _next_state(event):
 def _next_call(event):
     return (event['call'], SIBLING_EDGE)
 
+def _average(values, log):
+    # the average over the samples of psi of (log-)probabilities, along the first axis
+    values = np.asarray(values)
+    if len(values) == 1:
+        return values[0]
+    if not log:
+        return np.mean(values, axis=0)
+    top = np.max(values, axis=0)
+    return top + np.log(np.mean(np.exp(values - top), axis=0))
+
 class VectorMapping:
     def __init__(self, data, id_to_term, term_to_id):
         self.data = data
@@ -76,14 +86,33 @@ class VectorMapping:
     def __repr__(self):
         return repr(dict(self.items()))
 
+BACKENDS = ['tensorflow', 'numpy']
+
 class BayesianPredictor(object):
 
-    def __init__(self, save, sess):
+    def __init__(self, save, sess, backend='tensorflow', psi_mean=False, psi_samples=1):
+        """
+        :param save: directory where the model is stored
+        :param sess: the TF session, or None for the numpy backend
+        :param backend: 'tensorflow', or 'numpy' to run on the weights exported by export.py
+        :param psi_mean: if True, use the mean latent specification of evidences instead of sampling one
+        :param psi_samples: the number of latent specifications to sample for evidences. The
+                            predictions of all samples are decoded together and averaged.
+        """
+        assert not psi_mean or psi_samples == 1, 'there is a single mean latent specification'
         self.sess = sess
+        self.psi_mean = psi_mean
+        self.psi_samples = psi_samples
 
         # load the saved config
         with open(os.path.join(save, 'config.json')) as f:
             config = read_config(json.load(f), chars_vocab=True)
+        if backend == 'numpy':
+            # weights exported by export.py, sess is not used
+            self.model = NumpyModel(config, os.path.join(save, WEIGHTS_FILE))
+            self._model_files = [os.path.join(save, 'config.json'), os.path.join(save, WEIGHTS_FILE)]
+            return
+        assert backend == 'tensorflow', 'invalid backend: {}'.format(backend)
         self.model = Model(config, True)
 
         # restore the saved model
@@ -91,6 +120,13 @@ class BayesianPredictor(object):
         saver = tf.train.Saver(tf.global_variables())
         ckpt = tf.train.get_checkpoint_state(save)
         saver.restore(self.sess, ckpt.model_checkpoint_path)
+        self._model_files = [os.path.join(save, 'config.json')] + glob.glob(ckpt.model_checkpoint_path + '.*')
+
+    def model_digest(self):
+        """
+        A digest of the files of the model (and the backend reading them), which identifies its results
+        """
+        return file_digest(self._model_files)
 
     def _sequence_to_graph(self, sequence, step='call'):
         seq = [('START', CHILD_EDGE)] + [_next_call(call) for call in sequence[:-1]]
@@ -104,41 +140,128 @@ class BayesianPredictor(object):
         return seq
 
     # step can be 'call' or 'state', depending on if you are looking for distribution over the next call/state
-    def infer_step(self, psi, sequence, step='call', cache=None):
+    # log to get the log-distribution, target to get the (log-)probability of only that call/state
+    # with many samples in psi, the distributions of all samples are decoded together and averaged
+    def infer_step(self, psi, sequence, step='call', cache=None, log=False, target=None):
         seq = self._sequence_to_graph(sequence, step)
-        dist = self.model.infer_seq(self.sess, psi, seq, cache=cache)
-        return self._create_distribution(dist)
+        seqs = [seq] * len(psi)
+        if target is None:
+            for rows in self.model.infer_seq_batch_iter(self.sess, psi, seqs, cache=cache, log=log):
+                pass
+            return self._create_distribution(_average([row.distribution for _, row in rows], log))
+        # only gather the log-probability of the next node of the sequence at each step
+        targets = [[node for node, _ in seq[1:]] + [target]] * len(psi)
+        for rows in self.model.infer_seq_batch_iter(self.sess, psi, seqs, cache=cache, targets=targets):
+            pass
+        value = _average([row.distribution for _, row in rows], True)
+        return value if log else np.exp(value)
 
-    def infer_step_iter(self, psi, sequence, step='call', cache=None):
+    def infer_step_iter(self, psi, sequence, step='call', cache=None, log=False):
         seq = self._sequence_to_graph(sequence=sequence, step='call')
         states = []
-        for idx, row in enumerate(self.model.infer_seq_iter(self.sess, psi, seq, cache=cache)):
-            def next_state():
-                dist = self.model.infer_seq(self.sess, psi, _next_state(sequence[idx]), cache, resume=row)
-                return self._create_distribution(dist)
+        for idx, rows in enumerate(self.model.infer_seq_batch_iter(self.sess, psi, [seq] * len(psi),
+                                                                   cache=cache, log=log)):
+            rows = [row for _, row in rows]
+
+            def next_state(idx=idx, rows=rows):
+                dists = [self.model.infer_seq(self.sess, psi, _next_state(sequence[idx]), cache, resume=row, log=log)
+                         for row in rows]
+                return self._create_distribution(_average(dists, log))
             yield Row(
-                    call=row.node,
+                    call=rows[0].node,
                     states=states,
-                    distribution=self._create_distribution(row.distribution),
+                    distribution=self._create_distribution(_average([row.distribution for row in rows], log)),
                     next_state=next_state,
                 )
 
+            # each row gets the states of the call before it only
+            states = []
             if step == 'state' and idx < len(sequence):
                 call = sequence[idx]
-                new_seq = list(_next_state(call))
-                dists = self.model.infer_seq_iter(self.sess, psi, new_seq, cache=cache, resume=row)
-                vocabs = self.model.config.decoder.vocab
-                for (key, row) in zip(list(event_states(call)) + [None], dists):
-                    if key is not None:
-                        states.append(row.distribution[vocabs[key]])
-            else:
-                states = []
+                keys = list(event_states(call))
+                new_seq = list(_next_state(call))[:len(keys)]
+                log_probs = [[state.distribution for state in self.model.infer_seq_iter(
+                                 self.sess, psi, new_seq, cache=cache, resume=row, targets=keys)] for row in rows]
+                states = list(_average(log_probs, True) if log else np.exp(_average(log_probs, True)))
+
+    def next_state_distributions(self, psi, sequence, cache=None, log=False):
+        """
+        The distribution after the call and the states of each event of a sequence, as next_state of
+        the rows of infer_step_iter, with the branches into the states of all the events decoded
+        together in lockstep, so that their shared prefixes of calls are decoded once
+        :return: list with the distribution of each event
+        """
+        if len(sequence) == 0:
+            return []
+        calls = self._sequence_to_graph(sequence, step='call')
+        seqs = [calls[:idx+1] + list(_next_state(event)) for idx, event in enumerate(sequence)]
+        samples = len(psi)
+        if samples > 1:
+            psi = np.repeat(psi, len(seqs), axis=0)
+        # the distribution after the last step of each branch, for each sample
+        last = [None] * (len(seqs) * samples)
+        if cache is None:
+            # the branches still share their prefixes within the decode
+            cache = DecoderCache()
+        for rows in self.model.infer_seq_batch_iter(self.sess, psi, seqs * samples, cache=cache, log=log):
+            for i, row in rows:
+                last[i] = row.distribution
+        return [self._create_distribution(_average(last[i::len(seqs)], log)) for i in range(len(seqs))]
+
+    def _score_paths(self, sequence, step='call'):
+        # the paths that decode a sequence, each with its targets and the position from which it
+        # is scored: the calls followed by STOP, and with step 'state', for each call the branch
+        # into its states followed by STOP (the prefix of which is scored by the path of calls)
+        calls = self._sequence_to_graph(sequence, step='call')
+        call_targets = [node for node, _ in calls[1:]] + ['STOP']
+        paths = [(calls, call_targets, 0)]
+        if step == 'state':
+            for idx, event in enumerate(sequence):
+                branch = list(_next_state(event))
+                targets = call_targets[:idx+1] + [node for node, _ in branch[1:]] + ['STOP']
+                paths.append((calls[:idx+1] + branch, targets, idx + 1))
+        elif step != 'call':
+            raise ValueError('invalid step: {}'.format(step))
+        return paths
+
+    def sequence_log_likelihoods(self, psi, sequences, step='call', cache=None, batch_size=None):
+        """
+        Log-likelihood of many sequences, scoring the decoder paths of all of them together over
+        their prefix trie, so that the prefixes they share are decoded once
+        :param step: 'call' to score the calls (and the end) of each sequence, 'state' to also
+                     score the states of each call (and their end)
+        :param batch_size: the number of prefixes to decode at a time, or None for no limit
+        :return: array with the log-likelihood of each sequence
+        """
+        scored = [self._score_paths(sequence, step) for sequence in sequences]
+        paths = [path for paths in scored for path in paths]
+        # each sample of psi scores all the paths, in the same pass
+        log_probs = self.model.score_trie(self.sess, psi, [path for path, _, _ in paths],
+                                          [targets for _, targets, _ in paths], cache=cache, batch_size=batch_size)
+        llh = np.zeros((len(psi), len(sequences)), dtype=np.float64)
+        for k, sample_log_probs in enumerate(log_probs):
+            sample_log_probs = iter(sample_log_probs)
+            for i, paths in enumerate(scored):
+                for _, _, start in paths:
+                    llh[k, i] += np.sum(next(sample_log_probs)[start:])
+        return _average(llh, True)
 
     def _create_distribution(self, dist,):
         return VectorMapping(dist, self.model.config.decoder.chars, self.model.config.decoder.vocab)
 
     def psi_random(self):
-        return np.random.normal(size=[1, self.model.config.latent_size])
+        return np.random.normal(size=[self.psi_samples, self.model.config.latent_size])
+
+    def evidence_fingerprint(self, js_evidences):
+        return self.model.evidence_fingerprint(js_evidences)
+
+    def psi_key(self, js_evidences):
+        # identifies the specifications of the evidences, as they are inferred by this predictor
+        return '{}/{}'.format(self.evidence_fingerprint(js_evidences), 'mean' if self.psi_mean else 'sample')
 
     def psi_from_evidence(self, js_evidences):
-        return self.model.infer_psi(self.sess, js_evidences)
+        return self.model.infer_psi(self.sess, js_evidences, samples=self.psi_samples, mean=self.psi_mean)
+
+    def psi_from_evidences(self, js_evidences_list):
+        psi = self.model.infer_psi_many(self.sess, js_evidences_list, samples=self.psi_samples, mean=self.psi_mean)
+        return psi.reshape([len(js_evidences_list), self.psi_samples, self.model.config.latent_size])
@@ -0,0 +1,260 @@
+# Copyright 2017 Rice University
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+from __future__ import print_function
+import argparse
+import json
+import os
+
+import numpy as np
+import tensorflow as tf
+
+from salento.models.low_level_evidences.utils import CONFIG_INFER, read_config, dump_config
+
+HELP = """Use this script to preprocess a training data file into sharded TFRecord files, which
+train.py reads (given the directory in place of the data file) with the decoding of records
+spread over parallel calls, so that data preparation overlaps with training."""
+
+# file (in the shards directory) with the number of records and the config (with the vocabs)
+# that the records were wrangled with, written last
+SHARDS_FILE = 'shards.json'
+SHARD_NAME = 'shard-{:05d}-of-{:05d}.tfrecord'
+FORMAT = 'salento-shards'
+VERSION = 1
+
+
+def is_sharded(path):
+    """
+    Whether path is a directory of shards (see write_shards) rather than a data file
+    """
+    return os.path.isdir(path) and os.path.exists(os.path.join(path, SHARDS_FILE))
+
+
+def read_shards_meta(path):
+    with open(os.path.join(path, SHARDS_FILE)) as f:
+        meta = json.load(f)
+    assert meta.get('format') == FORMAT and meta.get('version') == VERSION, \
+        'Unsupported shards format in {}'.format(path)
+    return meta
+
+
+def with_vocab(js, meta):
+    """
+    Add the vocabs that the records of a shards directory were wrangled with to a config
+    :param js: the JSON config
+    :param meta: the shards metadata, see read_shards_meta
+    :return: the JSON config with the vocabs, to be read with read_config(..., chars_vocab=True)
+    """
+    js = dict(js, decoder=dict(js['decoder']))
+    vocabs = {ev['name']: ev for ev in meta['config']['evidence']}
+    js['evidence'] = [dict(ev, **{attr: vocabs[ev['name']][attr] for attr in CONFIG_INFER})
+                      for ev in js['evidence']]
+    for attr in CONFIG_INFER:
+        js['decoder'][attr] = meta['config']['decoder'][attr]
+    return js
+
+
+def _evidence_shape(ev):
+    # the shape of a wrangled data point of the evidence
+    return list(ev.wrangle([]).shape[1:])
+
+
+def _int64_feature(values):
+    return tf.train.Feature(int64_list=tf.train.Int64List(value=values))
+
+
+def _float_feature(values):
+    return tf.train.Feature(float_list=tf.train.FloatList(value=values))
+
+
+def write_shards(reader, config, path, num_shards):
+    """
+    Write the data points of a reader as TFRecord shards, dealt round-robin so that the shards
+    are balanced. A record has the (unpadded) nodes and edges of a path, and the non-zero
+    entries of each wrangled evidence.
+    :param reader: the Reader of the data file
+    :param config: the config that the reader wrangled the data points with
+    :param path: the directory to write the shards to
+    :param num_shards: the number of shards
+    :return: the number of records written
+    """
+    if not os.path.exists(path):
+        os.makedirs(path)
+    writers = [tf.python_io.TFRecordWriter(os.path.join(path, SHARD_NAME.format(i, num_shards)))
+               for i in range(num_shards)]
+    for i, length in enumerate(reader.lengths):
+        feature = {'nodes': _int64_feature(reader.nodes[i, :length].tolist()),
+                   'edges': _int64_feature(reader.edges[i, :length].astype(np.int64).tolist())}
+        for ev, data in zip(config.evidence, reader.inputs):
+            row = data[i].reshape(-1)
+            indices = np.flatnonzero(row)
+            feature['{}/indices'.format(ev.name)] = _int64_feature(indices.tolist())
+            feature['{}/values'.format(ev.name)] = _float_feature(row[indices].astype(np.float32).tolist())
+        example = tf.train.Example(features=tf.train.Features(feature=feature))
+        writers[i % num_shards].write(example.SerializeToString())
+    for writer in writers:
+        writer.close()
+
+    meta = {'format': FORMAT, 'version': VERSION, 'records': len(reader.lengths), 'shards': num_shards,
+            'config': dump_config(config)}
+    with open(os.path.join(path, SHARDS_FILE), 'w') as f:
+        json.dump(meta, f)
+    return len(reader.lengths)
+
+
+class InputPipeline(object):
+    """
+    The training batches of a tf.data pipeline, as tensors that the model reads directly (see
+    Model) instead of placeholders fed from Python. Paths of similar lengths are batched together,
+    and each batch is padded to its longest path only. The iterator is initialized once per epoch,
+    and batches are prefetched while the model trains on the previous ones.
+    """
+    def __init__(self, dataset, config, bucket_width=4, prefetch=2, feed=None):
+        """
+        :param dataset: the dataset of (evidence inputs, nodes, edges, targets, length) data points,
+                        with unpadded paths
+        :param config: the model config
+        :param bucket_width: the range of path lengths of a bucket, or 0 to batch paths of any length
+        :param prefetch: the number of batches to prepare ahead of training
+        :param feed: the feed dict to initialize the iterator with, if any
+        """
+        shapes = [_evidence_shape(ev) for ev in config.evidence]
+        padded_shapes = (tuple(shapes), [None], [None], [None], [])
+
+        if bucket_width > 0:
+            def bucket(inputs, nodes, edges, targets, length):
+                return tf.to_int64((length - 1) // bucket_width)
+
+            def batch(key, paths):
+                return paths.padded_batch(config.batch_size, padded_shapes)
+
+            dataset = dataset.apply(tf.contrib.data.group_by_window(bucket, batch, config.batch_size))
+        else:
+            dataset = dataset.padded_batch(config.batch_size, padded_shapes)
+        # drop the incomplete batches (of each bucket), since the model is built for full batches
+        dataset = dataset.filter(lambda inputs, nodes, edges, targets, lengths:
+                                 tf.equal(tf.shape(lengths)[0], config.batch_size))
+        dataset = dataset.prefetch(prefetch)
+        self.iterator = dataset.make_initializable_iterator()
+        self.feed = feed
+        inputs, nodes, edges, targets, lengths = self.iterator.get_next()
+        for ev_inputs, shape in zip(inputs, shapes):
+            ev_inputs.set_shape([config.batch_size] + shape)
+        for tensor in [nodes, edges, targets]:
+            tensor.set_shape([config.batch_size, None])
+        lengths.set_shape([config.batch_size])
+        self.batch = (list(inputs), nodes, edges, targets, lengths)
+
+    def initialize(self, sess):
+        """
+        Start (another epoch of) the batches
+        """
+        sess.run(self.iterator.initializer, self.feed)
+
+    @classmethod
+    def from_reader(cls, reader, config, shuffle_buffer=10000, num_parallel_calls=4, bucket_width=4, prefetch=2):
+        """
+        The pipeline of the data points of a reader, which are fed (once per epoch) to placeholders
+        rather than embedded in the graph as constants
+        :param reader: the Reader of the data file
+        :param config: the model config
+        :param shuffle_buffer: the number of data points to shuffle among
+        :param num_parallel_calls: the number of data points to prepare in parallel
+        :param bucket_width: the range of path lengths of a bucket, or 0 to batch paths of any length
+        :param prefetch: the number of batches to prepare ahead of training
+        """
+        inputs = tuple(tf.placeholder(tf.float32, [None] + _evidence_shape(ev)) for ev in config.evidence)
+        nodes = tf.placeholder(tf.int32, [None, None])
+        edges = tf.placeholder(tf.bool, [None, None])
+        targets = tf.placeholder(tf.int32, [None, None])
+        lengths = tf.placeholder(tf.int32, [None])
+        dataset = tf.data.Dataset.from_tensor_slices((inputs, nodes, edges, targets, lengths))
+        dataset = dataset.shuffle(shuffle_buffer)
+        dataset = dataset.map(lambda inputs, nodes, edges, targets, length:
+                              (inputs, nodes[:length], edges[:length], targets[:length], length),
+                              num_parallel_calls=num_parallel_calls)
+        feed = {nodes: reader.nodes, edges: reader.edges, targets: reader.targets, lengths: reader.lengths}
+        feed.update(zip(inputs, reader.inputs))
+        return cls(dataset, config, bucket_width, prefetch, feed)
+
+    @classmethod
+    def from_shards(cls, path, config, shuffle_buffer=10000, num_parallel_calls=4, bucket_width=4, prefetch=2):
+        """
+        The pipeline of the records in a shards directory (see write_shards), read from several
+        shards at a time and decoded in parallel calls. Paths longer than the max_seq_length of
+        the config are skipped.
+        :param path: the shards directory
+        :param config: the model config, with the vocabs of the shards (see with_vocab)
+        :param shuffle_buffer: the number of records to shuffle among
+        :param num_parallel_calls: the number of records to decode in parallel
+        :param bucket_width: the range of path lengths of a bucket, or 0 to batch paths of any length
+        :param prefetch: the number of batches to prepare ahead of training
+        """
+        meta = read_shards_meta(path)
+        files = [os.path.join(path, SHARD_NAME.format(i, meta['shards'])) for i in range(meta['shards'])]
+        max_seq_length = config.decoder.max_seq_length
+        shapes = [_evidence_shape(ev) for ev in config.evidence]
+
+        def decode(record):
+            features = {'nodes': tf.VarLenFeature(tf.int64), 'edges': tf.VarLenFeature(tf.int64)}
+            for ev in config.evidence:
+                features['{}/indices'.format(ev.name)] = tf.VarLenFeature(tf.int64)
+                features['{}/values'.format(ev.name)] = tf.VarLenFeature(tf.float32)
+            parsed = tf.parse_single_example(record, features)
+
+            inputs = []
+            for ev, shape in zip(config.evidence, shapes):
+                indices = tf.sparse_tensor_to_dense(parsed['{}/indices'.format(ev.name)])
+                values = tf.sparse_tensor_to_dense(parsed['{}/values'.format(ev.name)])
+                dense = tf.scatter_nd(tf.expand_dims(indices, 1), values,
+                                      tf.constant([int(np.prod(shape))], dtype=tf.int64))
+                inputs.append(tf.reshape(dense, shape))
+
+            # the targets of a path are its nodes shifted left by one
+            nodes = tf.cast(tf.sparse_tensor_to_dense(parsed['nodes']), tf.int32)
+            edges = tf.cast(tf.sparse_tensor_to_dense(parsed['edges']), tf.bool)
+            targets = tf.concat([nodes[1:], [0]], axis=0)
+            return tuple(inputs), nodes, edges, targets, tf.shape(nodes)[0]
+
+        dataset = tf.data.Dataset.from_tensor_slices(files).shuffle(len(files))
+        dataset = dataset.interleave(tf.data.TFRecordDataset, cycle_length=min(len(files), num_parallel_calls))
+        dataset = dataset.shuffle(shuffle_buffer)
+        dataset = dataset.map(decode, num_parallel_calls=num_parallel_calls)
+        dataset = dataset.filter(lambda inputs, nodes, edges, targets, length: length <= max_seq_length)
+        return cls(dataset, config, bucket_width, prefetch)
+
+
+if __name__ == '__main__':
+    from salento.models.low_level_evidences.data_reader import Reader
+    parser = argparse.ArgumentParser(formatter_class=argparse.RawDescriptionHelpFormatter,
+                                     description=HELP)
+    parser.add_argument('input_file', type=str, nargs=1,
+                        help='input data file')
+    parser.add_argument('output_dir', type=str,
+                        help='directory to write the shards to')
+    parser.add_argument('--num_shards', type=int, default=8,
+                        help='number of shards')
+    parser.add_argument('--config', type=str, default=os.path.join(os.path.dirname(__file__), 'config.json'),
+                        help='config file (see train.py for help)')
+    parser.add_argument('--continue_from', type=str, default=None,
+                        help='use the vocabs of the model checkpointed here, to continue training it')
+    clargs = parser.parse_args()
+    config_file = clargs.config if clargs.continue_from is None \
+        else os.path.join(clargs.continue_from, 'config.json')
+    with open(config_file) as f:
+        config = read_config(json.load(f), chars_vocab=clargs.continue_from)
+    reader = Reader(clargs, config)
+    print('Writing {} shards...'.format(clargs.num_shards), end='', flush=True)
+    n = write_shards(reader, config, clargs.output_dir, clargs.num_shards)
+    print('done, {} records'.format(n))
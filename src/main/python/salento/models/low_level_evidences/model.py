@@ -13,26 +13,269 @@
 # limitations under the License.
 
 import tensorflow as tf
-from tensorflow.contrib import legacy_seq2seq as seq2seq
 import numpy as np
-from collections import namedtuple
+from collections import namedtuple, OrderedDict
 
 from salento.models.low_level_evidences.architecture import BayesianEncoder, BayesianDecoder
 from salento.models.low_level_evidences.data_reader import CHILD_EDGE, SIBLING_EDGE
+from salento.models.low_level_evidences.utils import batch_size
+from salento.models.low_level_evidences.cache import token_id, fingerprint
 
 Row = namedtuple('Row', ['node', 'edge', 'distribution', 'state', 'cache_id'])
 
-class Model():
-    def __init__(self, config, infer=False):
+class Inference(object):
+    """
+    The inference logic shared by the backends, which provide sample_psi, infer_initial_state,
+    infer_batch_step and infer_projection
+    """
+
+    def wrangle_evidences(self, programs):
+        """
+        Read and wrangle the evidences of programs into the inputs of the encoder
+        """
+        return [ev.wrangle([ev.read_data_point(program) for program in programs]) for ev in self.config.evidence]
+
+    def evidence_fingerprint(self, evidences):
+        """
+        A digest of the encoder inputs for the given evidences. Evidences with the same
+        fingerprint have the same distribution of latent specifications.
+        """
+        return fingerprint(*self.wrangle_evidences([evidences]))
+
+    def infer_psi(self, sess, evidences, samples=1, mean=False):
+        return self.infer_psi_many(sess, [evidences], samples=samples, mean=mean)
+
+    def infer_psi_many(self, sess, programs, chunk_size=1024, samples=1, mean=False):
+        """
+        Sample the latent specifications of many programs, encoding chunk_size of them at a time
+        :param programs: the list of programs (e.g., packages) with evidences
+        :param samples: the number of specifications to sample for each program
+        :param mean: if True, use the mean of the distribution of specifications instead of sampling
+        :return: array of shape (len(programs) * samples, latent_size) with the specifications of each
+                 program next to each other
+        """
+        psi = []
+        for i in range(0, len(programs), chunk_size):
+            inputs = self.wrangle_evidences(programs[i:i+chunk_size])
+            psi.append(self.sample_psi(sess, [np.repeat(inp, samples, axis=0) for inp in inputs], mean))
+        if len(psi) == 0:
+            return np.zeros((0, self.config.latent_size), dtype=np.float32)
+        return np.concatenate(psi)
+
+    def infer_seq(self, sess, psi, seq, cache=None, resume=None, log=False):
+        dist = {}
+        for step in self.infer_seq_iter(sess, psi, seq, cache, resume, log=log):
+            dist = step.distribution
+        return dist
+
+    def infer_seq_iter(self, sess, psi, seq, cache=None, resume=None, targets=None, log=False):
+        """
+        Decode a sequence of (node, edge) one step at a time
+        :param resume: the Row of an earlier decoding to continue from, instead of the start from psi
+        :param targets: if given, the node expected after each step. The distribution of each Row is
+                        then only the log-probability of its target, the full distribution is never
+                        fetched.
+        :param log: if True, the distribution of each Row is a log-distribution
+        :return: an iterator that yields the Row of each step
+        """
+        if resume is None:
+            # use the given psi and get decoder's start state
+            state = self.infer_initial_state(sess, psi)[0]
+            path = cache.scope(psi) if cache is not None else None
+        else:
+            state = resume.state
+            path = resume.cache_id
+
+        targets = None if targets is None else [list(targets)]
+        for rows in self._decode(sess, [state], [path], [list(seq)], cache, targets, log):
+            yield rows[0][1]
+
+    def infer_seq_batch_iter(self, sess, psi, seqs, cache=None, targets=None, log=False):
+        """
+        Decode many sequences in lockstep, running one step of all unfinished sequences at once
+        :param psi: the latent specification, either a single one (1, latent_size) shared by all
+                    sequences or one per sequence (len(seqs), latent_size)
+        :param seqs: the list of sequences of (node, edge) to decode
+        :param cache: the DecoderCache of decoder steps, shared with infer_seq_iter
+        :param targets: if given, the list of targets of each sequence (see infer_seq_iter)
+        :param log: if True, rows hold log-distributions
+        :return: an iterator that yields at each step the list of (index in seqs, Row) of
+                 the sequences that are not finished yet
+        """
+        states = self.infer_initial_state(sess, psi)
+        paths = [cache.scope(psi[i:i+1]) if cache is not None else None for i in range(len(psi))]
+        if len(states) == 1:
+            states, paths = states * len(seqs), paths * len(seqs)
+        return self._decode(sess, states, paths, seqs, cache, targets, log)
+
+    def _decode(self, sess, states, paths, seqs, cache, targets, log):
+        vocab = self.config.decoder.vocab
+        states, paths = list(states), list(paths)
+        for t in range(max([len(seq) for seq in seqs] + [0])):
+            active = [i for i, seq in enumerate(seqs) if t < len(seq)]
+            values = {}
+            # sequences at the same trie node (and with the same target) share one computation, which
+            # is only a projection for the nodes whose state is restored from the cache's store
+            pending, restored, stored = OrderedDict(), OrderedDict(), {}
+            for i in active:
+                node, edge = seqs[i][t]
+                assert edge == CHILD_EDGE or edge == SIBLING_EDGE, 'invalid edge: {}'.format(edge)
+                target = None if targets is None else vocab[targets[i][t]]
+                if cache is None:
+                    pending[i] = [i]
+                    continue
+                paths[i] = cache.child(paths[i], token_id(vocab[node], edge))
+                key = (paths[i], target)
+                if key in pending or key in restored:
+                    (pending if key in pending else restored)[key].append(i)
+                    continue
+                cached = cache.get(paths[i], target)
+                if cached is not None:
+                    values[i], states[i] = cached
+                    continue
+                state = cache.stored_state(paths[i])
+                if state is not None:
+                    restored[key], stored[key] = [i], state
+                else:
+                    pending[key] = [i]
+
+            if len(restored) > 0:
+                first = [group[0] for group in restored.values()]
+                step_values = self.infer_projection(
+                    sess, [stored[key] for key in restored],
+                    None if targets is None else [targets[i][t] for i in first])
+                for key, value in zip(restored, step_values):
+                    for i in restored[key]:
+                        values[i], states[i] = value, stored[key]
+                    cache.put(key[0], value, stored[key], key[1])
+
+            if len(pending) > 0:
+                first = [group[0] for group in pending.values()]
+                step_values, step_states = self.infer_batch_step(
+                    sess, [states[i] for i in first], [seqs[i][t][0] for i in first],
+                    [seqs[i][t][1] for i in first], None if targets is None else [targets[i][t] for i in first])
+                for key, value, state in zip(pending, step_values, step_states):
+                    for i in pending[key]:
+                        values[i], states[i] = value, state
+                    if cache is not None:
+                        cache.put(key[0], value, state, key[1])
+
+            yield [(i, Row(node=seqs[i][t][0], edge=seqs[i][t][1],
+                           distribution=values[i] if log or targets is not None else np.exp(values[i]),
+                           state=states[i], cache_id=paths[i])) for i in active]
+
+    def score_trie(self, sess, psi, paths, targets, cache=None, batch_size=None):
+        """
+        Score whole paths, the log-probability of the target after each (node, edge) of each path,
+        over the prefix trie of the paths: each prefix is decoded once, whatever the number of paths
+        that share it, and all the targets wanted after it are read off its log-distribution. The
+        trie is decoded breadth-first, a batched step per level (of at most batch_size rows).
+        :param psi: the latent specifications (samples, latent_size), each of which scores all paths
+        :param paths: the list of paths of (node, edge)
+        :param targets: for each path, the list of nodes expected after each of its steps
+        :param cache: the DecoderCache of decoder steps, to reuse (and keep) the steps of the prefixes
+        :param batch_size: the number of rows to decode at a time, or None for a whole level at once
+        :return: list with, for each sample of psi, a list with an array of log-probabilities for each path
+        """
+        vocab = self.config.decoder.vocab
+        # the prefixes of the paths, node 0 being the empty prefix
+        children, parents, tokens = [{}], [None], [None]
+        path_nodes = []
+        for path in paths:
+            node, nodes = 0, []
+            for name, edge in path:
+                assert edge == CHILD_EDGE or edge == SIBLING_EDGE, 'invalid edge: {}'.format(edge)
+                child = children[node].get((name, edge))
+                if child is None:
+                    child = children[node][(name, edge)] = len(children)
+                    children.append({})
+                    parents.append(node)
+                    tokens.append((name, edge))
+                nodes.append(child)
+                node = child
+            path_nodes.append(nodes)
+        # the targets wanted after each prefix, and their columns in its gathered log-probabilities
+        wanted = [OrderedDict() for _ in children]
+        for nodes, target in zip(path_nodes, targets):
+            for node, name in zip(nodes, target):
+                wanted[node].setdefault(vocab[name], len(wanted[node]))
+
+        samples = len(psi)
+        states = dict(((k, 0), state) for k, state in enumerate(self.infer_initial_state(sess, psi)))
+        cache_nodes = {(k, 0): cache.scope(psi[k:k+1]) for k in range(samples)} if cache is not None else None
+        values = {}
+        level = list(children[0].values())
+        while len(level) > 0:
+            rows = [(k, node) for k in range(samples) for node in level]
+            step = batch_size or len(rows)
+            for start in range(0, len(rows), step):
+                self._decode_trie_rows(sess, rows[start:start + step], parents, tokens, wanted, states, values,
+                                       cache, cache_nodes)
+            # the states of the parents are not needed anymore
+            for node in set(parents[node] for node in level):
+                for k in range(samples):
+                    states.pop((k, node), None)
+                    if cache_nodes is not None:
+                        cache_nodes.pop((k, node), None)
+            level = [child for node in level for child in children[node].values()]
+
+        return [[np.array([values[(k, node)][wanted[node][vocab[name]]] for node, name in zip(nodes, target)])
+                 for nodes, target in zip(path_nodes, targets)] for k in range(samples)]
+
+    def _decode_trie_rows(self, sess, rows, parents, tokens, wanted, states, values, cache, cache_nodes):
+        # decode the (sample, trie node) rows from the states of their parents, which may be cached
+        # (or restored from the cache's store, then only projected)
+        vocab = self.config.decoder.vocab
+        pending, restored = [], []
+        for row in rows:
+            k, node = row
+            if cache is not None:
+                name, edge = tokens[node]
+                cache_node = cache_nodes[row] = cache.child(cache_nodes[(k, parents[node])],
+                                                            token_id(vocab[name], edge))
+                cached = cache.get(cache_node)
+                if cached is not None:
+                    log_dist, states[row] = cached
+                    values[row] = log_dist[list(wanted[node])]
+                    continue
+                state = cache.stored_state(cache_node)
+                if state is not None:
+                    states[row] = state
+                    restored.append(row)
+                    continue
+            pending.append(row)
+
+        if len(restored) > 0:
+            log_dists = self.infer_projection(sess, [states[row] for row in restored])
+            for row, log_dist in zip(restored, log_dists):
+                values[row] = log_dist[list(wanted[row[1]])]
+                cache.put(cache_nodes[row], log_dist, states[row])
+
+        if len(pending) > 0:
+            log_dists, step_states = self.infer_batch_step(
+                sess, [states[(k, parents[node])] for k, node in pending], [tokens[node][0] for _, node in pending],
+                [tokens[node][1] for _, node in pending])
+            for row, log_dist, state in zip(pending, log_dists, step_states):
+                values[row], states[row] = log_dist[list(wanted[row[1]])], state
+                if cache is not None:
+                    cache.put(cache_nodes[row], log_dist, state)
+
+
+class Model(Inference):
+    def __init__(self, config, infer=False, inputs=None):
         assert config.model == 'lle', 'Trying to load different model implementation: ' + config.model
         self.config = config
+        # train on the batch tensors (evidence inputs, nodes, edges, targets, lengths) of an input
+        # pipeline (see input_pipeline.py), or on placeholders to feed
+        ev_inputs, nodes, edges, targets, lengths = inputs if inputs is not None else (None,) * 5
         if infer:
-            config.batch_size = 1
+            # leave the batch open so that many sequences can be decoded in lockstep
+            config.batch_size = None
             config.decoder.max_seq_length = 1
 
         # setup the encoder
-        self.encoder = BayesianEncoder(config)
-        samples = tf.random_normal([config.batch_size, config.latent_size],
+        self.encoder = BayesianEncoder(config, ev_inputs)
+        samples = tf.random_normal([batch_size(config, self.encoder.psi_mean), config.latent_size],
                                    mean=0., stddev=1., dtype=tf.float32)
         self.psi = self.encoder.psi_mean + tf.sqrt(self.encoder.psi_covariance) * samples
 
@@ -40,18 +283,32 @@ class Model():
         lift_w = tf.get_variable('lift_w', [config.latent_size, config.decoder.units])
         lift_b = tf.get_variable('lift_b', [config.decoder.units])
         self.initial_state = tf.nn.xw_plus_b(self.psi, lift_w, lift_b)
-        self.decoder = BayesianDecoder(config, initial_state=self.initial_state, infer=infer)
+        self.decoder = BayesianDecoder(config, initial_state=self.initial_state, infer=infer,
+                                       nodes=nodes, edges=edges)
 
         # get the decoder outputs
-        output = tf.reshape(tf.concat(self.decoder.outputs, 1),
-                            [-1, self.decoder.cell1.output_size])
+        output = tf.reshape(self.decoder.outputs, [-1, self.decoder.cell1.output_size])
         logits = tf.matmul(output, self.decoder.projection_w) + self.decoder.projection_b
+        self.output = output
         self.probs = tf.nn.softmax(logits)
 
-        # 1. generation loss: log P(X | \Psi)
-        self.targets = tf.placeholder(tf.int32, [config.batch_size, config.decoder.max_seq_length])
-        self.gen_loss = seq2seq.sequence_loss([logits], [tf.reshape(self.targets, [-1])],
-                                              [tf.ones([config.batch_size * config.decoder.max_seq_length])])
+        if infer:
+            # log-space outputs, and the log-probability of a given target only
+            self.log_probs = tf.nn.log_softmax(logits)
+            self.infer_targets = tf.placeholder(tf.int32, [None], name='infer_targets')
+            self.target_log_probs = -tf.nn.sparse_softmax_cross_entropy_with_logits(
+                labels=self.infer_targets, logits=logits)
+
+        # 1. generation loss: log P(X | \Psi), averaged over the targets within the length of each
+        # path (the last node of a path has no target), so that padding does not count
+        self.targets = targets if targets is not None else \
+            tf.placeholder(tf.int32, [config.batch_size, None], name='targets')
+        self.lengths = lengths if lengths is not None else \
+            tf.placeholder(tf.int32, [config.batch_size], name='lengths')
+        mask = tf.reshape(tf.sequence_mask(self.lengths - 1, tf.shape(self.targets)[1], dtype=tf.float32), [-1])
+        gen_loss = tf.nn.sparse_softmax_cross_entropy_with_logits(labels=tf.reshape(self.targets, [-1]),
+                                                                  logits=logits)
+        self.gen_loss = tf.reduce_sum(gen_loss * mask) / tf.maximum(tf.reduce_sum(mask), 1.)
 
         # 2. latent loss: KL-divergence between P(\Psi | f(\Theta)) and P(\Psi)
         latent_loss = 0.5 * tf.reduce_sum(- tf.log(self.encoder.psi_covariance)
@@ -74,55 +331,61 @@ class Model():
         if not infer:
             print('Model parameters: {}'.format(np.sum(var_params)))
 
-    def infer_psi(self, sess, evidences):
-        # read and wrangle (with batch_size 1) the data
-        inputs = [ev.wrangle([ev.read_data_point(evidences)]) for ev in self.config.evidence]
-
-        # setup initial states and feed
+    def sample_psi(self, sess, inputs, mean=False):
+        """
+        Sample latent specifications from wrangled encoder inputs, in a single session run
+        :param mean: if True, get the means of the specifications instead of samples
+        """
         feed = {}
         for j, ev in enumerate(self.config.evidence):
             feed[self.encoder.inputs[j].name] = inputs[j]
-        psi = sess.run(self.psi, feed)
-        return psi
+        return sess.run(self.encoder.psi_mean if mean else self.psi, feed)
 
-    def infer_seq(self, sess, psi, seq, cache=None, resume=None):
-        dist = {}
-        path = ""
-        for step in self.infer_seq_iter(sess, psi, seq, cache, resume):
-            dist = step.distribution
-            path = step.cache_id
-        return dist
+    def infer_initial_state(self, sess, psi):
+        """
+        Get the decoder's start state for each given latent specification
+        :param psi: the latent specifications, of shape (n, latent_size)
+        :return: list of n decoder states
+        """
+        lifted = sess.run(self.initial_state, {self.psi: psi})
+        return [[lifted[i:i+1]] * self.config.decoder.num_layers for i in range(len(lifted))]
 
-    def infer_seq_iter(self, sess, psi, seq, cache=None, resume=None):
-        if resume is None:
-            # use the given psi and get decoder's start state
-            state = sess.run(self.initial_state, {self.psi: psi})
-            state = [state] * self.config.decoder.num_layers
-            path = ""
+    def infer_batch_step(self, sess, states, nodes, edges, targets=None):
+        """
+        Advance n independent decoder states by one (node, edge) each, in a single session run
+        :param states: list of n decoder states
+        :param nodes: list of n nodes
+        :param edges: list of n edges
+        :param targets: if given, list of n nodes to get the log-probability of
+        :return: tuple of the (n, vocab_size) array of log-distributions (or with targets, the n
+                 log-probabilities of the targets) and the list of n new decoder states
+        """
+        vocab = self.config.decoder.vocab
+        n = np.array([vocab[node] for node in nodes], dtype=np.int32)
+        e = np.array([edge == CHILD_EDGE for edge in edges], dtype=np.bool)
+        feed = {self.decoder.nodes[0].name: n,
+                self.decoder.edges[0].name: e}
+        for i in range(self.config.decoder.num_layers):
+            feed[self.decoder.initial_state[i].name] = np.concatenate([state[i] for state in states])
+        if targets is None:
+            output = self.log_probs
         else:
-            state = resume.state
-            path = resume.cache_id
-
-        for node, edge in seq:
-            assert edge == CHILD_EDGE or edge == SIBLING_EDGE, 'invalid edge: {}'.format(edge)
-            if cache is not None:
-                path += "/{}/{}".format(node, edge)
-            if cache is not None and path in cache:
-                dist, state = cache[path]
-            else:
-                dist, state = self._infer_seq_step(sess, state, node, edge)
-                if cache is not None:
-                    cache[path] = (dist, state)
-            yield Row(node=node, edge=edge, distribution=dist, state=state, cache_id=path)
-
-    def _infer_seq_step(self, sess, state, node, edge):
-            n = np.array([self.config.decoder.vocab[node]], dtype=np.int32)
-            e = np.array([edge == CHILD_EDGE], dtype=np.bool)
-            feed = {self.decoder.nodes[0].name: n,
-                    self.decoder.edges[0].name: e}
-            for i in range(self.config.decoder.num_layers):
-                feed[self.decoder.initial_state[i].name] = state[i]
-            (probs, state) = sess.run([self.probs, self.decoder.state], feed)
-            return probs[0], state
-
+            output = self.target_log_probs
+            feed[self.infer_targets] = np.array([vocab[target] for target in targets], dtype=np.int32)
+        (values, state) = sess.run([output, self.decoder.state], feed)
+        return values, [[layer[j:j+1] for layer in state] for j in range(len(states))]
 
+    def infer_projection(self, sess, states, targets=None):
+        """
+        Get the outputs of the steps that led to n decoder states, from the states alone (the output
+        of a step is the state of its last layer)
+        :param states: list of n decoder states
+        :param targets: if given, list of n nodes to get the log-probability of
+        :return: the (n, vocab_size) array of log-distributions, or with targets, the n log-probabilities
+        """
+        feed = {self.output: np.concatenate([state[-1] for state in states])}
+        if targets is None:
+            return sess.run(self.log_probs, feed)
+        vocab = self.config.decoder.vocab
+        feed[self.infer_targets] = np.array([vocab[target] for target in targets], dtype=np.int32)
+        return sess.run(self.target_log_probs, feed)
@@ -0,0 +1,155 @@
+# Copyright 2017 Rice University
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import re
+import numpy as np
+
+from salento.models.low_level_evidences.model import Inference
+from salento.models.low_level_evidences.utils import CHILD_EDGE
+
+# file (in the model directory) that the exported weights are saved to
+WEIGHTS_FILE = 'model.npz'
+
+
+class CheckpointVariables(object):
+    """
+    Look up the variables of a checkpoint by (regex) name, ignoring the optimizer's slots
+    """
+    def __init__(self, reader):
+        self.reader = reader
+        self.names = [name for name in reader.get_variable_to_shape_map()
+                      if re.search(r'/Adam(_\d+)?$', name) is None]
+
+    def find(self, pattern):
+        return {name: self.reader.get_tensor(name) for name in self.names if re.search(pattern, name)}
+
+    def get(self, pattern):
+        found = self.find(pattern)
+        assert len(found) == 1, 'Expected one variable matching {}, found {}'.format(pattern, sorted(found))
+        return list(found.values())[0]
+
+
+def export_weights(reader, config):
+    """
+    Pull the weights needed for inference out of a checkpoint
+    :param reader: the checkpoint reader (tf.train.NewCheckpointReader)
+    :param config: the model config
+    :return: dictionary of weight name to numpy array, as expected by NumpyModel
+    """
+    variables = CheckpointVariables(reader)
+    weights = {'lift_w': variables.get(r'^lift_w$'),
+               'lift_b': variables.get(r'^lift_b$'),
+               'emb': variables.get(r'^decoder/emb$'),
+               'projection_w': variables.get(r'^projection_w$'),
+               'projection_b': variables.get(r'^projection_b$')}
+    for cell in ['cell1', 'cell2']:
+        for i in range(config.decoder.num_layers):
+            for part in ['gates', 'candidate']:
+                prefix = r'^decoder/rnn/{}/.*cell_{}/.*{}/'.format(cell, i, part)
+                key = '{}/{}/{}'.format(cell, i, part)
+                weights[key + '/kernel'] = variables.get(prefix + '(kernel|weights)$')
+                weights[key + '/bias'] = variables.get(prefix + '(bias|biases)$')
+    for ev in config.evidence:
+        weights.update(ev.export_weights(variables))
+    return weights
+
+
+def _sigmoid(x):
+    return 1. / (1. + np.exp(-x))
+
+
+def _log_softmax(x):
+    x = x - np.max(x, axis=1, keepdims=True)
+    return x - np.log(np.sum(np.exp(x), axis=1, keepdims=True))
+
+
+class NumpyModel(Inference):
+    """
+    Inference-only counterpart of Model that runs on weights exported from a checkpoint
+    (see export.py) without a TF session. The sess arguments are accepted and ignored.
+    """
+    def __init__(self, config, weights_file):
+        assert config.model == 'lle', 'Trying to load different model implementation: ' + config.model
+        self.config = config
+        with np.load(weights_file) as f:
+            self.weights = {k: f[k] for k in f.files}
+
+    def _encode(self, inputs):
+        w = self.weights
+        d = np.ones(len(inputs[0]), dtype=np.float32)
+        encodings = []
+        for ev, inp in zip(self.config.evidence, inputs):
+            sigma_sq = np.square(w['{}/sigma'.format(ev.name)])
+            exists = ev.np_exists(inp)
+            d += np.where(exists, 1. / sigma_sq, 0.).astype(np.float32)
+            encoding = ev.np_encode(inp, w, self.config) / sigma_sq
+            encodings += [np.where(exists[:, None], encoding, 0.).astype(np.float32)] * ev.tile
+        psi_mean = np.sum(np.stack(encodings), axis=0) / d[:, None]
+        psi_covariance = np.ones_like(psi_mean) / d[:, None]
+        return psi_mean, psi_covariance
+
+    def sample_psi(self, sess, inputs, mean=False):
+        psi_mean, psi_covariance = self._encode(inputs)
+        if mean:
+            return psi_mean
+        samples = np.random.normal(size=psi_mean.shape).astype(np.float32)
+        return psi_mean + np.sqrt(psi_covariance) * samples
+
+    def infer_initial_state(self, sess, psi):
+        lifted = np.dot(psi, self.weights['lift_w']) + self.weights['lift_b']
+        return [[lifted[i:i+1]] * self.config.decoder.num_layers for i in range(len(lifted))]
+
+    def _gru(self, key, inp, state):
+        w = self.weights
+        gates = _sigmoid(np.dot(np.concatenate([inp, state], axis=1), w[key + '/gates/kernel'])
+                         + w[key + '/gates/bias'])
+        r, u = np.split(gates, 2, axis=1)
+        c = np.tanh(np.dot(np.concatenate([inp, r * state], axis=1), w[key + '/candidate/kernel'])
+                    + w[key + '/candidate/bias'])
+        return u * state + (1 - u) * c
+
+    def _multi_cell(self, cell, inp, state):
+        new_state = []
+        for i in range(self.config.decoder.num_layers):
+            inp = self._gru('{}/{}'.format(cell, i), inp, state[i])
+            new_state.append(inp)
+        return inp, new_state
+
+    def infer_batch_step(self, sess, states, nodes, edges, targets=None):
+        ids = np.array([self.config.decoder.vocab[node] for node in nodes], dtype=np.int32)
+        child = np.array([edge == CHILD_EDGE for edge in edges], dtype=np.bool)
+        inp = self.weights['emb'][ids]
+        state = [np.concatenate([s[i] for s in states]) for i in range(self.config.decoder.num_layers)]
+
+        # each row only goes through the cell of its edge
+        output = np.zeros((len(ids), self.config.decoder.units), dtype=np.float32)
+        new_state = [np.zeros_like(layer) for layer in state]
+        for cell, rows in [('cell1', child), ('cell2', ~child)]:
+            if not np.any(rows):
+                continue
+            out, st = self._multi_cell(cell, inp[rows], [layer[rows] for layer in state])
+            output[rows] = out
+            for layer, s in zip(new_state, st):
+                layer[rows] = s
+
+        return self._project(output, targets), [[layer[j:j+1] for layer in new_state] for j in range(len(states))]
+
+    def infer_projection(self, sess, states, targets=None):
+        return self._project(np.concatenate([state[-1] for state in states]), targets)
+
+    def _project(self, output, targets):
+        log_probs = _log_softmax(np.dot(output, self.weights['projection_w']) + self.weights['projection_b'])
+        if targets is not None:
+            log_probs = log_probs[np.arange(len(output)), [self.config.decoder.vocab[t] for t in targets]]
+        return log_probs
@@ -0,0 +1,215 @@
+# Copyright 2017 Rice University
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import fcntl
+import hashlib
+import os
+import re
+import tempfile
+
+import numpy as np
+
+_KEY_BYTES = 40
+
+
+def store_key(*parts):
+    """
+    The key of a store entry, a digest of the given (string or int) parts
+    """
+    digest = hashlib.sha1()
+    for part in parts:
+        digest.update('{}/'.format(part).encode('utf-8'))
+    return digest.hexdigest().encode('ascii')
+
+
+def file_digest(paths):
+    """
+    A digest of the contents of the given files, e.g., of a model checkpoint
+    """
+    digest = hashlib.sha1()
+    for path in sorted(paths):
+        with open(path, 'rb') as f:
+            for block in iter(lambda: f.read(2**20), b''):
+                digest.update(block)
+    return digest.hexdigest()
+
+
+class ArrayTable(object):
+    """
+    A persistent map from keys (see store_key) to float32 rows of a fixed width, kept in segments:
+    .npy files of (key, row) records sorted by key, which are memory-mapped (so processes that open
+    the same table share their pages) and searched with np.searchsorted. New rows are kept in memory
+    until flush, which happens once they take up flush_bytes. A flush writes the new rows as a new
+    segment, and then merges the newest segments while they are of similar sizes, so that there
+    are a logarithmic number of segments and a row is rewritten a logarithmic number of times.
+    Flushes take turns under a lock so that concurrent writers do not lose each other's rows, and
+    segments are replaced atomically. Processes that mapped the old segments keep reading them
+    until they reopen the table.
+    """
+    def __init__(self, path, width, flush_bytes=2**26):
+        """
+        :param path: the path of the table; the segments are named after it (e.g., states.12.npy
+                     for states.npy), and a table file at the path itself is read as the oldest segment
+        :param width: the width of the rows
+        :param flush_bytes: the memory taken by new rows at which they are flushed
+        """
+        self.path = path
+        self.dtype = np.dtype([('key', 'S{}'.format(_KEY_BYTES)), ('row', np.float32, (width,))])
+        self.max_new = max(1, flush_bytes // self.dtype.itemsize)
+        self._new = {}
+        self._load()
+
+    def _segment_path(self, number):
+        prefix, ext = os.path.splitext(self.path)
+        return '{}.{}{}'.format(prefix, number, ext)
+
+    def _segment_numbers(self):
+        # the numbers of the segments, oldest first, 0 being the table file at the path itself
+        prefix, ext = os.path.splitext(os.path.basename(self.path))
+        pattern = re.compile(re.escape(prefix) + r'\.(\d+)' + re.escape(ext) + '$')
+        names = os.listdir(os.path.dirname(self.path) or '.')
+        numbers = sorted(int(m.group(1)) for m in map(pattern.match, names) if m is not None)
+        return ([0] if os.path.exists(self.path) else []) + numbers
+
+    def _load(self):
+        while True:
+            try:
+                self._segments = [(number, np.load(self._segment_path(number) if number > 0 else self.path,
+                                                   mmap_mode='r'))
+                                  for number in self._segment_numbers()]
+                break
+            except FileNotFoundError:
+                # a segment was merged away while listing them, list them again
+                continue
+        for _, data in self._segments:
+            assert data.dtype == self.dtype, 'Table {} has a different layout'.format(self.path)
+
+    def _find(self, key):
+        # the newest segments first
+        for _, data in reversed(self._segments):
+            keys = data['key']
+            i = np.searchsorted(keys, key)
+            if i < len(keys) and keys[i] == key:
+                return data['row'][i]
+        return None
+
+    def get(self, key):
+        """
+        :return: the row stored for key, or None
+        """
+        row = self._new.get(key)
+        return row if row is not None else self._find(key)
+
+    def put(self, key, row):
+        if key not in self._new and self._find(key) is None:
+            self._new[key] = np.asarray(row, dtype=np.float32)
+            if len(self._new) >= self.max_new:
+                self.flush()
+
+    def flush(self):
+        if len(self._new) == 0:
+            # only pick up the rows that other processes flushed
+            self._load()
+            return
+        # writers (e.g., worker processes of an aggregator) take turns to add their rows
+        with open(self.path + '.lock', 'w') as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            self._load()
+            keys = sorted(key for key in self._new if self._find(key) is None)
+            if len(keys) > 0:
+                data = np.zeros(len(keys), dtype=self.dtype)
+                data['key'] = keys
+                data['row'] = [self._new[key] for key in keys]
+                number = self._segments[-1][0] + 1 if len(self._segments) > 0 else 1
+                self._write(number, data)
+                self._segments.append((number, data))
+                self._merge()
+            self._new = {}
+            self._load()
+
+    def _merge(self):
+        # merge the two newest segments while the newer is at least half the size of the older
+        while len(self._segments) > 1 and 2 * len(self._segments[-1][1]) >= len(self._segments[-2][1]):
+            (older, older_data), (newer, newer_data) = self._segments[-2:]
+            data = np.concatenate([older_data, newer_data])
+            _, unique = np.unique(data['key'], return_index=True)
+            self._write(newer, data[unique])
+            os.remove(self._segment_path(older) if older > 0 else self.path)
+            self._segments[-2:] = [(newer, data[unique])]
+
+    def _write(self, number, data):
+        fd, tmp = tempfile.mkstemp(dir=os.path.dirname(self.path) or '.', suffix='.npy')
+        with os.fdopen(fd, 'wb') as f:
+            np.save(f, data)
+        os.replace(tmp, self._segment_path(number))
+
+    def __len__(self):
+        return sum(len(data) for _, data in self._segments) + len(self._new)
+
+
+class ModelStore(object):
+    """
+    Persistent store of the results of a model, in a directory per model digest (so that a
+    retrained model never sees old results): the latent specifications inferred for evidences,
+    and the decoder state after each prefix of (node, edge) inputs from a latent specification.
+    The distribution after a prefix is not stored since it is only a projection of the state.
+    Several processes can share a store.
+    """
+    def __init__(self, directory, model_digest, config, readonly=False):
+        """
+        :param directory: the directory of stores
+        :param model_digest: the digest of the model, see BayesianPredictor.model_digest
+        :param config: the model config
+        :param readonly: if True, never write to the store
+        """
+        self.directory = os.path.join(directory, model_digest)
+        if not readonly and not os.path.exists(self.directory):
+            os.makedirs(self.directory)
+        self.readonly = readonly
+        self.num_layers = config.decoder.num_layers
+        self.psi = ArrayTable(os.path.join(self.directory, 'psi.npy'), config.latent_size)
+        self.states = ArrayTable(os.path.join(self.directory, 'states.npy'),
+                                 config.decoder.num_layers * config.decoder.units)
+
+    def get_psi(self, key, samples=1):
+        """
+        :param key: the key of the specifications of evidences, see BayesianPredictor.psi_key
+        :param samples: the number of specifications
+        :return: the (samples, latent_size) specifications stored for key, or None
+        """
+        rows = [self.psi.get(store_key(key, i)) for i in range(samples)]
+        return None if any(row is None for row in rows) else np.array(rows)
+
+    def put_psi(self, key, psi):
+        for i, row in enumerate(psi):
+            self.psi.put(store_key(key, i), row)
+
+    def get_state(self, prefix):
+        """
+        :param prefix: the prefix, the fingerprint of its latent specification followed by its token ids
+        :return: the decoder state after the prefix, or None
+        """
+        row = self.states.get(store_key(*prefix))
+        return None if row is None else np.split(np.array(row[None]), self.num_layers, axis=1)
+
+    def put_state(self, prefix, state):
+        self.states.put(store_key(*prefix), np.concatenate(state, axis=1)[0])
+
+    def flush(self):
+        if not self.readonly:
+            self.psi.flush()
+            self.states.flush()
+
+    def __str__(self):
+        return '{}: {} specifications, {} decoder states'.format(self.directory, len(self.psi), len(self.states))
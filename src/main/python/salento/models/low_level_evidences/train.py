@@ -25,6 +25,8 @@ import json
 import textwrap
 
 from salento.models.low_level_evidences.data_reader import Reader
+from salento.models.low_level_evidences.input_pipeline import InputPipeline, is_sharded, read_shards_meta, \
+    with_vocab
 from salento.models.low_level_evidences.model import Model
 from salento.models.low_level_evidences.utils import read_config, dump_config
 
@@ -68,9 +70,27 @@ def train(clargs):
     config_file = clargs.config if clargs.continue_from is None \
                                 else os.path.join(clargs.continue_from, 'config.json')
     with open(config_file) as f:
-        config = read_config(json.load(f), chars_vocab=clargs.continue_from)
-    reader = Reader(clargs, config)
-    
+        js = json.load(f)
+    input_file = clargs.input_file[0]
+    if is_sharded(input_file):
+        # the records are already wrangled, with the vocabs of the shards
+        meta = read_shards_meta(input_file)
+        if clargs.continue_from is None:
+            config = read_config(with_vocab(js, meta), chars_vocab=True)
+        else:
+            config = read_config(js, chars_vocab=True)
+            assert config.decoder.chars == meta['config']['decoder']['chars'], \
+                'Shards were not prepared with the vocabs of the model, see input_pipeline.py --continue_from'
+        config.num_batches = meta['records'] // config.batch_size
+        assert config.num_batches > 0, 'Not enough data'
+        pipeline = InputPipeline.from_shards(input_file, config, clargs.shuffle_buffer,
+                                             clargs.num_parallel_calls, clargs.bucket_width, clargs.prefetch)
+    else:
+        config = read_config(js, chars_vocab=clargs.continue_from)
+        reader = Reader(clargs, config)
+        pipeline = InputPipeline.from_reader(reader, config, clargs.shuffle_buffer, clargs.num_parallel_calls,
+                                             clargs.bucket_width, clargs.prefetch)
+
     jsconfig = dump_config(config)
     print(clargs)
     print(json.dumps(jsconfig, indent=2))
@@ -79,7 +99,7 @@ def train(clargs):
     with open(os.path.join(clargs.save, 'config.json'), 'w') as f:
         json.dump(jsconfig, fp=f, indent=2)
 
-    model = Model(config)
+    model = Model(config, inputs=pipeline.batch)
 
     with tf.Session() as sess:
         tf.global_variables_initializer().run()
@@ -94,30 +114,27 @@ def train(clargs):
 
         # training
         for i in range(config.num_epochs):
-            reader.reset_batches()
+            pipeline.initialize(sess)
             avg_loss = avg_evidence = avg_latent = avg_generation = 0
+            batches = 0
             for b in range(config.num_batches):
                 start = time.time()
 
-                # setup the feed dict
-                ev_data, n, e, y = reader.next_batch()
-                feed = {model.targets: y}
-                for j, ev in enumerate(config.evidence):
-                    feed[model.encoder.inputs[j].name] = ev_data[j]
-                for j in range(config.decoder.max_seq_length):
-                    feed[model.decoder.nodes[j].name] = n[j]
-                    feed[model.decoder.edges[j].name] = e[j]
-
-                # run the optimizer
-                loss, evidence, latent, generation, mean, covariance, _ \
-                    = sess.run([model.loss,
-                                model.evidence_loss,
-                                model.latent_loss,
-                                model.gen_loss,
-                                model.encoder.psi_mean,
-                                model.encoder.psi_covariance,
-                                model.train_op], feed)
+                # run the optimizer on the next batch of the pipeline
+                try:
+                    loss, evidence, latent, generation, mean, covariance, _ \
+                        = sess.run([model.loss,
+                                    model.evidence_loss,
+                                    model.latent_loss,
+                                    model.gen_loss,
+                                    model.encoder.psi_mean,
+                                    model.encoder.psi_covariance,
+                                    model.train_op])
+                except tf.errors.OutOfRangeError:
+                    # fewer batches than expected, since the incomplete batch of each bucket is dropped
+                    break
                 end = time.time()
+                batches += 1
                 avg_loss += np.mean(loss)
                 avg_evidence += np.mean(evidence)
                 avg_latent += np.mean(latent)
@@ -134,15 +151,16 @@ def train(clargs):
                            np.mean(mean),
                            np.mean(covariance),
                            end - start))
+            assert batches > 0, 'No full batch in the epoch, try a smaller --bucket_width'
             checkpoint_dir = os.path.join(clargs.save, 'model{}.ckpt'.format(i))
             saver.save(sess, checkpoint_dir)
             print('Model checkpointed: {}. Average for epoch evidence: {:.3f}, latent: {:.3f}, '
                   'generation: {:.3f}, loss: {:.3f}'.format
                   (checkpoint_dir,
-                   avg_evidence / config.num_batches,
-                   avg_latent / config.num_batches,
-                   avg_generation / config.num_batches,
-                   avg_loss / config.num_batches))
+                   avg_evidence / batches,
+                   avg_latent / batches,
+                   avg_generation / batches,
+                   avg_loss / batches))
 
 
 if __name__ == '__main__':
@@ -150,7 +168,7 @@ if __name__ == '__main__':
     parser = argparse.ArgumentParser(formatter_class=argparse.RawDescriptionHelpFormatter,
                                      description=textwrap.dedent(HELP))
     parser.add_argument('input_file', type=str, nargs=1,
-                        help='input data file')
+                        help='input data file, or directory of shards (see input_pipeline.py)')
     parser.add_argument('--python_recursion_limit', type=int, default=10000,
                         help='set recursion limit for the Python interpreter')
     parser.add_argument('--save', type=str, default='save',
@@ -159,6 +177,18 @@ if __name__ == '__main__':
                         help='config file (see description above for help)')
     parser.add_argument('--continue_from', type=str, default=None,
                         help='ignore config options and continue training model checkpointed here')
+    parser.add_argument('--cache_dir', type=str, default=None,
+                        help='cache the wrangled data here, and read it from here on later runs with the same '
+                             'data file and config')
+    parser.add_argument('--shuffle_buffer', type=int, default=10000,
+                        help='number of data points to shuffle among, for each batch')
+    parser.add_argument('--num_parallel_calls', type=int, default=4,
+                        help='number of data points to prepare (or records of shards to decode) in parallel')
+    parser.add_argument('--bucket_width', type=int, default=4,
+                        help='batch together paths whose lengths are in the same range of this width '
+                             '(0 to batch paths of any length)')
+    parser.add_argument('--prefetch', type=int, default=2,
+                        help='number of batches to prepare ahead of training')
     clargs = parser.parse_args()
     sys.setrecursionlimit(clargs.python_recursion_limit)
     if clargs.config and clargs.continue_from:
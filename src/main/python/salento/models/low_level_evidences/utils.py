@@ -17,15 +17,8 @@ import argparse
 import re
 import tensorflow as tf
 
-CONFIG_GENERAL = ['model', 'latent_size', 'batch_size', 'num_epochs',
-                  'learning_rate', 'print_step', 'alpha', 'beta']
-CONFIG_ENCODER = ['name', 'units', 'num_layers', 'tile']
-CONFIG_DECODER = ['units', 'num_layers', 'max_seq_length']
-CONFIG_INFER = ['chars', 'vocab', 'vocab_size']
-
-UNK = '_UNK_'
-CHILD_EDGE = 'V'
-SIBLING_EDGE = 'H'
+from salento.models.low_level_evidences.constants import CONFIG_GENERAL, CONFIG_ENCODER, CONFIG_DECODER, \
+    CONFIG_INFER, UNK, CHILD_EDGE, SIBLING_EDGE
 
 
 def length(tensor):
@@ -33,6 +26,11 @@ def length(tensor):
     return tf.reduce_sum(elems, axis=1)
 
 
+# the batch size of the graph, which is left open (None) when inferring and is then read off the tensor
+def batch_size(config, tensor):
+    return config.batch_size if config.batch_size is not None else tf.shape(tensor)[0]
+
+
 # split s based on camel case and lower everything (uses '#' for split)
 def split_camel(s):
     s1 = re.sub('(.)([A-Z][a-z]+)', r'\1#\2', s)  # UC followed by LC
@@ -29,15 +29,152 @@
 from __future__ import print_function
 import json
 import sys
+import numpy as np
 # substitute inf with low value
 LOW_PROB = 10e-50
+# suffix of the files of probability reports saved as ragged arrays
+RAGGED_SUFFIX = '.npz'
+
+def save_report(data_file, prob_data, backward_data=None):
+    """
+    save a probability report ({unit: {"j--call--call...": {"i--call": prob}}}) as ragged
+    arrays in an npz file, without the keys that are only made of the calls
+    @data_file : file name string, should end with RAGGED_SUFFIX
+    @prob_data : the probability report
+    @backward_data : if given, the report of a backward model with the same keys, whose
+    values are already aligned with the forward ones (see get_raw_call_values.py)
+    """
+    call_ids = {}
+    units, numbers, calls, values, backward_values = [], [], [], [], []
+    sequence_offsets, call_offsets = [0], [0]
+    for unit_key, unit_data in prob_data.items():
+        units.append(unit_key)
+        for seq_key, seq_data in unit_data.items():
+            numbers.append(int(seq_key.split('--', 1)[0]))
+            for call_key, prob_value in seq_data.items():
+                call = call_key.split('--', 1)[1]
+                calls.append(call_ids.setdefault(call, len(call_ids)))
+                values.append(prob_value)
+                if backward_data is not None:
+                    backward_values.append(backward_data[unit_key][seq_key][call_key])
+            call_offsets.append(len(values))
+        sequence_offsets.append(len(numbers))
+    # the sequence s of all units has the numbers[s] (its j) and the calls (ids into
+    # call_names) and values (and backward_values) from call_offsets[s] to call_offsets[s+1]
+    arrays = dict(units=np.array(units, dtype=str),
+                  call_names=np.array(list(call_ids), dtype=str),
+                  sequence_offsets=np.array(sequence_offsets, dtype=np.int64),
+                  numbers=np.array(numbers, dtype=np.int64),
+                  call_offsets=np.array(call_offsets, dtype=np.int64),
+                  calls=np.array(calls, dtype=np.int32),
+                  values=np.array(values, dtype=np.float64))
+    if backward_data is not None:
+        arrays['backward_values'] = np.array(backward_values, dtype=np.float64)
+    np.savez_compressed(data_file, **arrays)
+
+class RaggedReport(object):
+    """ A probability report saved by save_report, read from its arrays """
+    def __init__(self, data_file):
+        """ read the data file """
+        with np.load(data_file) as arrays:
+            self.arrays = {key: arrays[key] for key in arrays.files}
+
+    def sequences(self, backward=False):
+        """
+        @backward : if true, give the aligned values of the backward model (see
+        save_report) instead of the forward ones
+        returns an iterator of (unit_key, seq_key, call_keys, prob_vector)
+        of the sequences of the report
+        """
+        arrays = self.arrays
+        call_names = arrays['call_names'].tolist()
+        call_offsets = arrays['call_offsets'].tolist()
+        calls = arrays['calls'].tolist()
+        values = arrays['backward_values' if backward else 'values'].tolist()
+        sequence_offsets = arrays['sequence_offsets'].tolist()
+        numbers = arrays['numbers'].tolist()
+        for k, unit_key in enumerate(arrays['units'].tolist()):
+            for s in range(sequence_offsets[k], sequence_offsets[k + 1]):
+                names = [call_names[c] for c in calls[call_offsets[s]:call_offsets[s + 1]]]
+                seq_key = '%d--%s' % (numbers[s], '--'.join(names))
+                call_keys = ['%d--%s' % (i, name) for i, name in enumerate(names)]
+                yield unit_key, seq_key, call_keys, values[call_offsets[s]:call_offsets[s + 1]]
+
+def aligned_backward_values(prob_data):
+    """
+    @prob_data : a probability report, as returned by load_report
+    returns the backward values saved with the report (see save_report), aligned
+    with its values, or None
+    """
+    if isinstance(prob_data, RaggedReport):
+        return prob_data.arrays.get('backward_values')
+    return None
+
+def load_report(data_file):
+    """
+    read a probability report, either JSON or ragged arrays (see save_report)
+    returns the JSON data or a RaggedReport
+    """
+    if data_file.endswith(RAGGED_SUFFIX):
+        return RaggedReport(data_file)
+    with open(data_file, 'r') as fread:
+        return json.load(fread)
+
+def report_sequences(prob_data):
+    """
+    @prob_data : a probability report, as returned by load_report
+    returns an iterator of (unit_key, seq_key, call_keys, prob_vector)
+    of the sequences of the report
+    """
+    if isinstance(prob_data, RaggedReport):
+        return prob_data.sequences()
+    return ((unit_key, seq_key, list(seq_data.keys()), list(seq_data.values()))
+            for unit_key, unit_data in prob_data.items()
+            for seq_key, seq_data in unit_data.items())
+
+def report_arrays(prob_data):
+    """
+    parse a probability report (see load_report) into arrays
+    returns (keys, values, offsets) : the list of unique keys of the sequences
+    ("unit--seq_key", as in ProcessDataImpl), the array of the probability
+    values of all sequences, and the array of offsets of each sequence in values
+    """
+    keys, lengths = [], []
+    for unit_key, seq_key, call_keys, _ in report_sequences(prob_data):
+        keys.append("%s--%s" % (str(unit_key), seq_key))
+        lengths.append(len(call_keys))
+    offsets = np.zeros(len(lengths) + 1, dtype=np.int64)
+    offsets[1:] = np.cumsum(lengths)
+    if isinstance(prob_data, RaggedReport):
+        values = prob_data.arrays['values']
+    else:
+        values = np.array([prob_value for _, _, _, prob_vector in report_sequences(prob_data)
+                           for prob_value in prob_vector], dtype=np.float64)
+    return keys, values, offsets
+
+def backward_values(prob_data_backward, keys):
+    """
+    parse a probability report of the reversed sequences (see ProcessBiDataImpl)
+    into values aligned with those of the forward sequences
+    @keys : the keys of the forward sequences, see report_arrays
+    returns the array of the backward values, in the order of the forward values
+    """
+    backward_keys, values, offsets = report_arrays(prob_data_backward)
+    index = {}
+    for b, key in enumerate(backward_keys):
+        (unit_key, seq_num, seq_string) = key.split("--", 2)
+        rev_seq = "--".join(list(reversed(seq_string.split("--"))))
+        index["%s--%s--%s" % (unit_key, seq_num, rev_seq)] = b
+    assert all(key in index for key in keys), "Incompatible datasets"
+    # the values of each sequence, reversed
+    gather = [np.arange(offsets[index[key] + 1] - 1, offsets[index[key]] - 1, -1) for key in keys]
+    return values[np.concatenate(gather + [np.zeros(0, dtype=np.int64)])]
 
 class ProcessData(object):
     """ Takes in detailed probability call computes the metrics """
     def __init__(self, data_file):
-        """ read the data file """
-        with open(data_file, 'r') as fread:
-            self.prob_data = json.load(fread)
+        """ read the data file, JSON or ragged arrays (see save_report) """
+        self.prob_data = load_report(data_file)
 
     def data_parser(self):
         """ implement custom data parser that returns
@@ -67,11 +204,9 @@ class ProcessDataImpl(ProcessData):
             a. unique seq_key
             b. seq_prob
         """
-        for unit_key in self.prob_data:
-            for seq_key in self.prob_data[unit_key]:
-                prob_vector = self.prob_data[unit_key][seq_key].values()
-                new_seq_key = "%s--%s" % (str(unit_key), seq_key)
-                self.forward_obj[new_seq_key] = prob_vector
+        for unit_key, seq_key, _, prob_vector in report_sequences(self.prob_data):
+            new_seq_key = "%s--%s" % (str(unit_key), seq_key)
+            self.forward_obj[new_seq_key] = prob_vector
 
     def apply_aggregation(self, operator_type):
         """
@@ -97,6 +232,16 @@ class ProcessStates(ProcessData):
         it update the forward object dictionary with
         unique seq_key and probability vector associated with sequences
         """
+        if isinstance(self.prob_data, RaggedReport):
+            # the ragged arrays have a single probability value per call
+            for unit_key, seq_key, call_keys, prob_vector in self.prob_data.sequences():
+                for i, call_key in enumerate(call_keys):
+                    if prob_vector[i] == float('-inf'):
+                        print('Infinite : %s--%s' % (seq_key, call_key), file=sys.stderr)
+                        prob_vector[i] = LOW_PROB
+                new_seq_key = "%s_%s" % (str(unit_key), seq_key)
+                self.forward_obj[new_seq_key] = prob_vector
+            return
         for unit_key in self.prob_data:
             for seq_key in self.prob_data[unit_key]:
                 prob_vector = []
@@ -126,12 +271,16 @@ class ProcessBiDataImpl(object):
         """
         read the data file
         @data_file_forward : file name string for forward probability
-        @data_file_backward : file name string for reverse probability
+        @data_file_backward : file name string for reverse probability, or None
+        if the forward file has the aligned backward values (see save_report)
         """
-        with open(data_file_forward, 'r') as fread_forward:
-            self.prob_data_forward = json.load(fread_forward)
-        with open(data_file_backward, 'r') as fread_backward:
-            self.prob_data_backward = json.load(fread_backward)
+        self.prob_data_forward = load_report(data_file_forward)
+        self.prob_data_backward = None
+        if data_file_backward is not None:
+            self.prob_data_backward = load_report(data_file_backward)
+        else:
+            assert aligned_backward_values(self.prob_data_forward) is not None, \
+                "No backward probabilities in %s" % data_file_forward
         self.aggregated_data = {}
 
     def data_parser(self):
@@ -144,21 +293,23 @@ class ProcessBiDataImpl(object):
         forward_obj = {}
         backward_obj = {}
 
-        for unit_key in self.prob_data_forward:
-            for seq_key in self.prob_data_forward[unit_key]:
-                prob_vector = self.prob_data_forward[unit_key][seq_key].values()
-                new_seq_key = "%s--%s" % (str(unit_key), seq_key)
-                forward_obj[new_seq_key] = prob_vector
-
-
-        for unit_key in self.prob_data_backward:
-            for seq_key in self.prob_data_backward[unit_key]:
-                prob_vector = list(self.prob_data_backward[unit_key][seq_key].values())
-                (seq_num, seq_string) = seq_key.split("--", 1)
-                # s[::-1] reverses s
-                rev_seq = "--".join(list(reversed(seq_string.split("--"))))
-                new_seq_key = "%s--%s--%s" % (str(unit_key), seq_num, rev_seq)
-                backward_obj[new_seq_key] = prob_vector[::-1]
+        for unit_key, seq_key, _, prob_vector in report_sequences(self.prob_data_forward):
+            new_seq_key = "%s--%s" % (str(unit_key), seq_key)
+            forward_obj[new_seq_key] = prob_vector
+
+
+        if self.prob_data_backward is None:
+            # the backward values are already aligned, with the same keys
+            for unit_key, seq_key, _, prob_vector in self.prob_data_forward.sequences(backward=True):
+                backward_obj["%s--%s" % (str(unit_key), seq_key)] = prob_vector
+            return (forward_obj, backward_obj)
+
+        for unit_key, seq_key, _, prob_vector in report_sequences(self.prob_data_backward):
+            (seq_num, seq_string) = seq_key.split("--", 1)
+            # s[::-1] reverses s
+            rev_seq = "--".join(list(reversed(seq_string.split("--"))))
+            new_seq_key = "%s--%s--%s" % (str(unit_key), seq_num, rev_seq)
+            backward_obj[new_seq_key] = prob_vector[::-1]
         assert len(set(forward_obj.keys()) & set(backward_obj.keys())) == \
                  len(forward_obj), "Incompatible datasets"
 
@@ -173,7 +324,7 @@ class ProcessBiDataImpl(object):
         """
         (forward_obj, backward_obj) = self.data_parser()
 
-        for k, forward_probs in forward_obj.iteritems():
+        for k, forward_probs in forward_obj.items():
             backward_probs = backward_obj[k]
             assert len(forward_probs) == len(backward_probs)
             # multiple reverse and forward
@@ -189,15 +340,16 @@ def get_anamolous_list(test_data_file):
     @test_data_file : Salento acceptable Test Data File with anomalous entry
     returns a list of anomalous keys
     """
-    with open(test_data_file, 'r') as fread:
-        json_data = json.load(fread)
+    # only the anomalous packages are read, found with the index of the data file
+    from salento.models.low_level_evidences.data_reader import PackageIndex
+    index = PackageIndex(test_data_file)
+    anomalous = index.find('anomalous')
 
     anamolous_keys = set()
-    for k, data in enumerate(json_data['packages']):
+    for k, data in zip(anomalous, index.packages(anomalous)):
         for j, seq in enumerate(data['data']):
-            if data['name'] == 'anomalous' and j == len(data['data']) - 1:
+            if j == len(data['data']) - 1:
                 call_key = ''.join([seqs['call'] for seqs in seq['sequence']])
                 seq_key = '%d_%d_%s' % (k, j, call_key)
                 anamolous_keys.add(seq_key)
     return anamolous_keys
-
@@ -29,6 +29,7 @@
 
 import json
 import argparse
+import numpy as np
 # project imports
 import metric
 import data_parser
@@ -39,7 +40,8 @@ def get_map_score(data_file_forward, data_file_backward, metric_choice,
     """
        computes the map score
        @data_file_forward (type:string) : file with forward probabilities
-       @data_file_backward (type:string) : file with reverse probabilities
+       @data_file_backward (type:string) : file with reverse probabilities, or None
+       if they are in the forward file (see data_parser.save_report)
        @metric_choice (type:string) : key of metric to apply
        @anomalous_keys (type:list) : list of procedures that are anomalous,
        identified by the unique keys
@@ -59,6 +61,48 @@ def get_map_score(data_file_forward, data_file_backward, metric_choice,
     map_score = metric.compute_map(process_data.aggregated_data, anomalous_keys)
     return map_score
 
+def sweep_map_scores(data_file_forward, data_file_backward, anomalous_keys):
+    """
+       computes the map score of every metric, forward and (given the reverse
+       probabilities, in their own file or next to the forward ones) bi-directional,
+       parsing the probabilities only once
+       @data_file_forward (type:string) : file with forward probabilities
+       @data_file_backward (type:string) : file with reverse probabilities, or None
+       if they are in the forward file
+       @anomalous_keys (type:list) : list of procedures that are anomalous,
+       identified by the unique keys
+       returns dictionary of direction to dictionary of metric to Mean Average Precision Score
+    """
+    prob_data = data_parser.load_report(data_file_forward)
+    keys, values, offsets = data_parser.report_arrays(prob_data)
+    anomalous = np.array([key in anomalous_keys for key in keys], dtype=np.bool_)
+    directions = [('forward', values)]
+    backward = data_parser.aligned_backward_values(prob_data)
+    if data_file_backward:
+        backward = data_parser.backward_values(data_parser.load_report(data_file_backward), keys)
+    if backward is not None:
+        assert len(backward) == len(values), "Incompatible datasets"
+        # multiple reverse and forward
+        directions.append(('bidirectional', np.minimum(values, backward)))
+    map_scores = {}
+    for direction, direction_values in directions:
+        scores = metric.segment_metrics(direction_values, offsets)
+        map_scores[direction] = {name: metric.rank_map(scores[name], anomalous)
+                                 for name in sorted(metric.METRICOPTION)}
+    return map_scores
+
+def format_sweep(map_scores):
+    """
+       format the map scores of sweep_map_scores as a table, a row per metric
+       and a column per direction
+    """
+    directions = list(map_scores)
+    lines = ['%-10s' % 'metric' + ''.join('%15s' % direction for direction in directions)]
+    for name in sorted(metric.METRICOPTION):
+        lines.append('%-10s' % name + ''.join('%15.6f' % map_scores[direction][name]
+                                              for direction in directions))
+    return '\n'.join(lines)
+
 if __name__ == "__main__":
     parser = argparse.ArgumentParser(description="Compute map scores")
     parser.add_argument(
@@ -69,13 +113,18 @@ if __name__ == "__main__":
     parser.add_argument(
         '--data_file_backward',
         type=str,
-        help="Data file with backward raw probabilities")
+        help="Data file with backward raw probabilities, if they are not in "
+        "the (npz) forward data file")
     parser.add_argument(
         '--metric_choice',
-        required=True,
         type=str,
         choices=metric.METRICOPTION.keys(),
         help="Choose the metric to be applied")
+    parser.add_argument(
+        '--sweep',
+        action='store_true',
+        help="Compute the scores of all metrics and directions (bidirectional if "
+        "a backward data file is given) instead of a single one")
     parser.add_argument(
         '--test_data_file',
         type=str,
@@ -92,16 +141,26 @@ if __name__ == "__main__":
         choices=['forward', 'bidirectional'],
         help="Choose type of combination")
     args = parser.parse_args()
+    if not args.sweep and args.metric_choice is None:
+        parser.error('either --metric_choice or --sweep is required')
     anomalous_keys = data_parser.get_anamolous_list(args.test_data_file)
 
-    map_scores = get_map_score(
-        args.data_file_forward,
-        args.data_file_backward,
-        args.metric_choice,
-        anomalous_keys,
-        args.direction)
+    if args.sweep:
+        map_scores = sweep_map_scores(
+            args.data_file_forward,
+            args.data_file_backward,
+            anomalous_keys)
+    else:
+        map_scores = get_map_score(
+            args.data_file_forward,
+            args.data_file_backward,
+            args.metric_choice,
+            anomalous_keys,
+            args.direction)
     if args.result_file:
         with open(args.result_file, 'w') as fwrite:
             json.dump(map_scores, fwrite)
+    elif args.sweep:
+        print(format_sweep(map_scores))
     else:
         print(json.dumps(map_scores, indent=2))
@@ -29,6 +29,10 @@ from __future__ import print_function
 import argparse
 import json
 from salento.aggregators.base import Aggregator
+from salento.models.low_level_evidences.infer import BACKENDS
+from salento.models.low_level_evidences.cache import DecoderCache
+# project imports
+import data_parser
 
 class RawProbAggregator(Aggregator):
     """
@@ -55,29 +59,177 @@ class RawProbAggregator(Aggregator):
         }
     }
     """
-    def __init__(self, data_file, model_dir):
-        Aggregator.__init__(self, data_file, model_dir)
+    def __init__(self, data_file, model_dir, backend='tensorflow', store=None, psi_mean=False, psi_samples=1,
+                 workers=1, cache_size=1024, backward_model_dir=None):
+        """
+        :param cache_size: the memory (in MB) for caching the decoder steps of each model
+        :param backward_model_dir: if given, the directory of a model trained on reversed sequences,
+                                   which scores the same events in the same pass (see package_reports)
+        """
+        Aggregator.__init__(self, data_file, model_dir, backend=backend, store=store, psi_mean=psi_mean,
+                            psi_samples=psi_samples, workers=workers)
+        self.cache = DecoderCache(cache_size * 2**20)
+        # the steps of the backward model are cached apart, as they are not those of the same model
+        self.backward_cache = DecoderCache(cache_size * 2**20) if backward_model_dir is not None else None
+        self._backward_model_dir = backward_model_dir
+        self._backward_specs = {}
+
+    def _load_model(self, threads=0):
+        Aggregator._load_model(self, threads)
+        self.backward_sess, self.backward = None, None
+        if self._backward_model_dir is not None:
+            self.backward_sess, self.backward = self._load_predictor(self._backward_model_dir, threads)
+
+    def _close_model(self):
+        Aggregator._close_model(self)
+        if self.backward_sess is not None:
+            self.backward_sess.close()
+
+    def __getstate__(self):
+        state = Aggregator.__getstate__(self)
+        for key in ['backward_sess', 'backward']:
+            state.pop(key, None)
+        state['_backward_specs'] = {}
+        if self.backward_cache is not None:
+            state['backward_cache'] = DecoderCache(self.backward_cache.max_bytes)
+        return state
+
+    def _data_vocab(self):
+        # with a backward model, only the events that both models know are scored
+        vocab = Aggregator._data_vocab(self)
+        if self.backward is None:
+            return vocab
+        backward_vocab = self.backward.model.config.decoder.vocab
+        return {key: value for key, value in vocab.items() if key in backward_vocab}
+
+    def get_backward_specification(self, evidences):
+        """
+        The latent specification of the backward model for a given set of evidences
+        """
+        key = self.backward.psi_key(evidences)
+        if key not in self._backward_specs:
+            self._backward_specs[key] = self.backward.psi_from_evidence(evidences)
+        return self._backward_specs[key]
+
+    def prefetch_latent_specifications(self, packages=None):
+        Aggregator.prefetch_latent_specifications(self, packages)
+        if self.backward is None:
+            return
+        missing = {}
+        for package in self.packages() if packages is None else packages:
+            key = self.backward.psi_key(package)
+            if key not in self._backward_specs:
+                missing.setdefault(key, package)
+        psi = self.backward.psi_from_evidences(list(missing.values()))
+        for i, key in enumerate(missing):
+            self._backward_specs[key] = psi[i]
+
+    def _package_specs(self, package):
+        specs = Aggregator._package_specs(self, package)
+        if self.backward is not None:
+            key = self.backward.psi_key(package)
+            specs['_backward_specs'] = {key: self._backward_specs[key]}
+        return specs
+
+    def sequence_values(self, spec, events, states=False, model=None, cache=None):
+        """
+        The probability of each call of a sequence, and with states, the combined probability of
+        each call and its states (see get_state_call_values.py), from a single decode of the
+        sequence: the distributions over the next states of the calls are decoded together, from
+        the decoder states before the calls (see next_state_distributions)
+        :param model: the BayesianPredictor to decode with, the (forward) model if not given
+        :param cache: the DecoderCache of the model, the cache of the (forward) model if not given
+        :return: list of (call probability, combined probability or None) of each event
+        """
+        model, cache = (self.model, self.cache) if model is None else (model, cache)
+        values = []
+        rows = model.infer_step_iter(spec, events, step='call', cache=cache)
+        next(rows)
+        state_dists = model.next_state_distributions(spec, events, cache=cache) if states else [None] * len(events)
+        for event, row, state_dist in zip(events, rows, state_dists):
+            call_prob = float(row.distribution[self.call(event)])
+            prob_value = None
+            if states:
+                # Pr(Call, States) = sum_i Pr(State_i| Call)Pr(Call)
+                prob_value = 0
+                for key, value in state_dist.items():
+                    if '#' in key:
+                        prob_value += call_prob*value
+                prob_value = float(prob_value)
+            values.append((call_prob, prob_value))
+        return values
+
+    def package_reports(self, package, states=True):
+        """
+        :return: tuple of the call probability values and (with states) the combined call and
+                 state probability values of the sequences of a package, from the same pass, and
+                 the same from the backward model if any (or empty). The backward model reads each
+                 sequence reversed, and its values are put back in the order of the events, so that
+                 they are aligned with the forward values.
+        """
+        reports = ({}, {}, {}, {})
+        spec = self.get_latent_specification(package)
+        scorers = [(spec, None, None, reports[:2])]
+        if self.backward is not None:
+            scorers.append((self.get_backward_specification(package), self.backward, self.backward_cache,
+                            reports[2:]))
+        for j, sequence in enumerate(self.sequences(package)):
+            events = self.events(sequence)
+            event_key = str(j) + '--' + "--".join(x['call'] for x in events)
+            call_keys = [str(i) + '--' + event['call'] for i, event in enumerate(events)]
+            for scorer_spec, model, cache, (call_data, state_data) in scorers:
+                if model is None:
+                    values = self.sequence_values(scorer_spec, events, states)
+                else:
+                    values = self.sequence_values(scorer_spec, events[::-1], states, model, cache)[::-1]
+                call_data[event_key] = {key: call_prob for key, (call_prob, _) in zip(call_keys, values)}
+                if states:
+                    state_data[event_key] = {key: prob_value for key, (_, prob_value) in zip(call_keys, values)}
+        return reports
+
+    def package_values(self, package):
+        """
+        :return: the probability values of the sequences of a package
+        """
+        return self.package_reports(package, states=False)[0]
 
     def run(self):
         """
         invoke the RNN to get the probability
         """
         result_data = {}
-        for k, package in enumerate(self.packages()):
-            result_data[str(k)] = {}
-            spec = self.get_latent_specification(package)
-            for j, sequence in enumerate(self.sequences(package)):
-                events = self.events(sequence)
-                event_data = {}
-                for i, event in enumerate(events):
-                    call_key = (str(i) + '--' + event['call'])
-                    prob_value = float(self.distribution_next_call(
-                        spec, events[:i+1], call=self.call(event)))
-                    event_data[call_key] = prob_value
-                event_key = str(j) + '--' + "--".join(x['call'] for x in events)
-                result_data[str(k)][event_key] = event_data
+        for k, (_, package_data) in enumerate(self.map_packages('package_values')):
+            result_data[str(k)] = package_data
         return result_data
 
+    def run_reports(self, states=True):
+        """
+        invoke the RNN once to get both the call probability values and the combined call and
+        state probability values, of the forward and the backward model
+        :return: tuple of the four results (see package_reports)
+        """
+        results = ({}, {}, {}, {})
+        for k, (_, reports) in enumerate(self.map_packages('package_reports' if states else 'package_call_reports')):
+            for result, report in zip(results, reports):
+                result[str(k)] = report
+        return results
+
+    def package_call_reports(self, package):
+        return self.package_reports(package, states=False)
+
+def write_result(result_file, result, backward_result=None):
+    """
+    write out a result in a json file, or as ragged arrays if the file name
+    ends with data_parser.RAGGED_SUFFIX (see data_parser.save_report), with
+    the aligned backward values if given
+    """
+    if result_file.endswith(data_parser.RAGGED_SUFFIX):
+        data_parser.save_report(result_file, result, backward_result)
+    else:
+        assert backward_result is None, 'backward values are only written as ragged arrays'
+        with open(result_file, 'w') as fwrite:
+            json.dump(result, fwrite)
+
 if __name__ == '__main__':
     parser = argparse.ArgumentParser()
     parser.add_argument('--data_file', type=str, required=True,
@@ -85,13 +237,39 @@ if __name__ == '__main__':
     parser.add_argument('--model_dir', type=str, required=True,
                         help='directory to load the model from')
     parser.add_argument('--result_file', type=str, default=None,
-                        help='write out the result in json file')
+                        help='write out the result in json file, or in an npz file of ragged arrays if it ends with .npz')
+    parser.add_argument('--backend', type=str, default='tensorflow', choices=BACKENDS,
+                        help='run the model with tensorflow, or with numpy on weights exported by export.py')
+    parser.add_argument('--workers', type=int, default=1,
+                        help='number of processes to score packages in, each with its own copy of the model')
+    parser.add_argument('--cache_size', type=int, default=1024,
+                        help='memory (in MB) for caching the decoder steps of each model')
+    parser.add_argument('--state_result_file', type=str, default=None,
+                        help='also write out the combined call and state probabilities (see get_state_call_values.py), '
+                             'computed in the same pass')
+    parser.add_argument('--backward_model_dir', type=str, default=None,
+                        help='directory to load a model trained on reversed sequences from, whose probabilities are '
+                             'written next to the forward ones in the (npz) result files')
     clargs = parser.parse_args()
+    if clargs.backward_model_dir is not None and not all(
+            f.endswith(data_parser.RAGGED_SUFFIX) for f in [clargs.result_file, clargs.state_result_file] if f):
+        parser.error('--backward_model_dir needs result files that end with ' + data_parser.RAGGED_SUFFIX)
+    if clargs.backward_model_dir is not None and clargs.result_file is None:
+        parser.error('--backward_model_dir needs a --result_file')
 
-    with RawProbAggregator(clargs.data_file, clargs.model_dir) as aggregator:
-        result = aggregator.run()
+    with RawProbAggregator(clargs.data_file, clargs.model_dir, backend=clargs.backend, workers=clargs.workers,
+                           cache_size=clargs.cache_size, backward_model_dir=clargs.backward_model_dir) as aggregator:
+        backward_result = backward_state_result = None
+        if clargs.state_result_file or clargs.backward_model_dir:
+            result, state_result, backward_result, backward_state_result = aggregator.run_reports(
+                states=clargs.state_result_file is not None)
+            if clargs.backward_model_dir is None:
+                backward_result = backward_state_result = None
+            if clargs.state_result_file:
+                write_result(clargs.state_result_file, state_result, backward_state_result)
+        else:
+            result = aggregator.run()
         if clargs.result_file:
-            with open(clargs.result_file, 'w') as fwrite:
-                json.dump(result, fwrite)
+            write_result(clargs.result_file, result, backward_result)
         else:
             print(json.dumps(result))
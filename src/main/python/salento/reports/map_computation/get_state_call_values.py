@@ -28,9 +28,11 @@
 from __future__ import print_function
 import argparse
 import json
-from salento.aggregators.base import Aggregator
+from salento.models.low_level_evidences.infer import BACKENDS
+# project imports
+import get_raw_call_values
 
-class RawProbAggregator(Aggregator):
+class RawProbAggregator(get_raw_call_values.RawProbAggregator):
     """
     This is based on the simple sequence aggregator, here for each call
     the probability is retrieved. The schema of the output is below
@@ -55,45 +57,12 @@ class RawProbAggregator(Aggregator):
         }
     }
     """
-    def __init__(self, data_file, model_dir):
-        Aggregator.__init__(self, data_file, model_dir)
-
-    def run(self):
+    def package_values(self, package):
         """
-            invoke the RNN to get the probability
-            return combined call and state probability values
+        :return: the combined call and state probability values of the sequences of a package
         """
-        result_data = {}
-        # iterate over units
-        for k, package in enumerate(self.packages()):
-            result_data[str(k)] = {}
-            spec = self.get_latent_specification(package)
-            # iterate over sequence
-            for j, sequence in enumerate(self.sequences(package)):
-                events = self.events(sequence)
-                seq_calls = "--".join(x['call'] for x in events)
-                event_key = str(j) + '--' + seq_calls
-                event_data = {}
-                # iterate over calls
-                for i, event in enumerate(events):
-                    call_key = (str(i) + '--' + event['call'])
-                    call_prob = float(self.distribution_next_call(
-                        spec, events[:i+1], call=self.call(event)))
-                    # next state probability
-                    dist = self.distribution_next_state(spec, events[:i+1], None)
-                    # use the probability summation rule on conditional
-                    # probability to get a unified probability value
-                    # Pr(Call, States) = Pr(State0| Call)Pr(Call) +
-                    #                    Pr(State1| Call)Pr(Call) +
-                    #                    Pr(State2| Call)Pr(Call)
-                    prob_value = 0
-                    # get the individual states
-                    for key, value in dist.items():
-                        if '#' in key:
-                            prob_value += call_prob*value
-                    event_data[call_key] = prob_value
-                result_data[str(k)][event_key] = event_data
-        return result_data
+        # each sequence is decoded once, for its calls and the states of each call
+        return self.package_reports(package)[1]
 
 if __name__ == '__main__':
     parser = argparse.ArgumentParser()
@@ -102,13 +71,19 @@ if __name__ == '__main__':
     parser.add_argument('--model_dir', type=str, required=True,
                         help='directory to load model from')
     parser.add_argument('--result_file', type=str, default=None,
-                        help='write out result in json file')
+                        help='write out result in json file, or in an npz file of ragged arrays if it ends with .npz')
+    parser.add_argument('--backend', type=str, default='tensorflow', choices=BACKENDS,
+                        help='run the model with tensorflow, or with numpy on weights exported by export.py')
+    parser.add_argument('--workers', type=int, default=1,
+                        help='number of processes to score packages in, each with its own copy of the model')
+    parser.add_argument('--cache_size', type=int, default=1024,
+                        help='memory (in MB) for caching decoder steps')
     clargs = parser.parse_args()
 
-    with RawProbAggregator(clargs.data_file, clargs.model_dir) as aggregator:
+    with RawProbAggregator(clargs.data_file, clargs.model_dir, backend=clargs.backend,
+                           workers=clargs.workers, cache_size=clargs.cache_size) as aggregator:
         result = aggregator.run()
     if clargs.result_file:
-        with open(clargs.result_file, 'w') as fwrite:
-            json.dump(result, fwrite)
+        get_raw_call_values.write_result(clargs.result_file, result)
     else:
         print(json.dumps(result))
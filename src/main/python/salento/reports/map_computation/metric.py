@@ -28,7 +28,7 @@
 # Purpose :   This scripts produces the different anomaly metrics
 
 import math
-import operator
+import numpy as np
 
 class Metric(object):
     """
@@ -65,6 +65,37 @@ METRICOPTION = {
     "sum_llh": Metric.sum_llh,
     "min_llh": Metric.min_llh}
 
+def segment_metrics(values, offsets):
+    """
+        computes every metric of METRICOPTION for many sequences at once
+        @values : array with the probability values of all sequences
+        @offsets : array, the values of sequence s are values[offsets[s]:offsets[s+1]]
+        note that an empty sequence has a sum of 0 and a minimum of 1
+        return dictionary of metric name to the array of scores of the sequences
+    """
+    values = np.asarray(values, dtype=np.float64)
+    offsets = np.asarray(offsets, dtype=np.int64)
+    lengths = np.diff(offsets)
+    sums = np.zeros(len(lengths))
+    mins = np.ones(len(lengths))
+    log_sums = np.zeros(len(lengths))
+    # reduceat reduces between consecutive indices, so it is only given the non-empty sequences
+    nonempty = lengths > 0
+    if np.any(nonempty):
+        starts = offsets[:-1][nonempty]
+        with np.errstate(divide='ignore'):
+            log_values = np.log(values)
+        sums[nonempty] = np.add.reduceat(values, starts)
+        mins[nonempty] = np.minimum.reduceat(values, starts)
+        log_sums[nonempty] = np.add.reduceat(log_values, starts)
+    with np.errstate(divide='ignore'):
+        min_llh = - np.log(mins)
+    return {
+        "sum_raw": sums,
+        "min_raw": mins,
+        "sum_llh": - log_sums,
+        "min_llh": min_llh}
+
 def compute_map(data, anomalous_keys):
     """
         This function computes the map score for test data
@@ -73,19 +104,25 @@ def compute_map(data, anomalous_keys):
         Assumption : Every anomalous keys is present in the data
         return map_score
     """
-    # sort the data
-    sorted_data = sorted(data.items(), key=operator.itemgetter(1), reverse=True)
-    # set the indices
+    keys = list(data.keys())
+    scores = np.array([data[key] for key in keys], dtype=np.float64)
+    anomalous = np.array([key in anomalous_keys for key in keys], dtype=np.bool_)
+    return rank_map(scores, anomalous)
+
+def rank_map(scores, anomalous):
+    """
+        computes the map score from the scores of the sequences
+        @scores : array of the anomaly scores of the sequences
+        @anomalous : boolean array, true for the anomalous sequences
+        return map_score
+    """
+    # rank by decreasing score, the ties keeping their order
+    order = np.argsort(-scores, kind='mergesort')
     """
     @indices: a list of ranks of correctly retrieved items
     note that the ranks are 0-based (i.e, best rank = 0)
     """
-    indices = []
-    for i, keys in enumerate(sorted_data):
-        if keys[0] in anomalous_keys:
-            indices.append(i)
-    collected_precision = []
-    for i, val in enumerate(indices):
-        collected_precision.append((i+1)/float(val + 1))
-    map_score = sum(collected_precision)/(len(collected_precision))
+    indices = np.flatnonzero(anomalous[order])
+    collected_precision = np.arange(1, len(indices) + 1) / (indices + 1.)
+    map_score = collected_precision.mean() if len(collected_precision) else 0.0
     return map_score
@@ -23,6 +23,8 @@ import gzip
 import os.path
 
 from salento.models.low_level_evidences.evidence import update_apicalls
+from salento.models.low_level_evidences.data_reader import read_packages
+from salento.models.low_level_evidences.columnar import write_columnar
 
 HELP = """Use this script to extract evidences from a raw data file with sequences generated by driver.
 You can also filter programs based on number and length of sequences."""
@@ -39,25 +41,26 @@ def smart_open(filename, *args, **kwargs):
     return LOADERS.get(os.path.splitext(filename)[1], open)(filename, *args, **kwargs)
 
 def extract_evidence(clargs):
-    print('Loading data file...', end='')
-    with smart_open(clargs.input_file[0]) as f:
-        js = json.load(f)
-    print('done')
-    done = 0
-    programs = []
-    for program in js['packages']:
-        if not update_apicalls(program, max_seqs=clargs.max_seqs, max_seqs_length=clargs.max_seq_length):
-            continue
-        programs.append(program)
-        done += 1
-        print('Extracted evidence for {} programs'.format(done), end='\r')
+    # the packages are streamed from the input file (JSON or columnar dataset)
+    def programs():
+        done = 0
+        for program in read_packages(clargs.input_file[0]):
+            if not update_apicalls(program, max_seqs=clargs.max_seqs, max_seqs_length=clargs.max_seq_length):
+                continue
+            done += 1
+            print('Extracted evidence for {} programs'.format(done), end='\r')
+            yield program
 
+    if clargs.columnar:
+        write_columnar(programs(), clargs.output_file[0])
+        print('\nWrote columnar dataset {}'.format(clargs.output_file[0]))
+        return
+    programs = list(programs())
     print('\nWriting to {}...'.format(clargs.output_file[0]), end='')
     with smart_open(clargs.output_file[0], 'wt') as f:
         json.dump({'packages': programs}, fp=f, indent=2)
     print('done')
 
-
 if __name__ == '__main__':
     parser = argparse.ArgumentParser(formatter_class=argparse.RawDescriptionHelpFormatter,
                                      description=HELP)
@@ -71,6 +74,8 @@ if __name__ == '__main__':
                         help='maximum number of sequences in a program')
     parser.add_argument('--max_seq_length', type=int, default=9999,
                         help='maximum length of each sequence in a program')
+    parser.add_argument('--columnar', action='store_true',
+                        help='write the output as a columnar dataset (a directory, see columnar.py)')
     clargs = parser.parse_args()
     sys.setrecursionlimit(clargs.python_recursion_limit)
     extract_evidence(clargs)
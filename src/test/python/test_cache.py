@@ -0,0 +1,134 @@
+# Copyright 2017 Rice University
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import argparse
+import shutil
+import tempfile
+import unittest
+
+import numpy as np
+
+from salento.models.low_level_evidences.cache import DecoderCache, fingerprint
+from salento.models.low_level_evidences.store import ModelStore
+
+UNITS = 4
+LAYERS = 2
+
+
+def _config():
+    config = argparse.Namespace(latent_size=3)
+    config.decoder = argparse.Namespace(num_layers=LAYERS, units=UNITS)
+    return config
+
+
+def _state(value):
+    return [np.full((1, UNITS), value + layer, dtype=np.float32) for layer in range(LAYERS)]
+
+
+def _log_dist(value):
+    return np.full(5, value, dtype=np.float32)
+
+
+# the bytes taken by a cached step of a full log-distribution and a state
+_STEP_BYTES = _log_dist(0).nbytes + sum(layer.nbytes for layer in _state(0))
+
+
+class DecoderCacheTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_scopes_by_fingerprint(self):
+        psi = np.arange(3, dtype=np.float32)
+        self.assertEqual(fingerprint(psi), fingerprint(psi.copy()))
+        self.assertNotEqual(fingerprint(psi), fingerprint(psi + 1))
+        self.assertEqual(fingerprint(psi, psi), fingerprint(np.concatenate([psi, psi])))
+        cache = DecoderCache()
+        # equal specifications share their trie, and others do not
+        self.assertIs(cache.scope(psi), cache.scope(psi.copy()))
+        cache.put(cache.child(cache.scope(psi), 1), _log_dist(1), _state(1))
+        self.assertEqual(cache.get(cache.child(cache.scope(psi.copy()), 1))[0][0], 1)
+        self.assertIsNone(cache.get(cache.child(cache.scope(psi + 1), 1)))
+
+    def test_lru_eviction(self):
+        cache = DecoderCache(max_bytes=2 * _STEP_BYTES)
+        root = cache.scope(np.zeros(3))
+        a, b, c = (cache.child(root, key) for key in [1, 2, 3])
+        cache.put(a, _log_dist(1), _state(1))
+        cache.put(b, _log_dist(2), _state(2))
+        # a is now more recently used than b, so b goes first
+        self.assertIsNotNone(cache.get(a))
+        cache.put(c, _log_dist(3), _state(3))
+        self.assertEqual(len(cache), 2)
+        self.assertEqual(cache.evictions, 1)
+        self.assertIsNone(cache.get(b))
+        self.assertEqual(cache.get(a)[0][0], 1)
+        self.assertEqual(cache.get(c)[0][0], 3)
+        self.assertLessEqual(cache.nbytes, 2 * _STEP_BYTES)
+
+    def test_targets_then_full_distribution(self):
+        cache = DecoderCache()
+        node = cache.child(cache.scope(np.zeros(3)), 1)
+        cache.put(node, -0.5, _state(1), target=4)
+        self.assertEqual(cache.get(node, target=4)[0], -0.5)
+        self.assertIsNone(cache.get(node, target=3))
+        self.assertIsNone(cache.get(node))
+        cache.put(node, _log_dist(-1), _state(1))
+        self.assertEqual(cache.get(node)[0][0], -1)
+        self.assertEqual(cache.get(node, target=3)[0], -1)
+
+    def test_evicted_trie_nodes_are_pruned(self):
+        cache = DecoderCache(max_bytes=_STEP_BYTES)
+        psi = np.zeros(3)
+        root = cache.scope(psi)
+        node = cache.child(cache.child(root, 1), 2)
+        cache.put(node, _log_dist(1), _state(1))
+        cache.put(cache.child(cache.scope(np.ones(3)), 1), _log_dist(2), _state(2))
+        self.assertEqual(root.children, {})
+        # the pruned prefix is recreated on demand
+        self.assertIsNot(cache.child(cache.child(cache.scope(psi), 1), 2), node)
+
+    def test_prefix_after_eviction_during_decode(self):
+        store = ModelStore(self.directory, 'model', _config())
+        cache = DecoderCache(max_bytes=_STEP_BYTES, store=store)
+        psi = np.zeros(3)
+        # a decode holds the node of the prefix (10, 20) while its step is evicted
+        first = cache.child(cache.scope(psi), 10)
+        node = cache.child(first, 20)
+        cache.put(node, _log_dist(1), _state(1))
+        cache.put(cache.child(cache.scope(np.ones(3)), 10), _log_dist(2), _state(2))
+        self.assertIsNone(node.value)
+        self.assertEqual(cache.prefix(node), (fingerprint(psi), 10, 20))
+
+        # the decode goes on from the held node, and its steps are stored under their full prefixes
+        deeper = cache.child(node, 30)
+        cache.put(deeper, _log_dist(3), _state(3))
+        self.assertEqual(cache.prefix(deeper), (fingerprint(psi), 10, 20, 30))
+        np.testing.assert_array_equal(np.concatenate(cache.stored_state(node)),
+                                      np.concatenate(_state(1)))
+        np.testing.assert_array_equal(np.concatenate(cache.stored_state(deeper)),
+                                      np.concatenate(_state(3)))
+        self.assertIsNone(store.get_state((10, 20)))
+
+        # and are restored by a later run
+        store.flush()
+        later = DecoderCache(store=ModelStore(self.directory, 'model', _config(), readonly=True))
+        restored = later.child(later.child(later.child(later.scope(psi), 10), 20), 30)
+        np.testing.assert_array_equal(np.concatenate(later.stored_state(restored)),
+                                      np.concatenate(_state(3)))
+        other = later.child(later.child(later.scope(np.ones(3)), 10), 20)
+        self.assertIsNone(later.stored_state(other))
@@ -0,0 +1,79 @@
+# Copyright 2017 Rice University
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import copy
+import gzip
+import json
+import os
+import shutil
+import tempfile
+import unittest
+
+from salento.models.low_level_evidences.columnar import write_columnar
+from salento.models.low_level_evidences.data_reader import PackageIndex, read_packages
+
+PACKAGES = [
+    {'name': 'p{}'.format(k), 'apicalls': ['a', 'b'][:k % 3],
+     'data': [{'sequence': [{'call': 'abc'[(k + i) % 3], 'states': [i, k][:i % 3], 'location': 'L{}'.format(i)}
+                            for i in range(s)]}
+              for s in range(k % 4)]}
+    for k in range(7)]
+
+
+class DataFilesTest(unittest.TestCase):
+    """
+    The packages of a data file are the same whether it is JSON, compressed or columnar
+    """
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.json_file = os.path.join(self.directory, 'data.json')
+        with open(self.json_file, 'w') as f:
+            # with an unrelated key around the packages
+            json.dump({'version': [1, {'packages': []}], 'packages': PACKAGES, 'name': 'data'}, f, indent=1)
+        self.gzip_file = os.path.join(self.directory, 'data.json.gz')
+        with gzip.open(self.gzip_file, 'wt') as f:
+            json.dump({'packages': PACKAGES}, f)
+        self.columnar_dir = os.path.join(self.directory, 'data')
+        write_columnar(copy.deepcopy(PACKAGES), self.columnar_dir)
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_read_packages(self):
+        for filename in [self.json_file, self.gzip_file, self.columnar_dir]:
+            self.assertEqual(list(read_packages(filename, chunk_size=16)), PACKAGES, filename)
+
+    def test_json_values(self):
+        # strings with brackets, quotes and escapes, and values of all types, split across chunks
+        packages = [{'name': 'a {"[b]"} \\', 'n': [-1.5e3, 0, True, False, None], 'u': '\u00e9\u2603 \n',
+                     'data': [{'sequence': [], 'nested': {'x': [[], {}], 'y': '}]'}}]}, {}]
+        with open(self.json_file, 'w') as f:
+            json.dump({'packages': packages, 'other': {'packages': [1]}}, f, ensure_ascii=False)
+        for chunk_size in [1, 7, 2**20]:
+            self.assertEqual(list(read_packages(self.json_file, chunk_size=chunk_size)), packages)
+
+    def test_package_index(self):
+        for filename in [self.json_file, self.gzip_file, self.columnar_dir]:
+            index = PackageIndex(filename)
+            self.assertEqual(len(index), len(PACKAGES))
+            self.assertEqual(index.find('p3'), [3])
+            self.assertEqual(index.sequences.tolist(), [len(package['data']) for package in PACKAGES])
+            self.assertEqual(list(index.packages([5, 1, 5])), [PACKAGES[5], PACKAGES[1], PACKAGES[5]], filename)
+            # and over several calls, from the file kept open
+            self.assertEqual([index.package(k) for k in [2, 6, 0]], [PACKAGES[2], PACKAGES[6], PACKAGES[0]], filename)
+            index.close()
+        # the saved index is read back
+        self.assertTrue(os.path.exists(self.json_file + '.index.npz'))
+        self.assertEqual(PackageIndex(self.json_file).package(6), PACKAGES[6])
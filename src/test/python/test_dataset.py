@@ -0,0 +1,115 @@
+# Copyright 2017 Rice University
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import copy
+import json
+import os
+import shutil
+import tempfile
+import unittest
+
+from salento.aggregators.dataset import CompiledDataset, compile_packages
+from salento.models.low_level_evidences.columnar import ColumnarDataset, write_columnar
+
+CHARS = ['STOP', 'a', 'b', '0#0', '0#1', '1#1', '1#2']
+VOCAB = {char: i for i, char in enumerate(CHARS)}
+
+
+def _event(call, states, location):
+    return {'call': call, 'states': states, 'location': location}
+
+
+PACKAGES = [
+    {'name': 'p0', 'data': [
+        {'sequence': [_event('a', [0, 1], 'L1'), _event('b', [1, 2], 'L2')]},
+        # an unknown call, and an unknown state, are left out
+        {'sequence': [_event('c', [0, 1], 'L1'), _event('a', [0, 3], 'L2'), _event('b', [1, 1], 'L3')]},
+        {'sequence': [_event('a', [0, 1], 'L1'), _event('b', [1, 2], 'L2')]}]},
+    {'name': 'p1', 'data': [
+        {'sequence': []},
+        {'sequence': [_event('b', [0], 'L3'), _event('a', [1, 2], 'L1')]}]},
+]
+
+
+def _events(dataset):
+    return [[dataset.events(s) for s in dataset.sequences(package)] for package in dataset.packages]
+
+
+def _chunked_events(path):
+    # the packages and events compiled a package at a time
+    packages, events = [], []
+    for data in compile_packages(path, VOCAB, CHARS, [], chunk_size=1):
+        packages.extend((package.index, package) for package in data.packages)
+        events.extend(_events(data))
+    return packages, events
+
+
+class CompiledDatasetTest(unittest.TestCase):
+
+    def test_events(self):
+        dataset = CompiledDataset(copy.deepcopy(PACKAGES), VOCAB, CHARS, [])
+        self.assertEqual([package['name'] for package in dataset.packages], ['p0', 'p1'])
+        self.assertEqual(_events(dataset), [
+            [[_event('a', [0, 1], 'L1'), _event('b', [1, 2], 'L2')],
+             [_event('b', [1, 1], 'L3')],
+             [_event('a', [0, 1], 'L1'), _event('b', [1, 2], 'L2')]],
+            [[], [_event('b', [0], 'L3'), _event('a', [1, 2], 'L1')]]])
+        # the states keep their type
+        self.assertIs(type(dataset.events(0)[0]['states'][0]), int)
+        self.assertEqual(dataset.sequence_keys[0], dataset.sequence_keys[2])
+        self.assertNotEqual(dataset.sequence_keys[0], dataset.sequence_keys[1])
+
+    def test_sequences_ending_at(self):
+        dataset = CompiledDataset(copy.deepcopy(PACKAGES), VOCAB, CHARS, [])
+        self.assertEqual(dataset.sequences_ending_at(range(5)), [('L1', [4]), ('L2', [0, 2]), ('L3', [1])])
+        self.assertEqual(dataset.package_locations(dataset.packages[0]), ['L1', 'L2', 'L3'])
+
+    def test_compiled_in_chunks(self):
+        directory = tempfile.mkdtemp()
+        try:
+            path = os.path.join(directory, 'data.json')
+            with open(path, 'w') as f:
+                json.dump({'packages': PACKAGES}, f)
+            dataset = CompiledDataset(copy.deepcopy(PACKAGES), VOCAB, CHARS, [])
+            self.assertEqual(_chunked_events(path), (list(enumerate(dataset.packages)), _events(dataset)))
+        finally:
+            shutil.rmtree(directory)
+
+
+class ColumnarDatasetTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        write_columnar(copy.deepcopy(PACKAGES), self.directory)
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_packages(self):
+        self.assertEqual(list(ColumnarDataset(self.directory)), PACKAGES)
+
+    def test_compiled_as_json(self):
+        expected = CompiledDataset(copy.deepcopy(PACKAGES), VOCAB, CHARS, [])
+        compiled = CompiledDataset.from_columns(ColumnarDataset(self.directory), VOCAB, CHARS, [])
+        self.assertEqual(compiled.packages, expected.packages)
+        self.assertEqual(_events(compiled), _events(expected))
+        self.assertIs(type(compiled.events(0)[0]['states'][0]), int)
+        for name in ['calls', 'locations', 'states', 'state_offsets', 'event_offsets', 'sequence_offsets',
+                     'location_ranks']:
+            self.assertEqual(getattr(compiled, name).tolist(), getattr(expected, name).tolist(), name)
+        # and a package at a time
+        self.assertEqual(_chunked_events(self.directory), (list(enumerate(expected.packages)), _events(expected)))
+        # equal sequences have equal keys in both
+        self.assertEqual([(compiled.sequence_keys == key).tolist() for key in compiled.sequence_keys],
+                         [(expected.sequence_keys == key).tolist() for key in expected.sequence_keys])
@@ -0,0 +1,96 @@
+# Copyright 2017 Rice University
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import json
+import math
+import os
+import shutil
+import tempfile
+import unittest
+
+import numpy as np
+import pytest
+
+pytest.importorskip('tensorflow')
+
+from salento.models.low_level_evidences.infer import BayesianPredictor
+from salento.models.low_level_evidences.numpy_model import WEIGHTS_FILE
+
+CHARS = ['START', 'STOP', 'a', 'b', '0#0', '0#1', '1#1']
+UNITS = 6
+LAYERS = 2
+CONFIG = {
+    'model': 'lle', 'latent_size': 3, 'batch_size': 2, 'num_epochs': 1, 'learning_rate': 0.02,
+    'print_step': 1, 'alpha': 1e-05, 'beta': 1e-05,
+    'evidence': [{'name': 'apicalls', 'units': 4, 'num_layers': 1, 'tile': 1,
+                  'chars': ['a', 'b'], 'vocab': {'a': 0, 'b': 1}, 'vocab_size': 2}],
+    'decoder': {'units': UNITS, 'num_layers': LAYERS, 'max_seq_length': 8,
+                'chars': CHARS, 'vocab': {c: i for i, c in enumerate(CHARS)}, 'vocab_size': len(CHARS)}
+}
+SEQUENCE = [{'call': 'a', 'states': [0, 1]}, {'call': 'b', 'states': [1]}]
+
+
+def _weights(random):
+    # random decoder weights, in the layout of export_weights
+    shapes = {'lift_w': [CONFIG['latent_size'], UNITS], 'lift_b': [UNITS], 'emb': [len(CHARS), UNITS],
+              'projection_w': [UNITS, len(CHARS)], 'projection_b': [len(CHARS)]}
+    for cell in ['cell1', 'cell2']:
+        for i in range(LAYERS):
+            key = '{}/{}'.format(cell, i)
+            shapes.update({key + '/gates/kernel': [2 * UNITS, 2 * UNITS], key + '/gates/bias': [2 * UNITS],
+                           key + '/candidate/kernel': [2 * UNITS, UNITS], key + '/candidate/bias': [UNITS]})
+    return {name: random.normal(scale=0.5, size=shape).astype(np.float32) for name, shape in shapes.items()}
+
+
+class InferStepIterTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        with open(os.path.join(self.directory, 'config.json'), 'w') as f:
+            json.dump(CONFIG, f)
+        random = np.random.RandomState(0)
+        np.savez(os.path.join(self.directory, WEIGHTS_FILE), **_weights(random))
+        self.model = BayesianPredictor(self.directory, None, backend='numpy')
+        self.psi = random.normal(size=(1, CONFIG['latent_size'])).astype(np.float32)
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def _state_prob(self, before, call, states, state):
+        # the probability of the next state of a call after the events before it, given its states before it
+        return self.model.infer_step(self.psi, before + [{'call': call, 'states': states}], step='state',
+                                     target='{}#{}'.format(len(states), state))
+
+    def test_states_of_previous_call_only(self):
+        rows = list(self.model.infer_step_iter(self.psi, SEQUENCE, step='state'))
+        self.assertEqual(len(rows), len(SEQUENCE) + 1)
+        # each row has the states of the call before it, not those of all the calls so far
+        self.assertEqual(rows[0].states, [])
+        np.testing.assert_allclose(rows[1].states, [self._state_prob([], 'a', [], 0),
+                                                    self._state_prob([], 'a', [0], 1)], rtol=1e-5)
+        np.testing.assert_allclose(rows[2].states, [self._state_prob(SEQUENCE[:1], 'b', [], 1)], rtol=1e-5)
+        # and keeps them once the iteration has moved on
+        self.assertEqual(len(rows[1].states), 2)
+
+    def test_state_scores_add_up_to_sequence_log_likelihood(self):
+        llh = 0.
+        calls = [event['call'] for event in SEQUENCE] + ['STOP']
+        for row, next_call in zip(self.model.infer_step_iter(self.psi, SEQUENCE, step='state'), calls):
+            llh += math.log(row.distribution[next_call])
+            llh += sum(math.log(prob) for prob in row.states)
+            if next_call != 'STOP':
+                llh += math.log(row.next_state()['STOP'])
+        # as the KLD aggregator scores sequences with their states
+        expected = self.model.sequence_log_likelihoods(self.psi, [SEQUENCE], step='state')[0]
+        self.assertAlmostEqual(llh, expected, places=4)
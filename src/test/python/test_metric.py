@@ -0,0 +1,38 @@
+# Copyright 2017 Rice University
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import os
+import sys
+import unittest
+
+import numpy as np
+
+# the map computation scripts import each other as top-level modules
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', '..', 'main', 'python',
+                                'salento', 'reports', 'map_computation'))
+
+import metric
+
+
+class RankMapTest(unittest.TestCase):
+
+    def test_rank_map(self):
+        scores = np.array([0.9, 0.1, 0.5, 0.7])
+        # ranked 0.9, 0.7, 0.5, 0.1: the anomalous ones are found at ranks 1 and 3
+        self.assertAlmostEqual(metric.rank_map(scores, np.array([True, False, True, False])), (1 + 2 / 3.) / 2)
+        self.assertEqual(metric.compute_map({'a': 0.2, 'b': 0.8}, ['b']), 1.0)
+
+    def test_no_anomalous_keys(self):
+        self.assertEqual(metric.rank_map(np.array([0.9, 0.1]), np.zeros(2, dtype=np.bool_)), 0.0)
+        self.assertEqual(metric.rank_map(np.zeros(0), np.zeros(0, dtype=np.bool_)), 0.0)
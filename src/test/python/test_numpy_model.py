@@ -0,0 +1,83 @@
+# Copyright 2017 Rice University
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import os
+import shutil
+import tempfile
+import unittest
+
+import numpy as np
+import pytest
+
+tf = pytest.importorskip('tensorflow')
+if not hasattr(tf, 'Session'):
+    pytest.skip('the model needs TF 1.x', allow_module_level=True)
+
+from salento.models.low_level_evidences.model import Model
+from salento.models.low_level_evidences.numpy_model import NumpyModel, export_weights
+from salento.models.low_level_evidences.utils import read_config, CHILD_EDGE, SIBLING_EDGE
+
+CHARS = ['START', 'STOP', 'a', 'b', '0#x']
+CONFIG = {
+    'model': 'lle', 'latent_size': 4, 'batch_size': 2, 'num_epochs': 1, 'learning_rate': 0.02,
+    'print_step': 1, 'alpha': 1e-05, 'beta': 1e-05,
+    'evidence': [{'name': 'apicalls', 'units': 4, 'num_layers': 1, 'tile': 1,
+                  'chars': ['a', 'b'], 'vocab': {'a': 0, 'b': 1}, 'vocab_size': 2}],
+    'decoder': {'units': 8, 'num_layers': 3, 'max_seq_length': 4,
+                'chars': CHARS, 'vocab': {c: i for i, c in enumerate(CHARS)}, 'vocab_size': len(CHARS)}
+}
+
+# rows of (node, edge) fed to the decoder at each step
+STEPS = [[('START', CHILD_EDGE), ('START', CHILD_EDGE), ('START', CHILD_EDGE)],
+         [('a', SIBLING_EDGE), ('b', CHILD_EDGE), ('a', CHILD_EDGE)],
+         [('0#x', SIBLING_EDGE), ('a', SIBLING_EDGE), ('STOP', CHILD_EDGE)]]
+
+
+class NumpyModelTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def _decode(self, model, sess, psi):
+        states = model.infer_initial_state(sess, psi)
+        results = []
+        for rows in STEPS:
+            log_dists, states = model.infer_batch_step(sess, states, [n for n, _ in rows], [e for _, e in rows])
+            results.append((log_dists, [np.concatenate(layers, axis=1) for layers in states]))
+        return results
+
+    def test_tf_and_numpy_agree_over_layers(self):
+        psi = np.random.RandomState(0).normal(size=(3, CONFIG['latent_size'])).astype(np.float32)
+        with tf.Graph().as_default():
+            tf.set_random_seed(0)
+            model = Model(read_config(CONFIG, chars_vocab=True), infer=True)
+            with tf.Session() as sess:
+                sess.run(tf.global_variables_initializer())
+                checkpoint = tf.train.Saver().save(sess, os.path.join(self.directory, 'model.ckpt'))
+                expected = self._decode(model, sess, psi)
+
+        config = read_config(CONFIG, chars_vocab=True)
+        weights_file = os.path.join(self.directory, 'model.npz')
+        np.savez(weights_file, **export_weights(tf.train.NewCheckpointReader(checkpoint), config))
+        actual = self._decode(NumpyModel(config, weights_file), None, psi)
+
+        for (tf_log_dists, tf_states), (np_log_dists, np_states) in zip(expected, actual):
+            np.testing.assert_allclose(np_log_dists, tf_log_dists, rtol=1e-4, atol=1e-5)
+            for tf_state, np_state in zip(tf_states, np_states):
+                np.testing.assert_allclose(np_state, tf_state, rtol=1e-4, atol=1e-5)
+        # the layers of the states do not all collapse to the same values
+        self.assertFalse(np.allclose(actual[-1][1][0][:, :8], actual[-1][1][0][:, 8:16]))
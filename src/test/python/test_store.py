@@ -0,0 +1,151 @@
+# Copyright 2017 Rice University
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#    http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import argparse
+import multiprocessing
+import os
+import shutil
+import tempfile
+import unittest
+
+import numpy as np
+
+from salento.models.low_level_evidences.store import ArrayTable, ModelStore, store_key
+
+WIDTH = 3
+
+
+def _row(i):
+    return np.arange(WIDTH, dtype=np.float32) + i
+
+
+def _write_rows(path, start, count):
+    # a writer process, flushing along the way
+    table = ArrayTable(path, WIDTH, flush_bytes=7 * ArrayTable(path, WIDTH).dtype.itemsize)
+    for i in range(start, start + count):
+        table.put(store_key(i), _row(i))
+    table.flush()
+
+
+class ArrayTableTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.path = os.path.join(self.directory, 'states.npy')
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def _segments(self):
+        return sorted(name for name in os.listdir(self.directory) if name.startswith('states.') and
+                      name != 'states.npy.lock')
+
+    def test_round_trip(self):
+        table = ArrayTable(self.path, WIDTH)
+        for i in range(10):
+            table.put(store_key(i), _row(i))
+        np.testing.assert_array_equal(table.get(store_key(3)), _row(3))
+        self.assertEqual(self._segments(), [])
+        table.flush()
+
+        reopened = ArrayTable(self.path, WIDTH)
+        self.assertEqual(len(reopened), 10)
+        for i in range(10):
+            np.testing.assert_array_equal(reopened.get(store_key(i)), _row(i))
+        self.assertIsNone(reopened.get(store_key(10)))
+
+    def test_flush_at_threshold(self):
+        itemsize = ArrayTable(self.path, WIDTH).dtype.itemsize
+        table = ArrayTable(self.path, WIDTH, flush_bytes=4 * itemsize)
+        for i in range(3):
+            table.put(store_key(i), _row(i))
+        self.assertEqual(len(ArrayTable(self.path, WIDTH)), 0)
+        table.put(store_key(3), _row(3))
+        # the new rows were flushed without an explicit flush
+        self.assertEqual(len(ArrayTable(self.path, WIDTH)), 4)
+
+    def test_segments_are_merged(self):
+        itemsize = ArrayTable(self.path, WIDTH).dtype.itemsize
+        table = ArrayTable(self.path, WIDTH, flush_bytes=itemsize)
+        for i in range(100):
+            table.put(store_key(i), _row(i))
+            # a row put again is not stored again
+            table.put(store_key(i // 2), _row(i // 2))
+        # segments of decreasing sizes, one per bit of the number of rows
+        self.assertEqual(len(self._segments()), bin(100).count('1'))
+        reopened = ArrayTable(self.path, WIDTH)
+        self.assertEqual(len(reopened), 100)
+        for i in range(100):
+            np.testing.assert_array_equal(reopened.get(store_key(i)), _row(i))
+
+    def test_table_file_of_older_versions(self):
+        dtype = ArrayTable(self.path, WIDTH).dtype
+        data = np.zeros(2, dtype=dtype)
+        data['key'] = [store_key(1), store_key(0)]
+        data['row'] = [_row(1), _row(0)]
+        np.save(self.path, np.sort(data, order='key'))
+        table = ArrayTable(self.path, WIDTH)
+        np.testing.assert_array_equal(table.get(store_key(0)), _row(0))
+        table.put(store_key(2), _row(2))
+        table.flush()
+        # merged into a segment with the new row
+        self.assertFalse(os.path.exists(self.path))
+        reopened = ArrayTable(self.path, WIDTH)
+        for i in range(3):
+            np.testing.assert_array_equal(reopened.get(store_key(i)), _row(i))
+
+    def test_concurrent_writers(self):
+        context = multiprocessing.get_context('spawn')
+        writers = [context.Process(target=_write_rows, args=(self.path, 50 * w, 60)) for w in range(4)]
+        for writer in writers:
+            writer.start()
+        for writer in writers:
+            writer.join()
+            self.assertEqual(writer.exitcode, 0)
+        table = ArrayTable(self.path, WIDTH)
+        for i in range(210):
+            np.testing.assert_array_equal(table.get(store_key(i)), _row(i))
+        # rows written by several writers are kept once, once all the segments are merged
+        table.put(store_key(-1), _row(-1))
+        table.flush()
+        self.assertLessEqual(len(ArrayTable(self.path, WIDTH)), 211 + 3 * 10)
+
+
+class ModelStoreTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.config = argparse.Namespace(latent_size=2)
+        self.config.decoder = argparse.Namespace(num_layers=2, units=3)
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_round_trip(self):
+        store = ModelStore(self.directory, 'digest', self.config)
+        psi = np.array([[1, 2], [3, 4]], dtype=np.float32)
+        state = [np.array([[1, 2, 3]], dtype=np.float32), np.array([[4, 5, 6]], dtype=np.float32)]
+        store.put_psi('evidence', psi)
+        store.put_state(('psi', 1, 2), state)
+        store.flush()
+
+        readonly = ModelStore(self.directory, 'digest', self.config, readonly=True)
+        np.testing.assert_array_equal(readonly.get_psi('evidence', samples=2), psi)
+        self.assertIsNone(readonly.get_psi('evidence', samples=3))
+        restored = readonly.get_state(('psi', 1, 2))
+        for layer, expected in zip(restored, state):
+            np.testing.assert_array_equal(layer, expected)
+        self.assertIsNone(readonly.get_state(('psi', 1)))
+        # another model digest has its own store
+        self.assertIsNone(ModelStore(self.directory, 'other', self.config).get_state(('psi', 1, 2)))